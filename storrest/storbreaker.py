@@ -0,0 +1,120 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+# the key of the breaker covering every command of the controller
+ALL_COMMANDS = '*'
+
+
+class _State(object):
+    def __init__(self):
+        self.failures = 0
+        self.opened = 0
+        self.until = None
+        self.error = None
+        self.failed_at = None
+
+
+class CircuitBreaker(object):
+    """Fail fast the nytrocli commands which keep failing
+
+    The failures are counted per controller and command class (see
+    storutils.command_class). After threshold failures in a row the
+    breaker of the command opens: the command fails right away with the
+    error it has failed with for backoff seconds, doubled every time the
+    breaker opens again (up to max_backoff). Then a single call is let
+    through to probe the controller, its success closes the breaker.
+    A timeout opens the breaker of every command of the controller at
+    once, a hung controller would make each of them wait for the timeout
+    otherwise. The failures are forgotten after max_backoff seconds
+    without any.
+    """
+    def __init__(self, threshold=3, backoff=10, max_backoff=600,
+                 clock=time.time):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._clock = clock
+        self._states = {}
+        self._rejected = {}
+        self._lock = threading.Lock()
+
+    def _keys(self, controller, command):
+        controller = str(controller)
+        return (controller, command), (controller, ALL_COMMANDS)
+
+    def check(self, controller, command):
+        """The error to fail the command with, None if it may run"""
+        now = self._clock()
+        with self._lock:
+            for key in self._keys(controller, command):
+                state = self._states.get(key)
+                if state is None or state.until is None:
+                    continue
+                if state.until > now:
+                    self._rejected[key] = self._rejected.get(key, 0) + 1
+                    return state.error
+                # let this call probe the controller, the others fail
+                # fast until it's done
+                state.until = now + self._delay(state)
+        return None
+
+    def _delay(self, state):
+        return min(self.backoff * 2 ** (state.opened - 1), self.max_backoff)
+
+    def success(self, controller, command):
+        with self._lock:
+            for key in self._keys(controller, command):
+                self._states.pop(key, None)
+
+    def failure(self, controller, command, error, timeout=False):
+        now = self._clock()
+        cmd_key, controller_key = self._keys(controller, command)
+        with self._lock:
+            self._expire(now)
+            for key in ((cmd_key, controller_key) if timeout else (cmd_key,)):
+                state = self._states.setdefault(key, _State())
+                state.failures += 1
+                state.error = error
+                state.failed_at = now
+                if timeout or state.failures >= self.threshold:
+                    state.opened += 1
+                    state.until = now + self._delay(state)
+
+    def _expire(self, now):
+        idle = [key for key, state in self._states.iteritems()
+                if max(state.failed_at, state.until or 0) + self.max_backoff <
+                now]
+        for key in idle:
+            del self._states[key]
+
+    def stats(self):
+        """{(controller, command class): {'open': N, 'rejected': M}}"""
+        now = self._clock()
+        ret = {}
+
+        def _stats(key):
+            return ret.setdefault(key, {'open': 0, 'rejected': 0})
+
+        with self._lock:
+            for key, state in self._states.iteritems():
+                stats = _stats(key)
+                if state.until is not None and state.until > now:
+                    stats['open'] += 1
+            for key, rejected in self._rejected.iteritems():
+                _stats(key)['rejected'] += rejected
+        return ret
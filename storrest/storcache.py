@@ -0,0 +1,381 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import hashlib
+import sys
+import threading
+import time
+
+import storcompat
+
+DEFAULT_TTL_KEY = 'default'
+OrderedDict = getattr(collections, 'OrderedDict', storcompat.OrderedDict)
+
+
+def parse_ttl_spec(spec):
+    """Parse the TTL specification given on the command line
+
+    The spec is the default TTL optionally followed by the per command
+    class overrides, i.e. '5,/c show health=60,/c/e/s show all=30'
+    """
+    ttl = {}
+    for item in spec.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        if '=' in item:
+            cmd_class, seconds = item.rsplit('=', 1)
+            ttl[cmd_class.strip()] = float(seconds)
+        else:
+            ttl[DEFAULT_TTL_KEY] = float(item)
+    return ttl
+
+
+class ResultCache(object):
+    """Cache the parsed output of read-only nytrocli commands
+
+    ttl is either a number of seconds applied to every command class
+    or a dict mapping the command class (see storutils.command_class)
+    to the number of seconds; the 'default' key applies to the classes
+    which are not listed explicitly. Zero or None disables caching.
+    """
+    def __init__(self, ttl=None, clock=time.time):
+        if not isinstance(ttl, dict):
+            ttl = {DEFAULT_TTL_KEY: ttl}
+        self._ttl = ttl
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        # bumped by invalidate() so that the output read before
+        # the modification doesn't get stored after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def ttl_for(self, cmd_class):
+        return self._ttl.get(cmd_class, self._ttl.get(DEFAULT_TTL_KEY))
+
+    def get(self, key):
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, controller, value = entry
+                if expires > now:
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+        return False, None
+
+    def put(self, key, value, cmd_class, controller, generation=None):
+        ttl = self.ttl_for(cmd_class)
+        if not ttl:
+            return
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            self._entries[key] = (self._clock() + ttl, controller, value)
+
+    def invalidate(self, controller='all'):
+        """Drop the entries of the controller
+
+        The output of /call commands covers every controller, hence
+        those entries are dropped too.
+        """
+        controller = str(controller)
+        with self._lock:
+            self.generation += 1
+            if controller == 'all':
+                self._entries.clear()
+                return
+            stale = [key for key, (_, ctrl, _) in self._entries.iteritems()
+                     if ctrl in (controller, 'all')]
+            for key in stale:
+                del self._entries[key]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TopologyIndex(object):
+    """Keep the topology of the controllers between the requests
+
+    The topology (VD to drive groups, drive group to PDs and
+    (enclosure, slot) to PD maps, see Storcli._parse_topology) is
+    dropped when the controller gets modified and expires after ttl
+    seconds since it can be changed behind storrest's back too.
+    """
+    def __init__(self, ttl=60, clock=time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        # bumped by invalidate() so that a topology read before
+        # the modification doesn't get stored after it
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, controller):
+        now = self._clock()
+        with self._lock:
+            entry = self._entries.get(str(controller))
+            if entry is not None and entry[0] > now:
+                self.hits += 1
+                return entry[1]
+            self.misses += 1
+        return None
+
+    def put(self, controller, topology, generation):
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[str(controller)] = (self._clock() + self.ttl,
+                                              topology)
+
+    def invalidate(self, controller='all'):
+        controller = str(controller)
+        with self._lock:
+            self.generation += 1
+            if controller == 'all':
+                self._entries.clear()
+            else:
+                self._entries.pop(controller, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class ControllerProfiles(object):
+    """Remember what doesn't change while the controller stays in place
+
+    The profile of the controller is a dict of its model, whether
+    it's a Nytro WarpDrive and its enclosures. It's started over if
+    the PCI address of the controller changes and expires after ttl
+    seconds (the enclosures can be plugged in and out).
+    """
+    def __init__(self, ttl=600, clock=time.time):
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _current(self, controller, now):
+        entry = self._entries.get(controller)
+        if entry is not None and entry[0] > now:
+            return entry
+        return None
+
+    def get(self, controller, field):
+        """The field of the controller profile, None if it's not known"""
+        now = self._clock()
+        with self._lock:
+            entry = self._current(str(controller), now)
+            if entry is not None and field in entry[2]:
+                self.hits += 1
+                return entry[2][field]
+            self.misses += 1
+        return None
+
+    def update(self, controller, pci_address, **fields):
+        now = self._clock()
+        controller = str(controller)
+        with self._lock:
+            entry = self._current(controller, now)
+            if entry is None or entry[1] != pci_address:
+                entry = (now + self.ttl, pci_address, {})
+                self._entries[controller] = entry
+            entry[2].update(fields)
+
+    def add(self, controller, **fields):
+        """Add to the current profile of the controller, if there's any"""
+        now = self._clock()
+        with self._lock:
+            entry = self._current(str(controller), now)
+            if entry is not None:
+                entry[2].update(fields)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """Share the result of identical concurrent calls
+
+    The first caller of do() runs the function, the callers which
+    arrive with the same key while it's running wait for it and get
+    the very same result (or exception). The callers arriving after
+    invalidate() don't join the calls started before it.
+    """
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self.generation = 0
+        self.calls = 0
+        self.coalesced = 0
+
+    def do(self, key, fcn, *args, **kwargs):
+        with self._lock:
+            key = (self.generation, key)
+            self.calls += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = fcn(*args, **kwargs)
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def invalidate(self):
+        with self._lock:
+            self.generation += 1
+
+    @property
+    def in_flight(self):
+        return len(self._calls)
+
+    def stats(self):
+        return {'calls': self.calls,
+                'coalesced': self.coalesced,
+                'in_flight': self.in_flight}
+
+
+def _failed(out):
+    """Whether nytrocli has reported a failure in the decoded output"""
+    try:
+        return any(ctrl['Command Status']['Status'] != 'Success'
+                   for ctrl in out['Controllers'])
+    except (KeyError, TypeError):
+        return False
+
+
+class ResponseMemo(object):
+    """Reuse what has been parsed from the unchanged nytrocli output
+
+    decode() keeps the decoded output of every command along with the
+    hash of its raw output, the same output gives back the very same
+    objects (the failures are not kept). Everything computed from them
+    is memoized by derive() by the identity of its sources (kept alive
+    by the entry, so their ids can't be reused). encode() memoizes the
+    JSON encoding of the derived results. Up to max_entries decoded
+    outputs and as many derived results are kept, the least recently
+    used ones are dropped. The memoized objects are shared and must
+    never be modified.
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._decoded = OrderedDict()
+        self._derived = OrderedDict()
+        # id of the derived result -> its entry key
+        self._results = {}
+        self._lock = threading.Lock()
+        self.hits = collections.defaultdict(int)
+        self.misses = collections.defaultdict(int)
+
+    def _count(self, kind, hit):
+        with self._lock:
+            (self.hits if hit else self.misses)[kind] += 1
+
+    def decode(self, key, raw_out, fcn, *args, **kwargs):
+        digest = hashlib.sha1(raw_out or '').digest()
+        with self._lock:
+            entry = self._decoded.get(key)
+            if entry is not None and entry[0] == digest:
+                self._decoded[key] = self._decoded.pop(key)
+            else:
+                entry = None
+        if entry is not None:
+            self._count('decode', True)
+            return entry[1]
+        self._count('decode', False)
+        out = fcn(*args, **kwargs)
+        with self._lock:
+            self._decoded.pop(key, None)
+            if _failed(out):
+                return out
+            self._decoded[key] = (digest, out)
+            while len(self._decoded) > self.max_entries:
+                self._decoded.popitem(last=False)
+        return out
+
+    def _lookup(self, key, sources):
+        entry = self._derived.get(key)
+        if entry is None or len(entry[0]) != len(sources) or \
+                any(a is not b for a, b in zip(entry[0], sources)):
+            return None
+        return entry
+
+    def derive(self, name, sources, fcn, *args, **kwargs):
+        sources = tuple(sources)
+        key = (name,) + tuple(id(src) for src in sources)
+        with self._lock:
+            entry = self._lookup(key, sources)
+            if entry is not None:
+                self._derived[key] = self._derived.pop(key)
+        if entry is not None:
+            self._count(name, True)
+            return entry[1]
+        self._count(name, False)
+        result = fcn(*args, **kwargs)
+        with self._lock:
+            old = self._derived.pop(key, None)
+            if old is not None:
+                self._results.pop(id(old[1]), None)
+            self._derived[key] = (sources, result)
+            self._results[id(result)] = key
+            while len(self._derived) > self.max_entries:
+                _, (_, evicted) = self._derived.popitem(last=False)
+                self._results.pop(id(evicted), None)
+        return result
+
+    def encode(self, obj, fcn):
+        """The memoized fcn(obj) if obj is a derived result, else None"""
+        with self._lock:
+            memoized = id(obj) in self._results
+        if not memoized:
+            return None
+        return self.derive('encode', (obj,), fcn, obj)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': dict(self.hits), 'misses': dict(self.misses),
+                    'entries': len(self._decoded) + len(self._derived)}
@@ -15,10 +15,19 @@
 
 import json
 import logging
+import re
 import subprocess
+import time
 
+import stortiming
 import storutils
-from storcli_health import HealthInfoParser
+from storcache import SingleFlight
+from storcli_health import HealthInfoParser, prune_drive_details
+from storexec import CommandTimeout, PoolBusy, ProcessPool
+from stormetrics import Registry, SIZE_BUCKETS
+from storprofile import profiled
+from storrecords import PhysicalDrive, Record, VirtualDrive
+from storsched import ControllerScheduler
 from storutils import *
 
 if 'check_output' not in dir(subprocess):
@@ -30,7 +39,23 @@ SOMETHING_BAD_HAPPEND = 42
 NO_SUCH_VDRIVE = SOMETHING_BAD_HAPPEND
 INVALID_NYTROCLI_JSON = 100500
 MULTIPLE_VDS_FOR_SAME_PDS = SOMETHING_BAD_HAPPEND
+NYTROCLI_TIMEOUT = 100501
+STORCLI_BUSY = 503
+# the outputs decoded with prune_drive_details
+HEALTH_COMMAND_CLASSES = ('/c/e/s show all', '/c/s show all')
+# the controller can't run the command at all
+UNSUPPORTED_RX = re.compile('un-?supported', re.IGNORECASE)
+# the command addresses a VD, enclosure or drive picked by the client
+OBJECT_ID_RX = re.compile(r'/[ves]\d+')
 LOG = logging.getLogger('storrest.storcli')
+# identical commands running at the same time share the nytrocli process
+INFLIGHT = SingleFlight()
+# reads on a controller run concurrently, writes are exclusive
+SCHEDULER = ControllerScheduler()
+# limits the number of nytrocli processes running at once
+POOL = ProcessPool(max_processes=8)
+# nytrocli run time, output size, errors
+METRICS = Registry()
 
 
 class StorcliError(Exception):
@@ -39,17 +64,78 @@ class StorcliError(Exception):
         self.error_code = error_code
 
 
+class StorcliBusyError(StorcliError):
+    def __init__(self, msg, error_code=STORCLI_BUSY, retry_after=1):
+        super(StorcliBusyError, self).__init__(msg, error_code=error_code)
+        self.retry_after = retry_after
+
+
+def is_controller_failure(cmd, error):
+    """Whether the error tells the controller can't run the command
+
+    i.e. it has timed out, garbled the output or doesn't support the
+    command, rather than the object asked for doesn't exist. Any error
+    of a command addressing no particular VD, enclosure or drive (i.e.
+    '/c0 show health') is the controller's.
+    """
+    if error.error_code in (NYTROCLI_TIMEOUT, INVALID_NYTROCLI_JSON):
+        return True
+    if not OBJECT_ID_RX.search(cmd[0]):
+        return True
+    return UNSUPPORTED_RX.search(error.message or '') is not None
+
+
 class Storcli(object):
-    def __init__(self, storcli_cmd=STORCLI_CMD):
+    def __init__(self, storcli_cmd=STORCLI_CMD, cache=None, inflight=None,
+                 max_workers=1, batch_commands=False, scheduler=None,
+                 pool=None, metrics=None, profiler=None, memo=None,
+                 topology=None, profiles=None, breaker=None):
         self.storcli_cmd = storcli_cmd
+        # the number of controllers queried concurrently
+        self.max_workers = max_workers
+        # use /call commands instead of per-controller ones when possible
+        self.batch_commands = batch_commands
         self._health_parser = HealthInfoParser()
-
-    def _extract_storcli_data(self, data, error_code=None):
+        self._cache = cache
+        self._inflight = inflight if inflight is not None else INFLIGHT
+        self._scheduler = scheduler if scheduler is not None else SCHEDULER
+        self._pool = pool if pool is not None else POOL
+        # storprofile.Profiler for the public methods, None disables it
+        self._profiler = profiler
+        # storcache.ResponseMemo shared by all instances, None disables it
+        self._memo = memo
+        # storcache.TopologyIndex shared by all instances, None disables it
+        self._topology_index = topology
+        # storcache.ControllerProfiles shared by all instances, None
+        # disables it
+        self._profiles = profiles
+        # storbreaker.CircuitBreaker of the read-only commands, None
+        # disables it
+        self._breaker = breaker
+        metrics = metrics if metrics is not None else METRICS
+        self._command_seconds = metrics.histogram(
+            'nytrocli_command_seconds', 'Run time of nytrocli commands')
+        self._decode_seconds = metrics.histogram(
+            'nytrocli_decode_seconds', 'JSON decoding time of nytrocli output')
+        self._output_bytes = metrics.histogram(
+            'nytrocli_output_bytes', 'Size of nytrocli output', SIZE_BUCKETS)
+        self._errors = metrics.counter(
+            'nytrocli_errors_total', 'Failed nytrocli commands by ErrCd')
+        self._create_vd_seconds = metrics.histogram(
+            'storrest_create_vd_seconds',
+            'Time to create a VD and to look it up (by lookup method)')
+
+    def _extract_storcli_data(self, data, error_code=None, partial=False):
         ret = {}
         for controller_out in data['Controllers']:
             status_obj = controller_out['Command Status']
             controller_id = status_obj['Controller']
             status = status_obj['Status']
+            if status != 'Success' and partial:
+                # the command has failed on some of the controllers
+                LOG.info('controller %s error data: %s',
+                         controller_id, controller_out)
+                continue
             if status != 'Success':
                 LOG.info('error data: %s', data)
                 error_code = status_obj.get('ErrCd', SOMETHING_BAD_HAPPEND)
@@ -58,41 +144,159 @@ class Storcli(object):
             ret[controller_id] = controller_out.get('Response Data', {})
         return ret
 
-    def _run(self, cmd, permissive=False):
+    def _run(self, cmd, permissive=False, partial=False):
         _cmd = []
         _cmd.extend(self.storcli_cmd)
         _cmd.extend(cmd)
         _cmd.append('J')
-        error_code = None
+        controller = command_controller(cmd)
+        if not is_read_only(cmd):
+            try:
+                return self._execute(_cmd, permissive, partial)
+            finally:
+                # the reads started before the modification are not joined
+                self._inflight.invalidate()
+                if self._cache is not None:
+                    self._cache.invalidate(controller)
+                if self._topology_index is not None:
+                    self._topology_index.invalidate(controller)
+
+        key = (tuple(_cmd), permissive, partial)
+        generation = None
+        if self._cache is not None:
+            hit, out = self._cache.get(key)
+            if hit:
+                return out
+            generation = self._cache.generation
+        out = self._inflight.do(key, self._guarded_execute, cmd, _cmd,
+                                permissive, partial)
+        if self._cache is not None:
+            self._cache.put(key, out, command_class(cmd), controller,
+                            generation)
+        return out
+
+    def _guarded_execute(self, cmd, _cmd, permissive=False, partial=False):
+        """_execute unless the command keeps failing (see _breaker)"""
+        breaker = self._breaker
+        if breaker is None:
+            return self._execute(_cmd, permissive, partial)
+        controller = command_controller(cmd)
+        command = command_class(cmd)
+        error = breaker.check(controller, command)
+        if error is not None:
+            msg = '"{0}" has been failing, not retried yet: {1}'
+            raise StorcliError(msg.format(' '.join(cmd), error.message),
+                               error_code=error.error_code)
         try:
-            raw_out = subprocess.check_output(_cmd)
-        except subprocess.CalledProcessError, e:
-            raw_out = e.output
-            error_code = e.returncode
-        except OSError, oe:
-            msg = 'Failed to run "{cmd}", error: {errno} ({strerror})'
-            msg = msg.format(cmd=' '.join(_cmd),
-                             errno=oe.errno,
-                             strerror=oe.strerror)
-            raise StorcliError(msg, error_code=oe.errno)
-
-        def skip_nytrocli_debug_messages(s):
-            paren_idx = s.find('{')
-            return s[paren_idx:] if paren_idx != -1 else s
+            out = self._execute(_cmd, permissive, partial)
+        except StorcliBusyError:
+            # storrest is overloaded rather than the controller
+            raise
+        except StorcliError, e:
+            if is_controller_failure(cmd, e):
+                breaker.failure(controller, command, e,
+                                timeout=e.error_code == NYTROCLI_TIMEOUT)
+            else:
+                # the controller has answered, i.e. there's no such VD
+                breaker.success(controller, command)
+            raise
+        breaker.success(controller, command)
+        return out
 
+    def _spawn(self, _cmd):
+        cmd = _cmd[len(self.storcli_cmd):]
+        error_code = None
+        with self._scheduler.command(command_controller(cmd),
+                                     write=not is_read_only(cmd)):
+            start = time.time()
+            try:
+                raw_out = self._pool.check_output(_cmd)
+            except subprocess.CalledProcessError, e:
+                raw_out = e.output
+                error_code = e.returncode
+            except PoolBusy:
+                raise StorcliBusyError('Too many nytrocli commands queued',
+                                       retry_after=self._pool.retry_after)
+            except CommandTimeout:
+                msg = '"{cmd}" timed out after {timeout} seconds'
+                raise StorcliError(msg.format(cmd=' '.join(_cmd),
+                                              timeout=self._pool.timeout),
+                                   error_code=NYTROCLI_TIMEOUT)
+            except OSError, oe:
+                msg = 'Failed to run "{cmd}", error: {errno} ({strerror})'
+                msg = msg.format(cmd=' '.join(_cmd),
+                                 errno=oe.errno,
+                                 strerror=oe.strerror)
+                raise StorcliError(msg, error_code=oe.errno)
+            finally:
+                elapsed = time.time() - start
+                self._command_seconds.labels(command=command_verb(cmd[:-1]))\
+                    .observe(elapsed)
+                stortiming.record('spawn', elapsed)
+        return raw_out, error_code
+
+    def _decode(self, _cmd, raw_out, permissive=False):
+        # strip the nytrocli path and the trailing 'J'
+        cmd = _cmd[len(self.storcli_cmd):-1]
+        start = 0
         if permissive:
-            raw_out = skip_nytrocli_debug_messages(raw_out)
-
-        try:
-            out = json.loads(raw_out)
-        except:
-            LOG.info('invalid JSON %s', raw_out)
-            raise StorcliError(msg='invalid JSON received',
-                               error_code=INVALID_NYTROCLI_JSON)
-        out = self._extract_storcli_data(out, error_code)
+            # skip nytrocli debug messages without copying the output
+            start = max(raw_out.find('{'), 0)
+        decoder = None
+        if command_class(cmd) in HEALTH_COMMAND_CLASSES:
+            try:
+                decoder = json.JSONDecoder(
+                    object_pairs_hook=prune_drive_details)
+            except TypeError:
+                # python 2.6 json has got no object_pairs_hook
+                pass
+        if decoder is None:
+            return json.loads(raw_out[start:] if start else raw_out)
+        start = json.decoder.WHITESPACE.match(raw_out, start).end()
+        out, end = decoder.raw_decode(raw_out, start)
+        if raw_out[end:].strip():
+            raise ValueError('Extra data')
         return out
 
-    def _parse_controller_data(self, controller_id, dat):
+    def _execute(self, _cmd, permissive=False, partial=False):
+        verb = command_verb(_cmd[len(self.storcli_cmd):-1])
+        try:
+            raw_out, error_code = self._spawn(_cmd)
+            self._output_bytes.labels(command=verb).observe(len(raw_out or ''))
+            start = time.time()
+            try:
+                if self._memo is not None:
+                    out = self._memo.decode(tuple(_cmd), raw_out,
+                                            self._decode, _cmd, raw_out,
+                                            permissive=permissive)
+                else:
+                    out = self._decode(_cmd, raw_out, permissive=permissive)
+            except:
+                LOG.info('invalid JSON %s', raw_out)
+                raise StorcliError(msg='invalid JSON received',
+                                   error_code=INVALID_NYTROCLI_JSON)
+            elapsed = time.time() - start
+            self._decode_seconds.labels(command=verb).observe(elapsed)
+            stortiming.record('decode', elapsed)
+            # don't keep the raw output alive while extracting the data
+            del raw_out
+            with stortiming.timed('extract'):
+                ret = self._extract_storcli_data(out, error_code,
+                                                 partial=partial)
+            self._scheduler.answered(command_controller(
+                _cmd[len(self.storcli_cmd):-1]))
+            return ret
+        except StorcliError, e:
+            self._errors.labels(command=verb, error_code=e.error_code).inc()
+            raise
+
+    def _memoized(self, name, sources, fcn, *args, **kwargs):
+        """fcn(*args, **kwargs), reused while the sources don't change"""
+        if self._memo is None:
+            return fcn(*args, **kwargs)
+        return self._memo.derive(name, sources, fcn, *args, **kwargs)
+
+    def _parse_controller_data(self, controller_id, dat, prefetched=None):
         def get_host_interface(obj):
             # XXX: for some reason this information is located
             # in different subobjects for WarpDrive and MegaRAID.
@@ -111,26 +315,49 @@ class Storcli(object):
                 'sas_address': dat['Basics'].get('SAS Address'),
                 'host_interface': get_host_interface(dat),
                 }
+        if prefetched is None:
+            prefetched = {}
+        warpdrive = self._is_warpdrive(controller_id, controller_data=dat)
         # XXX: nytrocli errors out when trying to enumerate the enclosures
         # of Nytro WarpDrive (instead of givin an empty list)
-        if cinf['model'].startswith('Nytro WarpDrive'):
+        if warpdrive:
             enclosures = []
+        elif 'enclosures' in prefetched:
+            enclosures = prefetched['enclosures']
         else:
-            enclosures = self._enclosures(controller_id)
+            enclosures = self._profile(controller_id, 'enclosures')
+            if enclosures is None:
+                enclosures = self._enclosures(controller_id)
+        if self._profiles is not None:
+            self._profiles.add(controller_id, enclosures=enclosures)
         cinf['enclosures'] = enclosures
         cinf['capabilities'] = self._controller_capabilities(dat)
-        cinf['health'] = self._controller_health(controller_id)
+        if 'health' in prefetched:
+            cinf['health'] = prefetched['health']
+        else:
+            cinf['health'] = self._controller_health(controller_id)
         return cinf
 
+    def _parse_enclosures(self, cdat):
+        return sorted([d['EID'] for d in cdat['Properties']])
+
+    def _profile(self, controller_id, field):
+        if self._profiles is None:
+            return None
+        return self._profiles.get(controller_id, field)
+
     def _enclosures(self, controller_id):
         dat = self._run('/c{0}/eall show'.format(controller_id).split())
-        return sorted([d['EID'] for d in dat[controller_id]['Properties']])
+        return self._parse_enclosures(dat[controller_id])
 
     @property
+    @profiled
     def controllers(self):
         data = self._run('/call show all'.split())
-        return sorted([self._parse_controller_data(controller_id, dat)
-                       for controller_id, dat in data.iteritems()])
+        ret = parallel_map(lambda item: self._parse_controller_data(*item),
+                           data.items(),
+                           self.max_workers)
+        return sorted(ret)
 
     def _controller_capabilities(self, dat):
         caps = dat.get('Capabilities')
@@ -166,20 +393,84 @@ class Storcli(object):
         cmd = '/c{0} show health'.format(controller_id)
         try:
             data = self._run(cmd.split(), permissive=True)
+        except StorcliBusyError:
+            raise
         except StorcliError:
             return None
         return self._parse_controller_health(data[controller_id])
 
+    def _prefetch_controllers_data(self, data):
+        """Get the enclosures, health and drives of all controllers at once
+
+        Runs the whole system /call commands instead of 3 commands per
+        controller and splits their output by controller. The enclosures
+        and drives of Nytro WarpDrive can't be queried this way (see
+        _parse_controller_data and _get_raw_health_info), so these are
+        left for the per-controller commands if there's any WarpDrive.
+        The same happens if a /call command fails.
+        """
+        prefetched = dict((controller_id, {}) for controller_id in data)
+        if not self.batch_commands:
+            return prefetched
+
+        has_warpdrive = any(self._is_warpdrive(cid, controller_data=dat)
+                            for cid, dat in data.iteritems())
+        commands = [('health', '/call show health')]
+        if not has_warpdrive:
+            if any(self._profile(cid, 'enclosures') is None for cid in data):
+                commands.append(('enclosures', '/call/eall show'))
+            commands.append(('drives_health', '/call/eall/sall show all'))
+
+        def _run_batched(item):
+            key, cmd = item
+            try:
+                return key, self._run(cmd.split(),
+                                      permissive=key == 'health',
+                                      partial=key == 'health')
+            except StorcliBusyError:
+                # querying one by one would only queue more commands
+                raise
+            except StorcliError, e:
+                LOG.info('"%s" failed: %s, querying controllers one by one',
+                         cmd, e)
+                return key, None
+
+        for key, out in parallel_map(_run_batched, commands,
+                                     self.max_workers):
+            if out is None:
+                continue
+            for controller_id, cdat in prefetched.iteritems():
+                if key == 'health':
+                    # the controllers not supporting the command are skipped
+                    health = out.get(controller_id)
+                    if health is not None:
+                        health = self._parse_controller_health(health)
+                    cdat[key] = health
+                elif controller_id not in out:
+                    continue
+                elif key == 'enclosures':
+                    cdat[key] = self._parse_enclosures(out[controller_id])
+                else:
+                    cdat[key] = out
+        return prefetched
+
+    @profiled
     def controller_details(self, controller_id):
         if controller_id is None:
             controller_id = 'all'
         cmd = '/c{0} show all'.format(controller_id)
         data = self._run(cmd.split())
+        prefetched = {}
+        if controller_id == 'all':
+            prefetched = self._prefetch_controllers_data(data)
 
         def _controller_details(cid, dat):
-            details = self._parse_controller_data(cid, dat)
+            details = self._parse_controller_data(cid, dat,
+                                                  prefetched.get(cid))
             _dat = {cid: dat}
-            physical_drives = self._parse_physical_drives(_dat)
+            physical_drives = self._parse_physical_drives(
+                _dat,
+                raw_health_info=prefetched.get(cid, {}).get('drives_health'))
             details['virtual_drives'] = self._parse_virtual_drives(
                 _dat,
                 phys_drives=physical_drives
@@ -187,8 +478,9 @@ class Storcli(object):
             details['physical_drives'] = physical_drives
             return details
 
-        ret = [_controller_details(_controller_id, dat)
-               for _controller_id, dat in data.iteritems()]
+        ret = parallel_map(lambda item: _controller_details(*item),
+                           data.items(),
+                           self.max_workers)
         all_controllers = controller_id is None or controller_id == 'all'
         return sorted(ret) if all_controllers else ret[0]
 
@@ -212,17 +504,18 @@ class Storcli(object):
         drive_group, allocated = parse_drive_group(drive_dat['DG'])
         sector_size = storutils.parse_sector_size(drive_dat['SeSz'])
         size = storutils.parse_drive_size(drive_dat['Size'])
-        return {'controller_id': controller,
-                'enclosure': enclosure,
-                'slot': int(slot),
-                'drive_group': drive_group,
-                'size': size,
-                'sector_size': sector_size,
-                'allocated': allocated,
-                'state': storutils.parse_phys_drive_state(drive_dat['State']),
-                'medium': drive_dat.get('Med'),
-                'interface': drive_dat.get('Intf'),
-                'model': drive_dat['Model']}
+        return PhysicalDrive(
+            controller_id=controller,
+            enclosure=enclosure,
+            slot=int(slot),
+            drive_group=drive_group,
+            size=size,
+            sector_size=sector_size,
+            allocated=allocated,
+            state=storutils.parse_phys_drive_state(drive_dat['State']),
+            medium=drive_dat.get('Med'),
+            interface=drive_dat.get('Intf'),
+            model=drive_dat['Model'])
 
     def _get_raw_health_info(self, controller_id, is_warpdrive):
         health_cmd = '/c{0}/eall/sall show all'
@@ -231,24 +524,50 @@ class Storcli(object):
         health_cmd = health_cmd.format(controller_id)
         return self._run(health_cmd.split())
 
-    def _add_health_info(self, controller_id, pdrives, is_warpdrive=False):
-        raw_health_info = self._get_raw_health_info(controller_id,
-                                                    is_warpdrive)
-        self._health_parser.add_health_info(controller_id,
-                                            raw_health_info,
-                                            pdrives)
-
-    def _parse_physical_drives(self, data):
-        ret = []
-        for controller_id, controller_data in data.iteritems():
+    def _add_health_info(self, controller_id, pdrives, is_warpdrive=False,
+                         raw_health_info=None):
+        if raw_health_info is None:
+            raw_health_info = self._get_raw_health_info(controller_id,
+                                                        is_warpdrive)
+        with stortiming.timed('parse_health'):
+            self._health_parser.add_health_info(controller_id,
+                                                raw_health_info,
+                                                pdrives)
+
+    def _parse_physical_drives(self, data, raw_health_info=None):
+        def _parse_drives(controller_id, controller_data, is_warpdrive,
+                          health_info):
+            with stortiming.timed('parse_pd'):
+                drives = [self._parse_physical_drive(controller_id, drive_dat)
+                          for drive_dat in controller_data.get('PD LIST', [])]
+            self._add_health_info(controller_id, drives, is_warpdrive,
+                                  raw_health_info=health_info)
+            return drives
+
+        def _controller_drives(item):
+            controller_id, controller_data = item
             is_warpdrive = self._is_warpdrive(controller_id,
                                               controller_data=controller_data)
-            drives = [self._parse_physical_drive(controller_id, drive_dat)
-                      for drive_dat in controller_data.get('PD LIST', [])]
-            self._add_health_info(controller_id, drives, is_warpdrive)
-            ret.extend(drives)
-        return sorted(ret)
-
+            health_info = raw_health_info
+            if health_info is None:
+                health_info = self._get_raw_health_info(controller_id,
+                                                        is_warpdrive)
+            return self._memoized('pd', (controller_data,
+                                         health_info[controller_id]),
+                                  _parse_drives, controller_id,
+                                  controller_data, is_warpdrive, health_info)
+
+        def _merge(drive_lists):
+            ret = []
+            for drives in drive_lists:
+                ret.extend(drives)
+            return sorted(ret, key=Record.sort_key)
+
+        drive_lists = parallel_map(_controller_drives, data.items(),
+                                   self.max_workers)
+        return self._memoized('pds', drive_lists, _merge, drive_lists)
+
+    @profiled
     def physical_drives(self, controller_id=None):
         if controller_id is None:
             controller_id = 'all'
@@ -257,14 +576,7 @@ class Storcli(object):
         return self._parse_physical_drives(data)
 
     def _parse_virtual_drive(self, controller, vdrive_dat):
-        try:
-            drive_group, virtual_drive = vdrive_dat['DG/VD'].split('/')
-        except AttributeError:
-            # XXX: sometimes nytrocli puts an integer here
-            if isinstance(vdrive_dat['DG/VD'], int):
-                drive_group = virtual_drive = vdrive_dat['DG/VD']
-            else:
-                raise
+        drive_group, virtual_drive = parse_dg_vd(vdrive_dat['DG/VD'])
         size = storutils.parse_drive_size(vdrive_dat['Size'])
         raid_level = storutils.parse_raid_level(vdrive_dat['TYPE'])
         consistent = vdrive_dat['Consist'].lower() == 'yes'
@@ -279,53 +591,112 @@ class Storcli(object):
             else:
                 return val.lower()
 
-        return {'controller_id': controller,
-                'virtual_drive': int(virtual_drive),
-                'drive_group': int(drive_group),
-                'state': state,
-                'size': size,
-                'raid_level': raid_level,
-                'access': vdrive_dat['Access'].lower(),
-                'name': vdrive_dat['Name'],
-                'consistent': consistent,
-                'read_ahead': read_ahead,
-                'write_cache': write_cache,
-                'io_policy': io_policy,
-                'ssd_caching_active': _ssd_caching_active(vdrive_dat),
-                }
+        return VirtualDrive(
+            controller_id=controller,
+            virtual_drive=virtual_drive,
+            drive_group=drive_group,
+            state=state,
+            size=size,
+            raid_level=raid_level,
+            access=vdrive_dat['Access'].lower(),
+            name=vdrive_dat['Name'],
+            consistent=consistent,
+            read_ahead=read_ahead,
+            write_cache=write_cache,
+            io_policy=io_policy,
+            ssd_caching_active=_ssd_caching_active(vdrive_dat))
 
     def _parse_virtual_drives(self, data, phys_drives=None):
-
-        def drive_belongs_to(phys, virt):
-            if phys['drive_group'] is None:
-                return False
-            if phys['controller_id'] != virt['controller_id']:
-                return False
-            if phys['drive_group'] == virt['drive_group']:
-                return True
-            try:
-                return virt['drive_group'] in phys['drive_group']
-            except TypeError:
-                return False
-
         if phys_drives is None:
             phys_drives = self._parse_physical_drives(data)
 
-        def find_physical_drives_of_vdrive(vdrive):
-            pdrives = [d for d in phys_drives if drive_belongs_to(d, vdrive)]
-            pdrives.sort()
-            vdrive['physical_drives'] = pdrives
-
-        ret = []
-        for controller, response_data in data.iteritems():
-            vdrives = [self._parse_virtual_drive(controller, vdrive_dat)
-                       for vdrive_dat in response_data.get('VD LIST', [])]
-            map(find_physical_drives_of_vdrive, vdrives)
-            ret.extend(vdrives)
-        return sorted(ret)
+        def _parse_drives():
+            with stortiming.timed('parse_vd'):
+                dg_index = index_drive_groups(phys_drives)
+
+                def find_physical_drives_of_vdrive(vdrive):
+                    key = (vdrive['controller_id'], vdrive['drive_group'])
+                    vdrive['physical_drives'] = list(dg_index.get(key, ()))
+
+                ret = []
+                for controller, response_data in data.iteritems():
+                    vdrives = [self._parse_virtual_drive(controller,
+                                                         vdrive_dat)
+                               for vdrive_dat in
+                               response_data.get('VD LIST', [])]
+                    map(find_physical_drives_of_vdrive, vdrives)
+                    ret.extend(vdrives)
+                return sorted(ret, key=Record.sort_key)
+
+        sources = [phys_drives]
+        sources.extend(data[controller] for controller in sorted(data))
+        return self._memoized('vds', sources, _parse_drives)
+
+    def _health_drives(self, controller, raw_health_info):
+        """The drive entries which come along with the health info"""
+        return [self._parse_physical_drive(controller, drive_dat)
+                for val in raw_health_info[controller].itervalues()
+                if isinstance(val, list) for drive_dat in val]
+
+    def _parse_vd_show_all(self, controller, dat, virtual_drive_id):
+        """The VD of the /cN/vM (or /cN/vall) show all output
+
+        The health info of all the drives of the controller is queried
+        at once, the dedicated hot spares of the VD are taken from it,
+        so the VD is the same as in the enumeration of all VDs. None if
+        nytrocli didn't report the VD.
+        """
+        vdrive_dat = dat.get('/c{0}/v{1}'.format(controller, virtual_drive_id))
+        if not vdrive_dat:
+            return None
+        vdrive = self._parse_virtual_drive(controller, vdrive_dat[0])
+        with stortiming.timed('parse_pd'):
+            pdrives = [self._parse_physical_drive(controller, drive_dat)
+                       for drive_dat in
+                       dat.get('PDs for VD {0}'.format(virtual_drive_id), [])]
+        # the drives of Nytro WarpDrive have got no enclosure
+        is_warpdrive = any(pd['enclosure'] is None for pd in pdrives)
+        raw_health_info = self._get_raw_health_info(controller, is_warpdrive)
+        with stortiming.timed('parse_pd'):
+            members = drives_ids(pdrives)
+            group = index_drive_groups(
+                self._health_drives(controller, raw_health_info)).get(
+                    (controller, vdrive['drive_group']), [])
+            pdrives.extend(pd for pd in group
+                           if (pd['enclosure'], pd['slot']) not in members)
+        self._add_health_info(controller, pdrives,
+                              raw_health_info=raw_health_info)
+        vdrive['physical_drives'] = sorted(pdrives, key=Record.sort_key)
+        return vdrive
+
+    def _virtual_drive_details(self, controller_id, virtual_drive_id):
+        """Get the VD with /cN/vM show all and the health of its drives"""
+        cmd = '/c{0}/v{1} show all'.format(controller_id, virtual_drive_id)
+        data = self._run(cmd.split())
+        if len(data) != 1:
+            return None
+        controller, dat = data.items()[0]
+        return self._parse_vd_show_all(controller, dat, virtual_drive_id)
 
+    @profiled
     def virtual_drive_details(self, controller_id, virtual_drive_id,
                               raid_type=None):
+        if raid_type is None:
+            # cachecade/nytrocache VDs share the ids with the ordinary ones,
+            # so these are found by enumerating all VDs
+            try:
+                vdrive = self._virtual_drive_details(controller_id,
+                                                     virtual_drive_id)
+            except StorcliBusyError:
+                raise
+            except StorcliError, e:
+                if e.error_code == NYTROCLI_TIMEOUT:
+                    raise
+                LOG.info('/c%s/v%s show all failed: %s, enumerating the VDs',
+                         controller_id, virtual_drive_id, e)
+                vdrive = None
+            if vdrive is not None and vd_raid_type(vdrive) is None:
+                return vdrive
         vdrives = [d for d in self.virtual_drives(controller_id=controller_id)
                    if d['virtual_drive'] == virtual_drive_id and raid_type ==
                    vd_raid_type(d)]
@@ -336,18 +707,74 @@ class Storcli(object):
             raise StorcliError(msg.format(controller_id, virtual_drive_id),
                                error_code=NO_SUCH_VDRIVE)
 
+    def _parse_topology(self, controller, dat):
+        """The VD to drive groups, drive group to PDs and drive maps
+
+        of the /cN show output. The PDs come without the health info.
+        """
+        pdrives = [self._parse_physical_drive(controller, drive_dat)
+                   for drive_dat in dat.get('PD LIST', [])]
+        vd_groups = {}
+        for vdrive_dat in dat.get('VD LIST', []):
+            drive_group, virtual_drive = parse_dg_vd(vdrive_dat['DG/VD'])
+            # cachecade/nytrocache VDs share the ids with the ordinary ones
+            vd_groups.setdefault(virtual_drive, []).append(drive_group)
+        return {'vd_groups': vd_groups,
+                'group_drives': dict((dg, drives) for (_, dg), drives in
+                                     index_drive_groups(pdrives).iteritems()),
+                'drives': dict(((pd['enclosure'], pd['slot']), pd)
+                               for pd in pdrives)}
+
+    def _index_topology(self, data, generation):
+        topologies = {}
+        for controller, dat in data.iteritems():
+            topologies[controller] = self._memoized(
+                'topology', (dat,), self._parse_topology, controller, dat)
+            if self._topology_index is not None:
+                self._topology_index.put(controller, topologies[controller],
+                                         generation)
+        return topologies
+
+    def _topology(self, controller_id):
+        """The topology of the controller, see _parse_topology"""
+        index = self._topology_index
+        generation = None
+        if index is not None:
+            topology = index.get(controller_id)
+            if topology is not None:
+                return topology
+            generation = index.generation
+        cmd = '/c{0} show'.format(controller_id)
+        topologies = self._index_topology(self._run(cmd.split()), generation)
+        try:
+            return topologies[int(controller_id)]
+        except KeyError:
+            msg = 'No such controller /c{0}'.format(controller_id)
+            raise StorcliError(msg, error_code=SOMETHING_BAD_HAPPEND)
+
+    @profiled
     def virtual_drives(self, controller_id=None, raid_type=None):
         if controller_id is None:
             controller_id = 'all'
         cmd = '/c{0} show'.format(controller_id)
-        vds = self._parse_virtual_drives(self._run(cmd.split()))
+        index = self._topology_index
+        generation = index.generation if index is not None else None
+        data = self._run(cmd.split())
+        vds = self._parse_virtual_drives(data)
+        if index is not None:
+            # keeps the topology warm for the hot spare assignment
+            self._index_topology(data, generation)
         raid_type = self._validate_raid_type(raid_type)
         if raid_type:
             vds = [vd for vd in vds if vd_raid_type(vd) == raid_type]
-        return sorted(vds)
+        # already sorted by _parse_virtual_drives
+        return vds
 
     def _is_warpdrive(self, controller_id, controller_data=None):
         if controller_data is None:
+            warpdrive = self._profile(controller_id, 'warpdrive')
+            if warpdrive is not None:
+                return warpdrive
             cmd = '/c{0} show all'.format(controller_id)
             data = self._run(cmd.split())
             controller_data = data[controller_id]
@@ -355,8 +782,15 @@ class Storcli(object):
             model = controller_data['Basics']['Model']
         elif 'Product Name' in controller_data:
             model = controller_data['Product Name']
-        return model.startswith('Nytro WarpDrive')
-
+        warpdrive = model.startswith('Nytro WarpDrive')
+        if self._profiles is not None and 'Basics' in controller_data:
+            # only /cN show all has got the PCI address
+            self._profiles.update(controller_id,
+                                  controller_data['Basics'].get('PCI Address'),
+                                  model=model, warpdrive=warpdrive)
+        return warpdrive
+
+    @profiled
     def delete_virtual_drive(self, controller_id, virtual_drive_id,
                              force=False, raid_type=None):
         cmd = '/c{controller_id}/v{virtual_drive_id} del {raid_type} {force}'
@@ -376,14 +810,10 @@ class Storcli(object):
         return self._run(cmd.split())
 
     def _find_virtual_drive_by_phisical(self, physical_drives):
-        def physical_drives_ids(drives):
-            return set([(pd['enclosure'], pd['slot']) for pd in drives])
-
         controller_id = physical_drives[0]['controller_id']
-        pdrives_ids = physical_drives_ids(physical_drives)
+        pdrives_ids = drives_ids(physical_drives)
         found_vd = [vd for vd in self.virtual_drives(controller_id)
-                    if physical_drives_ids(vd['physical_drives']) ==
-                    pdrives_ids]
+                    if drives_ids(vd['physical_drives']) == pdrives_ids]
         if len(found_vd) == 1:
             return found_vd[0]
         elif len(found_vd) == 0:
@@ -394,6 +824,38 @@ class Storcli(object):
             error_code = MULTIPLE_VDS_FOR_SAME_PDS
         raise StorcliError(msg % pdrives_ids, error_code=error_code)
 
+    def _find_created_virtual_drive(self, controller_id, out,
+                                    physical_drives):
+        """The VD just created of the given drives, None if not found
+
+        Takes the VD id from the 'add vd' output if nytrocli reports it,
+        otherwise looks for the VD of these drives in /cN/vall show all.
+        The spares come along as the dedicated hot spares of the VD.
+        Returns the lookup method too.
+        """
+        virtual_drive_id = created_vd_id(out.get(controller_id))
+        if virtual_drive_id is not None:
+            method = 'response'
+            cmd = '/c{0}/v{1} show all'.format(controller_id,
+                                               virtual_drive_id)
+        else:
+            method = 'targeted'
+            cmd = '/c{0}/vall show all'.format(controller_id)
+        data = self._run(cmd.split())
+        if len(data) != 1:
+            return None, method
+        controller, dat = data.items()[0]
+        if virtual_drive_id is None:
+            pdrives_ids = drives_ids(physical_drives)
+            found = [vd_id for vd_id, drives in vds_members(dat).iteritems()
+                     if drives_ids(self._parse_physical_drive(controller, d)
+                                   for d in drives) == pdrives_ids]
+            if len(found) != 1:
+                return None, method
+            virtual_drive_id = found[0]
+        vdrive = self._parse_vd_show_all(controller, dat, virtual_drive_id)
+        return vdrive, method
+
     def _validate_raid_type(self, raid_type):
         funky_raid_types = ['cachecade', 'nytrocache']
         return raid_type if raid_type in funky_raid_types else ''
@@ -408,6 +870,7 @@ class Storcli(object):
             raise StorcliError(error_code=SOMETHING_BAD_HAPPEND,
                                msg='Invalid physical drives specified')
 
+    @profiled
     def create_virtual_drive(self, physical_drives,
                              spare_drives=None,
                              raid_level=0,
@@ -455,10 +918,40 @@ class Storcli(object):
         if ssd_caching:
             cmd.append('cachevd')
 
-        self._run(cmd)
-        return self._find_virtual_drive_by_phisical(physical_drives +
-                                                    (spare_drives or []))
-
+        controller_id = physical_drives[0]['controller_id']
+        start = time.time()
+        try:
+            out = self._run(cmd)
+        finally:
+            self._create_vd_seconds.labels(stage='create').observe(
+                time.time() - start)
+
+        start = time.time()
+        vdrive, method = None, 'scan'
+        # cachecade/nytrocache VDs share the ids with the ordinary ones
+        if not raid_type:
+            try:
+                vdrive, method = self._find_created_virtual_drive(
+                    controller_id, out, physical_drives)
+            except StorcliBusyError:
+                raise
+            except StorcliError, e:
+                LOG.info('failed to look up the new VD of %s: %s',
+                         drives_ids(physical_drives), e)
+        if vdrive is None:
+            method = 'scan'
+        try:
+            if vdrive is None:
+                vdrive = self._find_virtual_drive_by_phisical(
+                    physical_drives + (spare_drives or []))
+            return vdrive
+        finally:
+            elapsed = time.time() - start
+            self._create_vd_seconds.labels(stage='lookup_' + method)\
+                .observe(elapsed)
+            stortiming.record('lookup_vd', elapsed)
+
+    @profiled
     def update_virtual_drive(self, controller_id, virtual_drive_id,
                              name=None,
                              write_cache=None,
@@ -479,6 +972,7 @@ class Storcli(object):
 
         return self._run(cmd)
 
+    @profiled
     def add_hotspare_drive(self, virtual_drives,
                            pdrive=None,
                            controller_id=None,
@@ -500,12 +994,13 @@ class Storcli(object):
         cmd = '/c{controller_id}/e{enclosure}/s{slot} add hotsparedrive'
         cmd = cmd.format(**pdrive).split()
         if virtual_drives:
-            drive_groups = [vd['drive_group'] for vd in
-                            self.virtual_drives(controller_id)
-                            if vd['virtual_drive'] in virtual_drives]
+            vd_groups = self._topology(controller_id)['vd_groups']
+            drive_groups = [dg for vd in virtual_drives
+                            for dg in vd_groups.get(vd, ())]
             cmd.append('dgs=%s' % strlst(drive_groups))
         return self._run(cmd)
 
+    @profiled
     def delete_hotspare_drive(self, drive=None,
                               controller_id=None,
                               enclosure=None,
@@ -518,6 +1013,7 @@ class Storcli(object):
         cmd = cmd.format(**drive)
         return self._run(cmd.split())
 
+    @profiled
     def create_warp_drive_vd(self, controller_id, overprovision=None):
         cmd = '/c{0}/eall/sall start format'.format(controller_id).split()
         possible_levels = ('nom', 'cap', 'perf')
@@ -531,9 +1027,23 @@ class Storcli(object):
 
     #physical_drives=property(_physical_drives)
     @property
+    @profiled
     def all_physical_drives(self):
         return self.physical_drives()
 
     @property
+    @profiled
     def all_virtual_drives(self):
         return self.virtual_drives()
+
+    @property
+    def coalescing_stats(self):
+        return self._inflight.stats()
+
+    @property
+    def scheduler_stats(self):
+        return self._scheduler.stats()
+
+    @property
+    def pool_stats(self):
+        return self._pool.stats()
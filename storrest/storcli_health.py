@@ -16,10 +16,25 @@
 import re
 
 
+def prune_drive_details(pairs):
+    """json object_pairs_hook keeping only what HealthInfoParser needs
+
+    Of the 'Drive /cN/eM/sK - Detailed Information' objects only the
+    'Drive /cN/eM/sK State' subobject is kept, the device attributes,
+    policies, port information and inquiry data are dropped as soon as
+    the drive has been parsed, so the decoded tree never holds them all.
+    """
+    state = [(key, val) for key, val in pairs
+             if key.startswith('Drive ') and key.endswith(' State')]
+    return dict(state if state else pairs)
+
+
 class HealthInfoParser(object):
     def __init__(self):
         self._detailed_info_rx = re.compile('^Drive\s+/c(?P<controller_id>\d+)(/e(?P<enclosure>\d+))?/s(?P<slot>\d+)\s+[-]\s+Detailed\s+Information\s*$')
         self._state_rx = re.compile('^Drive\s+/c(?P<controller_id>\d+)(/e(?P<enclosure>\d+))/s(?P<slot>\d+)\s+State\s*$')
+        # (controller_id, enclosure, slot) -> (drive state, health info)
+        self._cache = {}
 
     def _drive_state_key(self, drive_addr_dict):
         # Something like 'Drive /c0/s32/s2 State'
@@ -75,11 +90,41 @@ class HealthInfoParser(object):
                                                       drive_state_info)
         return ret
 
+    def _drive_keys(self, drive_addr_tuple):
+        """The detailed information and state keys of the drive"""
+        controller_id, enclosure, slot = drive_addr_tuple
+        if enclosure is None:
+            addr = 'Drive /c%s/s%s' % (controller_id, slot)
+        else:
+            addr = 'Drive /c%s/e%s/s%s' % drive_addr_tuple
+        return addr + ' - Detailed Information', addr + ' State'
+
     def add_health_info(self, controller_id, raw_health_info, pdrives):
-        health_info = self.drives_health(controller_id,
-                                         raw_health_info[controller_id])
+        """Look the drives up by the keys built from their addresses
+
+        Falls back to matching all the keys with regexps (drives_health)
+        if nytrocli named some drive differently. The health of a drive
+        is parsed again only if its state object has changed (not taken
+        from the result cache).
+        """
+        dat = raw_health_info[controller_id]
+        cache = self._cache
+        fallback = None
         for pd in pdrives:
             if controller_id != pd['controller_id']:
                 continue
-            pd_addr_tuple = self._drive_addr_tuple(pd)
-            pd['health'] = health_info.get(pd_addr_tuple)
+            drive_addr_tuple = self._drive_addr_tuple(pd)
+            detailed_info_key, drive_state_key = \
+                self._drive_keys(drive_addr_tuple)
+            detailed_info = dat.get(detailed_info_key)
+            if detailed_info is None:
+                if fallback is None:
+                    fallback = self.drives_health(controller_id, dat)
+                pd['health'] = fallback.get(drive_addr_tuple)
+                continue
+            drive_state = detailed_info.get(drive_state_key)
+            cached = cache.get(drive_addr_tuple)
+            if cached is None or cached[0] is not drive_state:
+                cached = (drive_state, self._health_info(pd, drive_state))
+                cache[drive_addr_tuple] = cached
+            pd['health'] = cached[1]
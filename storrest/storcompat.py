@@ -42,3 +42,91 @@ def patch_subprocess(subprocess):
             return output
 
         subprocess.check_output = check_output
+
+
+def compare_digest(a, b):
+    """hmac.compare_digest for python older than 2.7.7
+
+    Takes the same time whatever the position of the first difference.
+    """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+
+class OrderedDict(dict):
+    """collections.OrderedDict for python 2.6
+
+    Only what storrest uses: the keys are kept in insertion order in
+    a doubly linked list of [prev, next, key].
+    """
+    _missing = object()
+
+    def __init__(self):
+        dict.__init__(self)
+        self._root = root = []
+        root[:] = [root, root, None]
+        self._links = {}
+
+    def __setitem__(self, key, value):
+        if key not in self:
+            root = self._root
+            last = root[0]
+            last[1] = root[0] = self._links[key] = [last, root, key]
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        dict.__delitem__(self, key)
+        prev, next, _ = self._links.pop(key)
+        prev[1] = next
+        next[0] = prev
+
+    def __iter__(self):
+        root = self._root
+        link = root[1]
+        while link is not root:
+            yield link[2]
+            link = link[1]
+
+    iterkeys = __iter__
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def pop(self, key, default=_missing):
+        if key in self:
+            value = dict.__getitem__(self, key)
+            del self[key]
+            return value
+        if default is self._missing:
+            raise KeyError(key)
+        return default
+
+    def popitem(self, last=True):
+        if not self:
+            raise KeyError('dictionary is empty')
+        key = self._root[0][2] if last else self._root[1][2]
+        return key, self.pop(key)
+
+    def clear(self):
+        dict.clear(self)
+        self._links.clear()
+        root = self._root
+        root[:] = [root, root, None]
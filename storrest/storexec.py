@@ -0,0 +1,126 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import logging
+import os
+import signal
+import subprocess
+import threading
+
+if 'check_output' not in dir(subprocess):
+    from storcompat import patch_subprocess
+    patch_subprocess(subprocess)
+
+LOG = logging.getLogger('storrest.storexec')
+
+
+class PoolBusy(Exception):
+    pass
+
+
+class CommandTimeout(Exception):
+    pass
+
+
+def check_output_timeout(cmd, timeout):
+    """subprocess.check_output which kills the command after timeout"""
+    # own process group, so the children holding stdout get killed too
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, preexec_fn=os.setsid)
+    expired = threading.Event()
+
+    def kill():
+        expired.set()
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        output, _ = proc.communicate()
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        LOG.warning('"%s" killed after %s seconds', ' '.join(cmd), timeout)
+        raise CommandTimeout(cmd, timeout)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd,
+                                            output=output)
+    return output
+
+
+class ProcessPool(object):
+    """Limit the number of the nytrocli processes running at once
+
+    Up to max_processes commands run concurrently, up to max_queue more
+    wait for a free slot (None means no limit), the rest are rejected
+    with PoolBusy. timeout (seconds, None means forever) limits the run
+    time of a command.
+    """
+    def __init__(self, max_processes=4, max_queue=None, timeout=None,
+                 retry_after=1):
+        self.max_processes = max_processes
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._cond = threading.Condition()
+        self.running = 0
+        self.waiting = 0
+        self.spawned = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+    @contextlib.contextmanager
+    def slot(self):
+        with self._cond:
+            if self.running >= self.max_processes:
+                if self.max_queue is not None and \
+                        self.waiting >= self.max_queue:
+                    self.rejected += 1
+                    raise PoolBusy()
+                self.waiting += 1
+                try:
+                    while self.running >= self.max_processes:
+                        self._cond.wait()
+                finally:
+                    self.waiting -= 1
+            self.running += 1
+            self.spawned += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.running -= 1
+                self._cond.notify()
+
+    def check_output(self, cmd):
+        with self.slot():
+            if self.timeout is None:
+                return subprocess.check_output(cmd)
+            try:
+                return check_output_timeout(cmd, self.timeout)
+            except CommandTimeout:
+                with self._cond:
+                    self.timeouts += 1
+                raise
+
+    def stats(self):
+        return {'running': self.running,
+                'waiting': self.waiting,
+                'spawned': self.spawned,
+                'rejected': self.rejected,
+                'timeouts': self.timeouts}
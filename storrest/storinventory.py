@@ -0,0 +1,241 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import cPickle
+import fcntl
+import logging
+import os
+import threading
+import time
+
+from storcache import SingleFlight
+from storcli import StorcliError
+from storutils import vd_raid_type
+
+LOG = logging.getLogger('storrest.storinventory')
+DRIVES_KEYS = ('physical_drives', 'virtual_drives')
+
+
+class InventorySnapshot(object):
+    """The controllers, physical and virtual drives at the given moment
+
+    Built from the controller_details('all') output. The snapshot is never
+    modified after the construction, the poller replaces it as a whole.
+    The lookup methods return None if the controller is not known, so
+    the caller can ask nytrocli directly.
+    """
+    def __init__(self, details, timestamp):
+        self.timestamp = timestamp
+        self._details = sorted(details)
+        self._by_id = dict((str(c['controller_id']), c)
+                           for c in self._details)
+        self.controllers = sorted([
+            dict((k, v) for k, v in c.iteritems() if k not in DRIVES_KEYS)
+            for c in self._details])
+
+    def age(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(now - self.timestamp, 0)
+
+    def _drives(self, key, controller_id):
+        if controller_id is None or controller_id == 'all':
+            return sorted([d for c in self._details for d in c[key]])
+        controller = self._by_id.get(str(controller_id))
+        return controller[key] if controller is not None else None
+
+    def controller_details(self, controller_id):
+        if controller_id is None or controller_id == 'all':
+            return self._details
+        return self._by_id.get(str(controller_id))
+
+    def physical_drives(self, controller_id=None):
+        return self._drives('physical_drives', controller_id)
+
+    def virtual_drives(self, controller_id=None, raid_type=None):
+        vds = self._drives('virtual_drives', controller_id)
+        if vds is not None and raid_type:
+            vds = [vd for vd in vds if vd_raid_type(vd) == raid_type]
+        return vds
+
+
+class SharedSnapshot(object):
+    """The snapshot file shared by the pre-forked worker processes
+
+    The worker refreshing the snapshot holds the lock file and replaces
+    the snapshot file atomically, the others load it when it changes.
+    Removing the file invalidates the snapshot of every worker.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock_path = path + '.lock'
+        self._invalidated_path = path + '.invalidated'
+        self._key = None
+        self._snapshot = None
+        self._load_lock = threading.Lock()
+
+    def load(self):
+        """The snapshot in the file, None if there's none"""
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        key = (st.st_ino, st.st_mtime, st.st_size)
+        with self._load_lock:
+            if key != self._key:
+                try:
+                    with open(self.path, 'rb') as f:
+                        snapshot = cPickle.load(f)
+                except (IOError, EOFError, cPickle.UnpicklingError), e:
+                    LOG.warning('failed to load %s: %s', self.path, e)
+                    return None
+                self._key, self._snapshot = key, snapshot
+            return self._snapshot
+
+    def save(self, snapshot):
+        """Publish the snapshot unless invalidated since it's been taken"""
+        try:
+            invalidated = os.stat(self._invalidated_path).st_mtime
+        except OSError:
+            invalidated = None
+        if invalidated is not None and invalidated >= snapshot.timestamp:
+            return False
+        tmp_path = '%s.%d' % (self.path, os.getpid())
+        with open(tmp_path, 'wb') as f:
+            cPickle.dump(snapshot, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_path, self.path)
+        return True
+
+    def invalidate(self):
+        # wait for the refresh in progress, it might have read nytrocli
+        # before the modification but not checked the marker yet
+        with self.lock():
+            with open(self._invalidated_path, 'a'):
+                os.utime(self._invalidated_path, None)
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    @contextlib.contextmanager
+    def lock(self):
+        with open(self._lock_path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class InventoryPoller(object):
+    """Refresh the inventory snapshot in the background
+
+    storcli_factory is a callable returning a Storcli instance. The
+    pollers of the pre-forked worker processes share the snapshot via
+    snapshot_file, so nytrocli is run once for all of them.
+    """
+    def __init__(self, storcli_factory, interval=30, snapshot_file=None):
+        self._storcli_factory = storcli_factory
+        self.interval = interval
+        self._snapshot = None
+        self._shared = None
+        if snapshot_file is not None:
+            self._shared = SharedSnapshot(snapshot_file)
+        self._generation = 0
+        self._refresh_flight = SingleFlight()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def _refresh(self, generation, max_age):
+        if self._shared is None:
+            return self._take(generation)
+        started = time.time()
+        with self._shared.lock():
+            # another worker might have refreshed it meanwhile
+            snapshot = self._shared.load()
+            if snapshot is not None and \
+                    snapshot.timestamp >= started - max_age:
+                return snapshot
+            snapshot = self._take(generation)
+            self._shared.save(snapshot)
+            return snapshot
+
+    def _take(self, generation):
+        timestamp = time.time()
+        details = self._storcli_factory().controller_details('all')
+        snapshot = InventorySnapshot(details, timestamp)
+        # don't publish the data collected before the invalidation
+        if generation == self._generation:
+            self._snapshot = snapshot
+        return snapshot
+
+    def refresh(self, max_age=0):
+        """Rebuild the snapshot synchronously
+
+        The shared snapshot some worker has taken within max_age seconds
+        is good enough.
+        """
+        generation = self._generation
+        return self._refresh_flight.do((generation, max_age), self._refresh,
+                                       generation, max_age)
+
+    def snapshot(self, fresh=False):
+        if self._shared is not None:
+            snapshot = self._shared.load()
+        else:
+            snapshot = self._snapshot
+        if fresh or snapshot is None:
+            snapshot = self.refresh()
+        return snapshot
+
+    def invalidate(self):
+        """Drop the snapshot after the configuration has been changed"""
+        self._generation += 1
+        self._snapshot = None
+        if self._shared is not None:
+            self._shared.invalidate()
+        self._wakeup.set()
+
+    def _poll(self):
+        while not self._stopped.is_set():
+            try:
+                self.refresh(max_age=self.interval)
+            except StorcliError, e:
+                LOG.warning('failed to refresh the inventory: %s', e)
+            except Exception:
+                LOG.exception('failed to refresh the inventory')
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self._poll,
+                                        name='storrest-inventory')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Wait up to timeout seconds for the refresh in progress"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                LOG.warning('the inventory refresh is still running')
+            self._thread = None
@@ -0,0 +1,170 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import logging
+import Queue
+import threading
+import time
+import uuid
+
+import storcompat
+from storcli import StorcliBusyError, StorcliError, SOMETHING_BAD_HAPPEND
+
+LOG = logging.getLogger('storrest.storjobs')
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_FINISHED = 'finished'
+JOB_FAILED = 'failed'
+OrderedDict = getattr(collections, 'OrderedDict', storcompat.OrderedDict)
+
+
+class Job(object):
+    def __init__(self, fcn, args=(), kwargs=None, description=None):
+        self.job_id = uuid.uuid4().hex
+        self.description = description
+        self.status = JOB_QUEUED
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self.result = None
+        self.error_code = None
+        self.error_message = None
+        self._fcn = fcn
+        self._args = args
+        self._kwargs = kwargs or {}
+        self._done = threading.Event()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self.done
+
+    def run(self):
+        self.status = JOB_RUNNING
+        self.started = time.time()
+        try:
+            self.result = self._fcn(*self._args, **self._kwargs)
+            self.status = JOB_FINISHED
+        except StorcliError, e:
+            self.error_code = e.error_code
+            self.error_message = e.message
+            self.status = JOB_FAILED
+        except Exception, e:
+            LOG.exception('job %s (%s) failed', self.job_id, self.description)
+            self.error_code = SOMETHING_BAD_HAPPEND
+            self.error_message = str(e)
+            self.status = JOB_FAILED
+        finally:
+            self.finished = time.time()
+            self._fcn = self._args = self._kwargs = None
+            self._done.set()
+
+    def to_dict(self):
+        return {'job_id': self.job_id,
+                'description': self.description,
+                'status': self.status,
+                'created': self.created,
+                'started': self.started,
+                'finished': self.finished,
+                'result': self.result,
+                'error_code': self.error_code,
+                'error_message': self.error_message}
+
+
+class JobManager(object):
+    """Run the slow operations in a bounded pool of worker threads
+
+    Up to max_jobs finished jobs are kept for the status queries,
+    the older ones are forgotten. A job submitted while max_queued ones
+    are waiting for a worker is refused with StorcliBusyError.
+    """
+    def __init__(self, workers=2, max_jobs=100, max_queued=20,
+                 retry_after=1):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.max_queued = max_queued
+        self.retry_after = retry_after
+        self._queue = Queue.Queue()
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            job.run()
+
+    def _start_workers(self):
+        while len(self._threads) < self.workers:
+            thread = threading.Thread(target=self._work,
+                                      name='storrest-job-%d' %
+                                      len(self._threads))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def _forget_finished(self):
+        finished = [job_id for job_id, job in self._jobs.iteritems()
+                    if job.done]
+        for job_id in finished[:max(len(finished) - self.max_jobs, 0)]:
+            del self._jobs[job_id]
+
+    def submit(self, fcn, *args, **kwargs):
+        description = kwargs.pop('description', None)
+        job = Job(fcn, args, kwargs, description=description)
+        with self._lock:
+            if self._queue.qsize() >= self.max_queued:
+                raise StorcliBusyError('Too many jobs queued',
+                                       retry_after=self.retry_after)
+            self._forget_finished()
+            self._jobs[job.job_id] = job
+            self._start_workers()
+            self._queue.put(job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def jobs(self):
+        with self._lock:
+            return self._jobs.values()
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def shutdown(self, wait=True, timeout=None):
+        """Stop the workers once the queued jobs have been run
+
+        Waits for them up to timeout seconds (forever if None).
+        """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            deadline = time.time() + timeout if timeout is not None else None
+            for thread in threads:
+                if deadline is None:
+                    thread.join()
+                else:
+                    thread.join(max(deadline - time.time(), 0))
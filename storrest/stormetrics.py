@@ -0,0 +1,179 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+import threading
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304,
+                16777216)
+
+
+def _escape(value):
+    return str(value).replace('\\', r'\\').replace('"', r'\"').\
+        replace('\n', r'\n')
+
+
+def _fmt_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (key, _escape(val))
+                             for key, val in labels)
+
+
+def _fmt_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+
+class Histogram(object):
+    def __init__(self, buckets):
+        self._lock = threading.Lock()
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        idx = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            self.counts[idx] += 1
+            self.sum += value
+            self.count += 1
+
+    def samples(self, name, labels):
+        with self._lock:
+            counts, total, count = list(self.counts), self.sum, self.count
+        ret = []
+        cumulative = 0
+        for bound, bucket_count in zip(self.buckets + (float('inf'),),
+                                       counts):
+            cumulative += bucket_count
+            ret.append((name + '_bucket',
+                        labels + (('le', _fmt_value(float(bound))),),
+                        cumulative))
+        ret.append((name + '_sum', labels, total))
+        ret.append((name + '_count', labels, count))
+        return ret
+
+
+class MetricFamily(object):
+    """A metric with its children, one per combination of label values"""
+    def __init__(self, name, help, metric_type, buckets=None):
+        self.name = name
+        self.help = help
+        self.type = metric_type
+        self.buckets = buckets
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, **labels):
+        key = tuple(sorted(labels.items()))
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    if self.type == 'histogram':
+                        child = Histogram(self.buckets)
+                    else:
+                        child = Counter()
+                    self._children[key] = child
+        return child
+
+    def samples(self):
+        with self._lock:
+            children = sorted(self._children.items())
+        ret = []
+        for labels, child in children:
+            ret.extend(child.samples(self.name, labels))
+        return ret
+
+
+class Registry(object):
+    """Counters and histograms rendered in the Prometheus text format
+
+    Besides the metrics updated as things happen, collectors (callables
+    returning the (name, help, type, [(labels_dict, value), ...]) tuples)
+    are run on every render to export the statistics kept elsewhere.
+    """
+    def __init__(self):
+        self._families = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+
+    def _family(self, name, help, metric_type, buckets=None):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = MetricFamily(name, help, metric_type, buckets)
+                self._families[name] = family
+            elif family.type != metric_type:
+                raise ValueError('%s is a %s' % (name, family.type))
+        return family
+
+    def counter(self, name, help):
+        return self._family(name, help, 'counter')
+
+    def histogram(self, name, help, buckets=LATENCY_BUCKETS):
+        return self._family(name, help, 'histogram', buckets)
+
+    def add_collector(self, collector):
+        with self._lock:
+            self._collectors.append(collector)
+
+    def get(self, name, **labels):
+        """The counter value or the (count, sum) of the histogram"""
+        child = self._families[name].labels(**labels)
+        if isinstance(child, Histogram):
+            return child.count, child.sum
+        return child.value
+
+    def render(self):
+        with self._lock:
+            families = sorted(self._families.items())
+            collectors = list(self._collectors)
+        lines = []
+
+        def add_family(name, help, metric_type, samples):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, metric_type))
+            for sample_name, labels, value in samples:
+                lines.append('%s%s %s' % (sample_name, _fmt_labels(labels),
+                                          _fmt_value(value)))
+
+        for name, family in families:
+            add_family(name, family.help, family.type, family.samples())
+        for collector in collectors:
+            for name, help, metric_type, samples in collector():
+                add_family(name, help, metric_type,
+                           [(name, tuple(sorted(labels.items())), value)
+                            for labels, value in samples])
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,122 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import cProfile
+import functools
+import marshal
+import pstats
+import StringIO
+import threading
+
+_local = threading.local()
+
+
+class Profiler(object):
+    """Profile the next N calls with cProfile and aggregate the results
+
+    Only the thread making the call is profiled (not the parallel_map
+    workers), nested calls are accounted to the outermost one.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._remaining = 0
+        self._stats = None
+        self.profiled_calls = 0
+
+    def arm(self, count):
+        """Profile the next count calls (0 stops profiling)"""
+        with self._lock:
+            self._remaining = max(int(count), 0)
+
+    def reset(self):
+        with self._lock:
+            self._remaining = 0
+            self._stats = None
+            self.profiled_calls = 0
+
+    def _claim(self, force):
+        with self._lock:
+            if self._remaining > 0:
+                self._remaining -= 1
+                return True
+            return force
+
+    @contextlib.contextmanager
+    def profiled(self, force=False):
+        """Profile the block if armed (or force is set)"""
+        if getattr(_local, 'active', False) or not self._claim(force):
+            yield
+            return
+        prof = cProfile.Profile()
+        _local.active = True
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            _local.active = False
+            with self._lock:
+                if self._stats is None:
+                    self._stats = pstats.Stats(prof)
+                else:
+                    self._stats.add(prof)
+                self.profiled_calls += 1
+
+    def wrap(self, fcn):
+        @functools.wraps(fcn)
+        def wrapper(*args, **kwargs):
+            with self.profiled():
+                return fcn(*args, **kwargs)
+        return wrapper
+
+    def status(self):
+        with self._lock:
+            return {'remaining': self._remaining,
+                    'profiled_calls': self.profiled_calls}
+
+    def dump(self):
+        """The aggregated stats in the pstats file format (None if empty)
+
+        Load them with pstats.Stats(filename) or any pstats viewer.
+        """
+        with self._lock:
+            if self._stats is None:
+                return None
+            return marshal.dumps(self._stats.stats)
+
+    def report(self, sort='cumulative', limit=50):
+        """The aggregated stats as a text table (None if empty)"""
+        buf = StringIO.StringIO()
+        with self._lock:
+            if self._stats is None:
+                return None
+            self._stats.stream = buf
+            self._stats.sort_stats(sort).print_stats(limit)
+        return buf.getvalue()
+
+
+PROFILER = Profiler()
+
+
+def profiled(fcn):
+    """Profile the Storcli method with the profiler it has been given"""
+    @functools.wraps(fcn)
+    def wrapper(self, *args, **kwargs):
+        if self._profiler is None:
+            return fcn(self, *args, **kwargs)
+        with self._profiler.profiled():
+            return fcn(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,184 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import operator
+
+
+class Record(object):
+    """A fixed set of fields with the read/write dict interface
+
+    Records compare equal to the dicts with the same items and sort the
+    same way the dicts did (the fewer fields first, then by the values
+    in the field name order), so the replies are ordered as before.
+    """
+    __slots__ = ()
+    _fields = ()
+    _sorted_fields = ()
+    _sorted_values = staticmethod(lambda record: ())
+
+    def __init__(self, **kwargs):
+        for key, val in kwargs.iteritems():
+            self[key] = val
+
+    def __getitem__(self, key):
+        if key not in self._fields:
+            raise KeyError(key)
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, val):
+        if key not in self._fields:
+            raise KeyError(key)
+        setattr(self, key, val)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        return key in self._fields and hasattr(self, key)
+
+    def keys(self):
+        return [key for key in self._fields if hasattr(self, key)]
+
+    def values(self):
+        return [self[key] for key in self.keys()]
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    def iteritems(self):
+        return iter(self.items())
+
+    __iter__ = iterkeys
+
+    def __len__(self):
+        return len(self.keys())
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def sort_key(self):
+        try:
+            return len(self._fields), self._sorted_values(self)
+        except AttributeError:
+            values = tuple(getattr(self, key) for key in self._sorted_fields
+                           if hasattr(self, key))
+            return len(values), values
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return type(self) is type(other) and \
+                self.items() == other.items()
+        if isinstance(other, dict):
+            return self.to_dict() == other
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        return eq if eq is NotImplemented else not eq
+
+    def __cmp__(self, other):
+        if isinstance(other, Record):
+            return cmp(self.sort_key(), other.sort_key())
+        return cmp(self.to_dict(), other)
+
+    __hash__ = None
+
+    def __getstate__(self):
+        return self.items()
+
+    def __setstate__(self, state):
+        for key, val in state:
+            self[key] = val
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join('%s=%r' % item for item in self.items()))
+
+
+class PhysicalDrive(Record):
+    _fields = ('controller_id', 'enclosure', 'slot', 'drive_group', 'size',
+               'sector_size', 'allocated', 'state', 'medium', 'interface',
+               'model', 'health')
+    _sorted_fields = tuple(sorted(_fields))
+    _sorted_values = operator.attrgetter(*_sorted_fields)
+    __slots__ = _fields
+
+    def to_dict(self):
+        # built the way the drive dicts used to be, json.dumps emits
+        # the keys in the same order
+        try:
+            ret = {'controller_id': self.controller_id,
+                   'enclosure': self.enclosure,
+                   'slot': self.slot,
+                   'drive_group': self.drive_group,
+                   'size': self.size,
+                   'sector_size': self.sector_size,
+                   'allocated': self.allocated,
+                   'state': self.state,
+                   'medium': self.medium,
+                   'interface': self.interface,
+                   'model': self.model}
+        except AttributeError:
+            return Record.to_dict(self)
+        if hasattr(self, 'health'):
+            ret['health'] = self.health
+        return ret
+
+
+class VirtualDrive(Record):
+    _fields = ('controller_id', 'virtual_drive', 'drive_group', 'state',
+               'size', 'raid_level', 'access', 'name', 'consistent',
+               'read_ahead', 'write_cache', 'io_policy', 'ssd_caching_active',
+               'physical_drives')
+    _sorted_fields = tuple(sorted(_fields))
+    _sorted_values = operator.attrgetter(*_sorted_fields)
+    __slots__ = _fields
+
+    def to_dict(self):
+        try:
+            ret = {'controller_id': self.controller_id,
+                   'virtual_drive': self.virtual_drive,
+                   'drive_group': self.drive_group,
+                   'state': self.state,
+                   'size': self.size,
+                   'raid_level': self.raid_level,
+                   'access': self.access,
+                   'name': self.name,
+                   'consistent': self.consistent,
+                   'read_ahead': self.read_ahead,
+                   'write_cache': self.write_cache,
+                   'io_policy': self.io_policy,
+                   'ssd_caching_active': self.ssd_caching_active}
+        except AttributeError:
+            return Record.to_dict(self)
+        if hasattr(self, 'physical_drives'):
+            ret['physical_drives'] = self.physical_drives
+        return ret
+
+
+def to_json(obj):
+    """json.dumps default serializing the records"""
+    if isinstance(obj, Record):
+        return obj.to_dict()
+    raise TypeError('%r is not JSON serializable' % obj)
@@ -13,10 +13,24 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import hmac
 import json
+import logging
+import re
+import threading
+import time
 import web
 
-from storcli import Storcli, StorcliError
+import storbreaker
+import storcli
+import storcompat
+import storprofile
+import storrecords
+import stortiming
+from storcli import Storcli, StorcliBusyError, StorcliError
+from storcache import ControllerProfiles, ResponseMemo, TopologyIndex
+from storexec import ProcessPool
+from storjobs import JobManager
 
 try:
     from storversion import storrest_git_version
@@ -33,45 +47,382 @@ urls = (
     '/v0.5/controllers/(\d+)/physicaldevices/(\d+)/(\d+)/hotspare', 'HotspareOps',
     '/v0.5/controllers/(\d+)/virtualdevices/((?:cachecade)|(?:nytrocache))', 'CachecadeView',
     '/v0.5/controllers/(\d+)/virtualdevices/((?:cachecade)|(?:nytrocache))/(\d+)', 'CachecadeDetails',
-    '/v0.5/controllers/(\d+)/virtualdevices/warpdrive', 'WarpdriveView'
+    '/v0.5/controllers/(\d+)/virtualdevices/warpdrive', 'WarpdriveView',
+    '/v0.5/jobs', 'JobsView',
+    '/v0.5/jobs/([0-9a-f]+)', 'JobDetails',
+    '/metrics', 'MetricsView',
+    '/admin/profile', 'AdminProfile',
+    '/admin/profile/stats', 'AdminProfileStats',
 )
 
 CFG = {
-    'storcli_command': ['/opt/MegaRAID/nytrocli/nytrocli64']
+    'storcli_command': ['/opt/MegaRAID/nytrocli/nytrocli64'],
+    # storcache.ResultCache shared by all requests, None disables caching
+    'cache': None,
+    # the number of controllers queried concurrently
+    'max_workers': 4,
+    # get the data of all controllers with /call commands when possible
+    'batch_commands': True,
+    # storinventory.InventoryPoller, None makes GETs run nytrocli
+    'inventory': None,
+    # storsched.ControllerScheduler, None means the storcli default one
+    'scheduler': None,
+    # runs the modifications requested with ?async=1, None refuses them
+    'jobs': JobManager(workers=2),
+    # limits the number of nytrocli processes, their queue and run time
+    'pool': ProcessPool(max_processes=4, max_queue=32, timeout=300),
+    # report where the request time went in the Server-Timing header
+    'server_timing': True,
+    # storcache.ResponseMemo reusing the parsed unchanged nytrocli output
+    'memo': ResponseMemo(),
+    # storcache.TopologyIndex resolving the VDs of hot spare assignments
+    'topology': TopologyIndex(ttl=60),
+    # storcache.ControllerProfiles, the models and enclosures
+    'controller_profiles': ControllerProfiles(ttl=600),
+    # storbreaker.CircuitBreaker failing fast the commands which keep
+    # failing, None disables it
+    'breaker': storbreaker.CircuitBreaker(),
+    # storprofile.Profiler armed via /admin/profile
+    'profiler': storprofile.PROFILER,
+    # the X-Storrest-Admin-Token value for /admin/*, None disables them
+    'admin_token': None,
 }
 
+LOG = logging.getLogger('storrest')
 web.config.debug = False
 app = web.application(urls, globals())
+ROUTES = [(re.compile('^%s$' % urls[i]), urls[i + 1])
+          for i in range(0, len(urls), 2)]
+HTTP_REQUEST_SECONDS = storcli.METRICS.histogram(
+    'storrest_http_request_seconds', 'HTTP request latency by handler')
+compare_digest = getattr(hmac, 'compare_digest', storcompat.compare_digest)
+
+
+def route_name(path):
+    for rx, name in ROUTES:
+        if rx.match(path):
+            return name
+    return 'unknown'
+
+
+def record_request_latency(handler):
+    start = time.time()
+    try:
+        return handler()
+    finally:
+        status = web.ctx.get('status', '200 OK').split()[0]
+        HTTP_REQUEST_SECONDS.labels(handler=route_name(web.ctx.path),
+                                    method=web.ctx.method,
+                                    status=status).observe(time.time() -
+                                                           start)
+
+
+def add_server_timing(handler):
+    with stortiming.collect() as timings:
+        start = time.time()
+        ret = handler()
+        timings.add('total', time.time() - start)
+        if CFG['server_timing']:
+            web.header('Server-Timing', timings.server_timing())
+        return ret
+
+
+def is_admin():
+    token = CFG['admin_token']
+    given = web.ctx.env.get('HTTP_X_STORREST_ADMIN_TOKEN')
+    return token is not None and given is not None and \
+        compare_digest(str(given), str(token))
+
+
+def profile_request(handler):
+    """Profile the request if /admin/profile asked for it
+
+    The admin can also profile a single request by sending the
+    X-Storrest-Profile: 1 header along with the admin token.
+    """
+    if web.ctx.path.startswith('/admin/'):
+        return handler()
+    force = web.ctx.env.get('HTTP_X_STORREST_PROFILE') in TRUE_STRINGS and \
+        is_admin()
+    with CFG['profiler'].profiled(force=force):
+        return handler()
+
+app.add_processor(record_request_latency)
+app.add_processor(add_server_timing)
+app.add_processor(profile_request)
+
+
+def collect_stats():
+    """Export the caches, coalescing, scheduler and pool statistics"""
+    ret = []
+    cache = CFG['cache']
+    if cache is not None:
+        ret.extend([
+            ('storrest_cache_hits_total', 'Result cache hits', 'counter',
+             [({}, cache.hits)]),
+            ('storrest_cache_misses_total', 'Result cache misses', 'counter',
+             [({}, cache.misses)]),
+            ('storrest_cache_entries', 'Result cache size', 'gauge',
+             [({}, len(cache))])])
+    memo = CFG['memo']
+    if memo is not None:
+        stats = memo.stats()
+        ret.extend([
+            ('storrest_memo_hits_total',
+             'Parsing steps skipped as their input has not changed',
+             'counter', [({'kind': kind}, count)
+                         for kind, count in sorted(stats['hits'].items())]),
+            ('storrest_memo_misses_total',
+             'Parsing steps run as their input has changed',
+             'counter', [({'kind': kind}, count)
+                         for kind, count in sorted(stats['misses'].items())]),
+            ('storrest_memo_entries', 'Memoized parsing results', 'gauge',
+             [({}, stats['entries'])])])
+    topology = CFG['topology']
+    if topology is not None:
+        ret.extend([
+            ('storrest_topology_hits_total',
+             'Controller topology lookups served from the index', 'counter',
+             [({}, topology.hits)]),
+            ('storrest_topology_misses_total',
+             'Controller topology lookups which ran nytrocli', 'counter',
+             [({}, topology.misses)]),
+            ('storrest_topology_entries', 'Controllers in the topology index',
+             'gauge', [({}, len(topology))])])
+    profiles = CFG['controller_profiles']
+    if profiles is not None:
+        ret.extend([
+            ('storrest_controller_profile_hits_total',
+             'Controller models and enclosures known without nytrocli',
+             'counter', [({}, profiles.hits)]),
+            ('storrest_controller_profile_misses_total',
+             'Controller models and enclosures queried with nytrocli',
+             'counter', [({}, profiles.misses)]),
+            ('storrest_controller_profile_entries',
+             'Controllers with a known profile', 'gauge',
+             [({}, len(profiles))])])
+    breaker = CFG['breaker']
+    if breaker is not None:
+        stats = sorted(breaker.stats().items())
+        ret.extend([
+            ('storrest_breaker_open',
+             'Open circuit breakers of the failing nytrocli commands',
+             'gauge', [({'controller': controller, 'command': command},
+                        counts['open'])
+                       for (controller, command), counts in stats]),
+            ('storrest_breaker_rejected_total',
+             'nytrocli commands failed fast by an open circuit breaker',
+             'counter', [({'controller': controller, 'command': command},
+                          counts['rejected'])
+                         for (controller, command), counts in stats])])
+    inflight = storcli.INFLIGHT.stats()
+    ret.extend([
+        ('storrest_coalesced_calls_total',
+         'nytrocli commands which shared the result of a running one',
+         'counter', [({}, inflight['coalesced'])]),
+        ('storrest_inflight_commands', 'nytrocli commands running now',
+         'gauge', [({}, inflight['in_flight'])])])
+    scheduler = CFG['scheduler'] or storcli.SCHEDULER
+    sched = sorted(scheduler.stats().items())
+    for key, metric_type, help in (
+            ('queue_depth', 'gauge', 'Commands waiting for the controller'),
+            ('readers', 'gauge', 'Read-only commands running'),
+            ('commands', 'counter', 'Commands scheduled'),
+            ('wait_time_total', 'counter',
+             'Seconds spent waiting for the controller')):
+        ret.append(('storrest_scheduler_%s' % key, help, metric_type,
+                    [({'controller': controller}, stats[key])
+                     for controller, stats in sched]))
+    pool = CFG['pool'].stats()
+    for key, metric_type, help in (
+            ('running', 'gauge', 'nytrocli processes running'),
+            ('waiting', 'gauge', 'Commands waiting for a process slot'),
+            ('spawned', 'counter', 'nytrocli processes started'),
+            ('rejected', 'counter', 'Commands rejected, the queue was full'),
+            ('timeouts', 'counter', 'nytrocli processes killed on timeout')):
+        ret.append(('storrest_pool_%s' % key, help, metric_type,
+                    [({}, pool[key])]))
+    if CFG['jobs'] is not None:
+        ret.append(('storrest_jobs_pending', 'Asynchronous jobs queued',
+                    'gauge', [({}, CFG['jobs'].pending)]))
+    return ret
+
+storcli.METRICS.add_collector(collect_stats)
+
+
+class StorcliService(object):
+    """The Storcli instance shared by all the requests
+
+    It's built from CFG on the first use, call reset() after changing
+    CFG. warm_up() learns the controllers before serving the requests,
+    start() starts the inventory poller and stop() lets the modifications
+    in progress complete.
+    """
+    def __init__(self):
+        self._storcli = None
+        self._lock = threading.Lock()
+
+    @property
+    def storcli(self):
+        storcli = self._storcli
+        if storcli is None:
+            with self._lock:
+                if self._storcli is None:
+                    LOG.debug('nytrocli command: %s', CFG['storcli_command'])
+                    self._storcli = Storcli(
+                        storcli_cmd=CFG['storcli_command'],
+                        cache=CFG['cache'],
+                        max_workers=CFG['max_workers'],
+                        batch_commands=CFG['batch_commands'],
+                        scheduler=CFG['scheduler'],
+                        pool=CFG['pool'],
+                        memo=CFG['memo'],
+                        topology=CFG['topology'],
+                        profiles=CFG['controller_profiles'],
+                        breaker=CFG['breaker'])
+                storcli = self._storcli
+        return storcli
+
+    def reset(self):
+        with self._lock:
+            self._storcli = None
+
+    def warm_up(self):
+        """Learn the models, enclosures and drives of the controllers"""
+        try:
+            self.storcli.controllers
+        except StorcliError, e:
+            LOG.warning('failed to query the controllers: %s', e)
+
+    def start(self):
+        if CFG['inventory'] is not None:
+            CFG['inventory'].start()
+
+    def stop(self, timeout=30):
+        """Wait up to timeout seconds for the modifications in progress"""
+        deadline = time.time() + timeout
+        if CFG['inventory'] is not None:
+            CFG['inventory'].stop(timeout=timeout)
+        if CFG['jobs'] is not None:
+            CFG['jobs'].shutdown(timeout=max(deadline - time.time(), 0))
+        while CFG['pool'].stats()['running'] and time.time() < deadline:
+            time.sleep(0.1)
+        running = CFG['pool'].stats()['running']
+        if running:
+            LOG.warning('%d nytrocli commands still running', running)
+
+SERVICE = StorcliService()
 
 
 def get_storcli():
-    print('get_storcli: storcli_command: %s' % CFG['storcli_command'])
-    return Storcli(storcli_cmd=CFG['storcli_command'])
+    return SERVICE.storcli
+
+
+TRUE_STRINGS = ('1', 'true', 'yes')
+
+
+def get_snapshot():
+    """The inventory snapshot to answer GET requests from (if enabled)
+
+    ?fresh=1 forces the synchronous refresh of the snapshot.
+    """
+    inventory = CFG['inventory']
+    if inventory is None:
+        return None
+    fresh = web.input(_method='get', fresh=None).fresh in TRUE_STRINGS
+    snapshot = inventory.snapshot(fresh=fresh)
+    web.ctx.snapshot_age = snapshot.age()
+    return snapshot
 
 
 def dumb_error_handler(fcn):
+    def add_extras(reply):
+        snapshot_age = web.ctx.get('snapshot_age')
+        if snapshot_age is not None:
+            reply['snapshot_age'] = snapshot_age
+        # ?timing=1 adds the Server-Timing data (except the encoding)
+        timings = stortiming.current()
+        if timings is not None and \
+                web.input(_method='get').get('timing') in TRUE_STRINGS:
+            reply['timing'] = timings.to_dict()
+        return reply
+
     def wrapper(*args, **kwargs):
         try:
-            return {'error_code': 0,
-                    'error_message': None,
-                    'storrest_version': storrest_git_version,
-                    'data': fcn(*args, **kwargs)}
+            return add_extras({'error_code': 0,
+                               'error_message': None,
+                               'storrest_version': storrest_git_version,
+                               'data': fcn(*args, **kwargs)})
         except StorcliError, e:
-            web.ctx.status = '500 Internal Server Error'
-            return {'error_code': e.error_code,
-                    'error_message': e.message,
-                    'storrest_version': storrest_git_version,
-                    'data': None}
+            if isinstance(e, StorcliBusyError):
+                web.ctx.status = '503 Service Unavailable'
+                web.header('Retry-After', str(e.retry_after))
+            else:
+                web.ctx.status = '500 Internal Server Error'
+            return add_extras({'error_code': e.error_code,
+                               'error_message': e.message,
+                               'storrest_version': storrest_git_version,
+                               'data': None})
+    return wrapper
+
+
+def invalidates_inventory(fcn):
+    def wrapper(*args, **kwargs):
+        try:
+            return fcn(*args, **kwargs)
+        finally:
+            if CFG['inventory'] is not None:
+                CFG['inventory'].invalidate()
     return wrapper
 
 
+# stands for the memoized JSON of the reply data
+MEMOIZED_DATA = '@memoized data@'
+
+
+def json_encode(obj):
+    return json.dumps(obj, default=storrecords.to_json)
+
+
 def jsonize(fcn):
     def wrapper(*args, **kwargs):
         web.header('Content-Type', 'application/json')
-        return json.dumps(fcn(*args, **kwargs))
+        reply = fcn(*args, **kwargs)
+        with stortiming.timed('encode'):
+            memo = CFG['memo']
+            data = reply.get('data') if isinstance(reply, dict) else None
+            encoded_data = None
+            if memo is not None and data is not None:
+                encoded_data = memo.encode(data, json_encode)
+            if encoded_data is None:
+                return json_encode(reply)
+            # replacing the value keeps the order of the keys
+            reply['data'] = MEMOIZED_DATA
+            return json_encode(reply).replace(json_encode(MEMOIZED_DATA),
+                                              encoded_data, 1)
     return wrapper
 
 
+def run_job(description, fcn, *args, **kwargs):
+    """Call fcn, or run it as a job if the client asked for ?async=1
+
+    For the job the reply is '202 Accepted' with the job description,
+    GET /v0.5/jobs/<job_id> reports its status and result.
+    """
+    if web.input(_method='get').get('async') not in TRUE_STRINGS:
+        return fcn(*args, **kwargs)
+    if CFG['jobs'] is None:
+        # the other workers couldn't report the job
+        raise StorcliError(error_code=400,
+                           msg='?async=1 is not available with '
+                           'several workers')
+    job = CFG['jobs'].submit(invalidates_inventory(fcn), *args,
+                             description=description, **kwargs)
+    web.ctx.status = '202 Accepted'
+    web.header('Location', '/v0.5/jobs/%s' % job.job_id)
+    return job.to_dict()
+
+
 def get_post_data():
     raw_data = web.data()
     try:
@@ -87,6 +438,9 @@ class ControllersView(object):
     @jsonize
     @dumb_error_handler
     def GET(self):
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            return snapshot.controllers
         return self.storcli.controllers
 
 
@@ -97,6 +451,11 @@ class ControllerDetails(object):
     @jsonize
     @dumb_error_handler
     def GET(self, controller_id):
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            details = snapshot.controller_details(controller_id)
+            if details is not None:
+                return details
         return self.storcli.controller_details(controller_id)
 
 
@@ -107,6 +466,11 @@ class PhysicalDrivesView(object):
     @jsonize
     @dumb_error_handler
     def GET(self, controller_id=None):
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            drives = snapshot.physical_drives(controller_id=controller_id)
+            if drives is not None:
+                return drives
         return self.storcli.physical_drives(controller_id=controller_id)
 
 
@@ -117,10 +481,16 @@ class VirtualDrivesView(object):
     @jsonize
     @dumb_error_handler
     def GET(self, controller_id=None):
+        snapshot = get_snapshot()
+        if snapshot is not None:
+            drives = snapshot.virtual_drives(controller_id=controller_id)
+            if drives is not None:
+                return drives
         return self.storcli.virtual_drives(controller_id=controller_id)
 
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def POST(self, controller_id):
         data = get_post_data()
         if 'drives' not in data:
@@ -131,15 +501,19 @@ class VirtualDrivesView(object):
                        'name', 'read_ahead', 'write_cache', 'io_policy',
                        'ssd_caching')
         params = dict([(k, data.get(k)) for k in param_names])
-        return self.storcli.create_virtual_drive(data['drives'], **params)
+        return run_job('create virtual drive',
+                       self.storcli.create_virtual_drive,
+                       data['drives'], **params)
 
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def DELETE(self, controller_id):
         if controller_id != 'all':
             controller_id = int(controller_id)
-        return get_storcli().\
-            delete_virtual_drive(controller_id, 'all', force=True)
+        return run_job('delete all virtual drives',
+                       get_storcli().delete_virtual_drive,
+                       controller_id, 'all', force=True)
 
 
 class CachecadeView(object):
@@ -151,6 +525,7 @@ class CachecadeView(object):
 
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def POST(self, controller_id, raid_type):
         data = get_post_data()
         if 'drives' not in data:
@@ -162,7 +537,9 @@ class CachecadeView(object):
                   'write_cache': data.get('write_cache'),
                   }
         web.ctx.status = '201 Created'
-        return get_storcli().create_virtual_drive(data['drives'], **params)
+        return run_job('create %s' % raid_type,
+                       get_storcli().create_virtual_drive,
+                       data['drives'], **params)
 
 
 class VirtualDriveDetails(object):
@@ -177,21 +554,23 @@ class VirtualDriveDetails(object):
 
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def DELETE(self, controller_id, virtual_drive_id):
-        return self.storcli.delete_virtual_drive(controller_id,
-                                                 virtual_drive_id,
-                                                 force=True)
+        return run_job('delete virtual drive',
+                       self.storcli.delete_virtual_drive,
+                       controller_id, virtual_drive_id, force=True)
 
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def POST(self, controller_id, virtual_drive_id):
         data = get_post_data()
         param_names = ('name', 'read_ahead', 'write_cache', 'io_policy',
                        'ssd_caching')
         params = dict([(k, data.get(k)) for k in param_names])
-        return self.storcli.update_virtual_drive(int(controller_id),
-                                                 int(virtual_drive_id),
-                                                 **params)
+        return run_job('update virtual drive',
+                       self.storcli.update_virtual_drive,
+                       int(controller_id), int(virtual_drive_id), **params)
 
 
 class CachecadeDetails(object):
@@ -204,30 +583,32 @@ class CachecadeDetails(object):
 
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def DELETE(self, controller_id, raid_type, virtual_drive_id):
-        return get_storcli().\
-            delete_virtual_drive(controller_id,
-                                 virtual_drive_id,
-                                 raid_type=raid_type)
+        return run_job('delete %s' % raid_type,
+                       get_storcli().delete_virtual_drive,
+                       controller_id, virtual_drive_id, raid_type=raid_type)
 
 
 class WarpdriveView(object):
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def POST(self, controller_id):
         try:
             data = json.loads(web.data())
             overprovision = data.get('overprovision')
         except:
             overprovision = None
-        return get_storcli().\
-            create_warp_drive_vd(controller_id,
-                                 overprovision=overprovision)
+        return run_job('format warpdrive',
+                       get_storcli().create_warp_drive_vd,
+                       controller_id, overprovision=overprovision)
 
 
 class HotspareOps(object):
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def POST(self, controller_id, enclosure, slot):
         try:
             data = json.loads(web.data())
@@ -235,19 +616,99 @@ class HotspareOps(object):
         except:
             virtual_drives = None
 
-        return get_storcli().\
-            add_hotspare_drive(virtual_drives,
-                               controller_id=controller_id,
-                               enclosure=enclosure,
-                               slot=slot)
+        return run_job('add hotspare drive',
+                       get_storcli().add_hotspare_drive,
+                       virtual_drives,
+                       controller_id=controller_id,
+                       enclosure=enclosure,
+                       slot=slot)
 
     @jsonize
     @dumb_error_handler
+    @invalidates_inventory
     def DELETE(self, controller_id, enclosure, slot):
-        return get_storcli().\
-            delete_hotspare_drive(controller_id=controller_id,
-                                  enclosure=enclosure,
-                                  slot=slot)
+        return run_job('delete hotspare drive',
+                       get_storcli().delete_hotspare_drive,
+                       controller_id=controller_id,
+                       enclosure=enclosure,
+                       slot=slot)
+
+
+class JobsView(object):
+    @jsonize
+    @dumb_error_handler
+    def GET(self):
+        if CFG['jobs'] is None:
+            return []
+        return sorted([job.to_dict() for job in CFG['jobs'].jobs()],
+                      key=lambda job: job['created'])
+
+
+class JobDetails(object):
+    @jsonize
+    @dumb_error_handler
+    def GET(self, job_id):
+        job = CFG['jobs'].get(job_id) if CFG['jobs'] is not None else None
+        if job is None:
+            raise StorcliError(error_code=404, msg='No such job %s' % job_id)
+        return job.to_dict()
+
+
+def check_admin():
+    if CFG['admin_token'] is None:
+        raise web.notfound()
+    if not is_admin():
+        raise web.forbidden()
+
+
+class AdminProfile(object):
+    @jsonize
+    @dumb_error_handler
+    def GET(self):
+        check_admin()
+        return CFG['profiler'].status()
+
+    @jsonize
+    @dumb_error_handler
+    def POST(self):
+        check_admin()
+        try:
+            count = int(get_post_data().get('requests', 1))
+        except (AttributeError, TypeError, ValueError):
+            raise StorcliError(error_code=400, msg='invalid requests count')
+        CFG['profiler'].arm(count)
+        return CFG['profiler'].status()
+
+    @jsonize
+    @dumb_error_handler
+    def DELETE(self):
+        check_admin()
+        CFG['profiler'].reset()
+        return CFG['profiler'].status()
+
+
+class AdminProfileStats(object):
+    def GET(self):
+        """The aggregated pstats (?format=text for a text report)"""
+        check_admin()
+        profiler = CFG['profiler']
+        text = web.input(_method='get').get('format') == 'text'
+        stats = profiler.report() if text else profiler.dump()
+        if stats is None:
+            raise web.notfound('nothing has been profiled yet\n')
+        if text:
+            web.header('Content-Type', 'text/plain')
+        else:
+            web.header('Content-Type', 'application/octet-stream')
+            web.header('Content-Disposition',
+                       'attachment; filename="storrest.pstats"')
+        return stats
+
+
+class MetricsView(object):
+    def GET(self):
+        web.header('Content-Type', 'text/plain; version=0.0.4')
+        return storcli.METRICS.render()
 
 if __name__ == '__main__':
     app.run()
@@ -0,0 +1,191 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import fcntl
+import os
+import threading
+import time
+
+
+class ControllerScheduler(object):
+    """Readers/writer scheduling of nytrocli commands per controller
+
+    Up to max_readers read-only commands run concurrently on a controller,
+    a modifying command runs exclusively. Commands on different controllers
+    don't wait for each other, except the /call ones ('all') which overlap
+    with every controller. Waiting writers block the new readers, so a
+    steady stream of GETs can't starve a DELETE.
+
+    The statistics of a controller which has never answered (i.e. a bogus
+    controller id in the URL) are dropped once it's been idle for
+    forget_after seconds.
+
+    With lock_dir the pre-forked worker processes sharing it exclude each
+    other's commands as well: a command holds the lock file of its
+    controller, shared for reading and exclusive for a modification,
+    which also holds the 'all' one exclusively against the /call reads.
+    """
+    def __init__(self, max_readers=4, clock=time.time, forget_after=10.0,
+                 lock_dir=None):
+        self.max_readers = max_readers
+        self.forget_after = forget_after
+        self.lock_dir = lock_dir
+        self._clock = clock
+        self._cond = threading.Condition()
+        self._readers = {}
+        self._writers = set()
+        self._waiting_readers = {}
+        self._waiting_writers = {}
+        self._waits = {}
+        self._answered = set()
+        self._idle_since = {}
+
+    def _overlaps(self, controller, busy):
+        if controller == 'all':
+            return bool(busy)
+        return controller in busy or 'all' in busy
+
+    def _can_run(self, controller, write):
+        if self._overlaps(controller, self._writers):
+            return False
+        if write:
+            return not self._overlaps(controller, self._readers)
+        if self._overlaps(controller, self._waiting_writers):
+            return False
+        return self._readers.get(controller, 0) < self.max_readers
+
+    def _inc(self, counters, controller, delta=1):
+        count = counters.get(controller, 0) + delta
+        if count:
+            counters[controller] = count
+        else:
+            del counters[controller]
+
+    def acquire(self, controller, write=False):
+        controller = str(controller)
+        waiting = self._waiting_writers if write else self._waiting_readers
+        start = self._clock()
+        with self._cond:
+            self._forget_idle()
+            self._inc(waiting, controller)
+            try:
+                while not self._can_run(controller, write):
+                    self._cond.wait()
+            finally:
+                self._inc(waiting, controller, -1)
+            if write:
+                self._writers.add(controller)
+            else:
+                self._inc(self._readers, controller)
+            self._record_wait(controller, self._clock() - start)
+
+    def _record_wait(self, controller, waited, commands=1):
+        count, total, longest = self._waits.get(controller, (0, 0.0, 0.0))
+        self._waits[controller] = (count + commands, total + waited,
+                                   max(longest, waited))
+
+    def _idle(self, controller):
+        return not (controller in self._readers or
+                    controller in self._writers or
+                    controller in self._waiting_readers or
+                    controller in self._waiting_writers)
+
+    def _forget_idle(self):
+        now = self._clock()
+        for controller, since in self._idle_since.items():
+            if controller in self._answered or not self._idle(controller):
+                del self._idle_since[controller]
+            elif now - since > self.forget_after:
+                del self._idle_since[controller]
+                self._waits.pop(controller, None)
+
+    def answered(self, controller):
+        """Keep the statistics of the controller, it does exist"""
+        controller = str(controller)
+        with self._cond:
+            self._answered.add(controller)
+
+    def release(self, controller, write=False):
+        controller = str(controller)
+        with self._cond:
+            if write:
+                self._writers.discard(controller)
+            else:
+                self._inc(self._readers, controller, -1)
+            if controller not in self._answered and self._idle(controller):
+                self._idle_since[controller] = self._clock()
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def _process_lock(self, controller, write=False):
+        """Exclude the commands of the other processes (see lock_dir)"""
+        if self.lock_dir is None:
+            yield
+            return
+        controller = str(controller)
+        if not write:
+            locks = [(controller, fcntl.LOCK_SH)]
+        elif controller == 'all':
+            locks = [('all', fcntl.LOCK_EX)]
+        else:
+            # 'all' is the last one to take, so there's no deadlock
+            locks = [(controller, fcntl.LOCK_EX), ('all', fcntl.LOCK_EX)]
+        files = []
+        start = self._clock()
+        try:
+            for name, operation in locks:
+                path = os.path.join(self.lock_dir, 'controller-%s.lock' % name)
+                files.append(open(path, 'a'))
+                fcntl.flock(files[-1], operation)
+            with self._cond:
+                self._record_wait(controller, self._clock() - start,
+                                  commands=0)
+            yield
+        finally:
+            # closing the file releases the lock
+            for f in reversed(files):
+                f.close()
+
+    @contextlib.contextmanager
+    def command(self, controller, write=False):
+        self.acquire(controller, write=write)
+        try:
+            with self._process_lock(controller, write=write):
+                yield
+        finally:
+            self.release(controller, write=write)
+
+    def stats(self):
+        """Queue depth, running commands and wait time per controller"""
+        with self._cond:
+            self._forget_idle()
+            controllers = set(self._waits) | set(self._readers) | \
+                self._writers | set(self._waiting_readers) | \
+                set(self._waiting_writers)
+            ret = {}
+            for controller in controllers:
+                count, total, longest = self._waits.get(controller,
+                                                        (0, 0.0, 0.0))
+                ret[controller] = {
+                    'queue_depth': self._waiting_readers.get(controller, 0) +
+                    self._waiting_writers.get(controller, 0),
+                    'readers': self._readers.get(controller, 0),
+                    'writer': controller in self._writers,
+                    'commands': count,
+                    'wait_time_total': total,
+                    'wait_time_max': longest,
+                }
+            return ret
@@ -0,0 +1,155 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import errno
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from web import httpserver, wsgiserver
+
+LOG = logging.getLogger('storrest.storserver')
+
+
+class WSGIServer(wsgiserver.CherryPyWSGIServer):
+    """CherryPy WSGI server optionally accepting on the given socket
+
+    The pre-forked workers share the socket the master process listens on.
+    """
+    listening_socket = None
+
+    def bind(self, family, type, proto=0):
+        if self.listening_socket is None:
+            return super(WSGIServer, self).bind(family, type, proto)
+        self.socket = self.listening_socket
+
+
+def make_server(app, address, threads=10, backlog=64, keepalive=10,
+                listening_socket=None):
+    """The multi-threaded HTTP/1.1 server of the web.py application
+
+    threads requests are handled concurrently, up to backlog connections
+    wait to be accepted, an idle keep-alive connection is closed after
+    keepalive seconds.
+    """
+    server = WSGIServer(address, httpserver.LogMiddleware(app.wsgifunc()),
+                        numthreads=threads, request_queue_size=backlog,
+                        timeout=keepalive, server_name='storrest')
+    server.listening_socket = listening_socket
+    return server
+
+
+def _run(server, on_stop=None):
+    def _terminate(signum, frame):
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, _terminate)
+    try:
+        server.start()
+    except (KeyboardInterrupt, SystemExit):
+        server.stop()
+    finally:
+        if on_stop is not None:
+            on_stop()
+
+
+def _listen(address, backlog):
+    family = socket.AF_INET6 if ':' in address[0] else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+def _fork_worker(server_args, post_fork, on_stop):
+    pid = os.fork()
+    if pid:
+        return pid
+    status = 0
+    try:
+        # the master stops the workers on Ctrl-C
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if post_fork is not None:
+            post_fork()
+        _run(make_server(**server_args), on_stop)
+    except:
+        LOG.exception('worker %s failed', os.getpid())
+        status = 1
+    os._exit(status)
+
+
+def serve(app, address, threads=10, backlog=64, keepalive=10, workers=1,
+          post_fork=None, on_stop=None):
+    """Serve the application until SIGTERM or SIGINT
+
+    With workers > 1 the master process listens on the address and
+    pre-forks the given number of worker processes serving the
+    connections, a worker which dies is started over. post_fork is
+    called in every worker (or once if there are no workers) before it
+    serves the requests, i.e. to start the threads as those don't
+    survive fork(). on_stop is called once the worker has stopped
+    serving the requests.
+    """
+    server_args = {'app': app, 'address': address, 'threads': threads,
+                   'backlog': backlog, 'keepalive': keepalive}
+    LOG.info('serving on http://%s:%d/', *address)
+    if workers <= 1:
+        if post_fork is not None:
+            post_fork()
+        _run(make_server(**server_args), on_stop)
+        return
+
+    server_args['listening_socket'] = _listen(address, backlog)
+    children = set()
+    stopping = []
+
+    def _stop(signum, frame):
+        stopping.append(signum)
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    for _ in range(workers):
+        children.add(_fork_worker(server_args, post_fork, on_stop))
+    while not stopping:
+        try:
+            pid, status = os.wait()
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                continue
+            raise
+        if pid not in children:
+            continue
+        children.discard(pid)
+        if not stopping:
+            LOG.warning('worker %s exited (status %s), restarting',
+                        pid, status)
+            # don't spin if the workers die right away
+            time.sleep(1)
+            children.add(_fork_worker(server_args, post_fork, on_stop))
+
+    for pid in children:
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    for pid in children:
+        try:
+            os.waitpid(pid, 0)
+        except OSError:
+            pass
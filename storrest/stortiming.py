@@ -0,0 +1,100 @@
+
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import contextlib
+import threading
+import time
+
+_local = threading.local()
+
+
+class Timings(object):
+    """Time spent in the stages of a request (nytrocli, decoding, ...)
+
+    Durations of the same stage are summed up. The stages run by
+    parallel_map workers are accounted too, so the sum of durations
+    may exceed the wall clock time of the request.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = []
+        self._durations = {}
+
+    def add(self, name, seconds):
+        with self._lock:
+            if name not in self._durations:
+                self._stages.append(name)
+                self._durations[name] = [0.0, 0]
+            self._durations[name][0] += seconds
+            self._durations[name][1] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return dict((name, {'duration': total, 'count': count})
+                        for name, (total, count) in
+                        self._durations.iteritems())
+
+    def server_timing(self):
+        """The value of the Server-Timing header (durations in ms)"""
+        with self._lock:
+            return ', '.join('%s;dur=%.3f' % (name,
+                                              self._durations[name][0] * 1000)
+                             for name in self._stages)
+
+
+def current():
+    """Timings being collected by this thread (None if not collecting)"""
+    return getattr(_local, 'timings', None)
+
+
+@contextlib.contextmanager
+def collect(timings=None):
+    """Collect the timings of the stages run by this thread"""
+    previous = current()
+    _local.timings = timings if timings is not None else Timings()
+    try:
+        yield _local.timings
+    finally:
+        _local.timings = previous
+
+
+def record(name, seconds):
+    timings = current()
+    if timings is not None:
+        timings.add(name, seconds)
+
+
+@contextlib.contextmanager
+def timed(name):
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(name, time.time() - start)
+
+
+def bind(fcn):
+    """Make fcn account its stages to this thread's timings
+
+    For the functions run by other threads on behalf of this one.
+    """
+    timings = current()
+    if timings is None:
+        return fcn
+
+    def wrapper(*args, **kwargs):
+        with collect(timings):
+            return fcn(*args, **kwargs)
+    return wrapper
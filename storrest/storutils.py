@@ -14,7 +14,12 @@
 # limitations under the License.
 
 import logging
+import Queue
 import re
+import sys
+import threading
+
+import stortiming
 
 LOG = logging.getLogger('storrest.storcli.storutils')
 
@@ -102,6 +107,68 @@ def vd_raid_type(vd):
         return None
 
 
+def parse_dg_vd(dg_vd):
+    """(drive_group, virtual_drive) of the VD LIST 'DG/VD' field"""
+    try:
+        drive_group, virtual_drive = dg_vd.split('/')
+    except AttributeError:
+        # XXX: sometimes nytrocli puts an integer here
+        if isinstance(dg_vd, int):
+            drive_group = virtual_drive = dg_vd
+        else:
+            raise
+    return int(drive_group), int(virtual_drive)
+
+
+def index_drive_groups(phys_drives):
+    """Map (controller_id, drive_group) to the sorted list of its drives
+
+    A dedicated hot spare (drive_group is a list) is indexed under
+    each of its drive groups.
+    """
+    index = {}
+    for drive in phys_drives:
+        drive_group = drive['drive_group']
+        if isinstance(drive_group, list):
+            drive_groups = set(drive_group)
+        elif isinstance(drive_group, int):
+            drive_groups = (drive_group,)
+        else:
+            continue
+        for dg in drive_groups:
+            index.setdefault((drive['controller_id'], dg), []).append(drive)
+    for drives in index.itervalues():
+        drives.sort()
+    return index
+
+
+def drives_ids(drives):
+    return set([(d['enclosure'], d['slot']) for d in drives])
+
+
+VD_KEY_RX = re.compile(r'^/c\d+/v(\d+)$')
+PDS_FOR_VD_RX = re.compile(r'^PDs for VD (\d+)$')
+
+
+def created_vd_id(response_data):
+    """The id of the VD created by 'add vd' if nytrocli reported it"""
+    for key in (response_data or {}):
+        match = VD_KEY_RX.match(key)
+        if match:
+            return int(match.group(1))
+    return None
+
+
+def vds_members(dat):
+    """Map the VD id to its member drives in /cN/vall show all output"""
+    ret = {}
+    for key, val in dat.iteritems():
+        match = PDS_FOR_VD_RX.match(key)
+        if match:
+            ret[int(match.group(1))] = val
+    return ret
+
+
 def parse_state(arg):
     smap = {'Optl': 'optimal',
             'OfLn': 'offline',
@@ -132,3 +199,79 @@ def validate_integer(val, interval):
 
 def validate_percentage(val):
     return validate_integer(val, (0, 100))
+
+
+_COMMAND_ID_RX = re.compile('(?<=/[cevsd])(?:\d+|all)')
+_COMMAND_CONTROLLER_RX = re.compile('^/c(\d+|all)')
+
+
+def command_class(cmd):
+    """Strip the object IDs from the nytrocli command
+
+    ['/c0/eall/sall', 'show', 'all'] -> '/c/e/s show all'
+    """
+    return ' '.join([_COMMAND_ID_RX.sub('', cmd[0])] + list(cmd[1:]))
+
+
+def command_verb(cmd):
+    """command_class without the parameters, i.e. for the metrics labels
+
+    ['/c0', 'add', 'vd', 'r1', 'drives=62:1,2'] -> '/c add vd'
+    """
+    words = [word for word in cmd[1:3]
+             if '=' not in word and word not in ('force', 'cc')]
+    if len(words) == 2 and words[0] not in ('show', 'add', 'start'):
+        words = words[:1]
+    return ' '.join([_COMMAND_ID_RX.sub('', cmd[0])] + words)
+
+
+def command_controller(cmd):
+    """The controller the nytrocli command operates on ('all' for /call)"""
+    matched = _COMMAND_CONTROLLER_RX.match(cmd[0]) if cmd else None
+    return matched.group(1) if matched else 'all'
+
+
+def is_read_only(cmd):
+    return len(cmd) > 1 and cmd[1] == 'show'
+
+
+def parallel_map(fcn, items, max_workers=1):
+    """Like map(), but runs fcn in up to max_workers threads
+
+    The results are returned in the order of items. If some of the calls
+    fail the exception of the first one (in the order of items) is
+    re-raised after all the calls have completed.
+    """
+    items = list(items)
+    workers = min(max_workers or 1, len(items))
+    if workers <= 1:
+        return [fcn(item) for item in items]
+
+    fcn = stortiming.bind(fcn)
+    results = [None] * len(items)
+    errors = [None] * len(items)
+    pending = Queue.Queue()
+    for idx in range(len(items)):
+        pending.put(idx)
+
+    def worker():
+        while True:
+            try:
+                idx = pending.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[idx] = fcn(items[idx])
+            except:
+                errors[idx] = sys.exc_info()
+
+    threads = [threading.Thread(target=worker) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for exc_info in errors:
+        if exc_info is not None:
+            raise exc_info[0], exc_info[1], exc_info[2]
+    return results
@@ -14,7 +14,15 @@
 # limitations under the License.
 
 import json
+import marshal
 import mock
+import os
+import pickle
+import shutil
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from tests_helpers import MultiReturnValues, add_top_srcdir_to_path,\
@@ -24,13 +32,22 @@ from tests_helpers import MultiReturnValues, add_top_srcdir_to_path,\
 add_top_srcdir_to_path()
 
 import storrest
-from storrest.storutils import strlst, vd_raid_type
+import storrest.storbreaker
+import storrest.storcache
+import storrest.storcli_health
+import storrest.storcompat
+import storrest.storexec
+import storrest.stormetrics
+import storrest.storprofile
+import storrest.stortiming
+from storrest.storutils import drives_ids, strlst, vd_raid_type
 
 STORCLI_SHOW = read_expected('call_show.json')
 STORCLI_SHOW_ALL = read_expected('call_show_all.json')
 STORCLI_ENCLOSURES_SHOW = read_expected('c0_eall_show.json')
 STORCLI_C0_EALL_SALL_SHOW = read_expected('c0_eall_sall_show_all.json')
 STORCLI_C1_SALL_SHOW = read_expected('c1_sall_show_all.json')
+STORCLI_C0_V0_SHOW_ALL = read_expected('c0_v0_show_all.json')
 
 
 def extract_controller_raw_data(raw_dat, controller_id, serialize=True):
@@ -273,10 +290,145 @@ class StorcliTest(unittest.TestCase):
         self.verify_storcli_commands(expected_commands)
         self.assertEqual(actual, self.controller_details)
 
+    def _mock_storcli_replies(self, replies):
+        def storcli_reply(cmd):
+            return replies[' '.join(cmd[len(self.storcli.storcli_cmd):-1])]
+        self.mock_check_output.side_effect = storcli_reply
+
+    def test_controller_details_parallel(self):
+        self.storcli = storrest.storcli.Storcli(max_workers=4)
+        self._mock_storcli_replies({
+            '/call show all': STORCLI_SHOW_ALL,
+            '/c0/eall show': STORCLI_ENCLOSURES_SHOW,
+            '/c0 show health': read_expected('c0_show_health.json'),
+            '/c0/eall/sall show all': STORCLI_C0_EALL_SALL_SHOW,
+            '/c1 show health': read_expected('c1_show_health.json'),
+            '/c1/sall show all': STORCLI_C1_SALL_SHOW,
+        })
+        actual = self.storcli.controller_details(None)
+        self.assertEqual(actual, self.controller_details)
+        self.assertEqual(self.mock_check_output.call_count, 6)
+
+    def test_controller_details_batched(self):
+        controller_id = 0
+        self.storcli = storrest.storcli.Storcli(batch_commands=True)
+        self.mock_check_output.side_effect = MultiReturnValues([
+            extract_controller_raw_data(STORCLI_SHOW_ALL, controller_id),
+            read_expected('c0_show_health.json'),
+            STORCLI_ENCLOSURES_SHOW,
+            STORCLI_C0_EALL_SALL_SHOW,
+        ])
+        expected_commands = (
+            '{storcli_cmd} /call show all J',
+            '{storcli_cmd} /call show health J',
+            '{storcli_cmd} /call/eall show J',
+            '{storcli_cmd} /call/eall/sall show all J',
+        )
+        actual = self.storcli.controller_details('all')
+        self.verify_storcli_commands(expected_commands)
+        expected = [c for c in self.controller_details
+                    if c['controller_id'] == controller_id]
+        self.assertEqual(actual, expected)
+
+    def test_controller_details_busy(self):
+        replies = {
+            '/call show all': STORCLI_SHOW_ALL,
+            '/c0 show all': extract_controller_raw_data(STORCLI_SHOW_ALL, 0),
+            '/c0/eall show': STORCLI_ENCLOSURES_SHOW,
+            '/call/eall show': STORCLI_ENCLOSURES_SHOW,
+            '/c0/eall/sall show all': STORCLI_C0_EALL_SALL_SHOW,
+            '/call/eall/sall show all': STORCLI_C0_EALL_SALL_SHOW,
+        }
+
+        def storcli_reply(cmd):
+            cmd = ' '.join(cmd[len(self.storcli.storcli_cmd):-1])
+            if cmd.endswith('show health'):
+                raise storrest.storexec.PoolBusy()
+            return replies[cmd]
+
+        self.mock_check_output.side_effect = storcli_reply
+        with self.assertRaises(storrest.storcli.StorcliBusyError):
+            self.storcli.controller_details(0)
+        # the busy /call isn't retried controller by controller
+        self.storcli = storrest.storcli.Storcli(batch_commands=True)
+        self.mock_check_output.reset_mock()
+        with self.assertRaises(storrest.storcli.StorcliBusyError):
+            self.storcli.controller_details('all')
+        commands = [' '.join(args[0][len(self.storcli.storcli_cmd):-1])
+                    for args, _ in self.mock_check_output.call_args_list]
+        self.assertEqual([cmd for cmd in commands if 'health' in cmd],
+                         ['/call show health'])
+
+    def test_controller_details_batched_warpdrive(self):
+        self.storcli = storrest.storcli.Storcli(batch_commands=True)
+        health_replies = [read_expected(name) for name in
+                          ('c0_show_health.json', 'c1_show_health.json')]
+        # skip nytrocli debug messages
+        health_replies = [json.loads(reply[reply.find('{'):])
+                          for reply in health_replies]
+        call_show_health = {'Controllers': [reply['Controllers'][0]
+                                            for reply in health_replies]}
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_SHOW_ALL,
+            json.dumps(call_show_health),
+            STORCLI_ENCLOSURES_SHOW,
+            STORCLI_C0_EALL_SALL_SHOW,
+            STORCLI_C1_SALL_SHOW,
+        ])
+        # WarpDrive can't enumerate enclosures, hence per-controller
+        # commands for the enclosures and drives
+        expected_commands = (
+            '{storcli_cmd} /call show all J',
+            '{storcli_cmd} /call show health J',
+            '{storcli_cmd} /c0/eall show J',
+            '{storcli_cmd} /c0/eall/sall show all J',
+            '{storcli_cmd} /c1/sall show all J',
+        )
+        actual = self.storcli.controller_details('all')
+        self.verify_storcli_commands(expected_commands)
+        self.assertEqual(actual, self.controller_details)
+
     def test_virtual_drive_details(self):
         controller_id = 0
         virtual_drive_id = 0
         self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_C0_V0_SHOW_ALL,
+            STORCLI_C0_EALL_SALL_SHOW,
+        ])
+        actual = self.storcli.virtual_drive_details(controller_id,
+                                                    virtual_drive_id)
+        expected = [vd for vd in self.expected_virtual_drives
+                    if vd['controller_id'] == controller_id and
+                    vd['virtual_drive'] == virtual_drive_id][0]
+        expected_commands = (
+            '{storcli_cmd} /c{controller_id}/v{virtual_drive_id} show all J',
+            '{storcli_cmd} /c{controller_id}/eall/sall show all J',
+        )
+        self.assertEqual(actual, expected)
+        self.verify_storcli_commands(expected_commands,
+                                     controller_id=controller_id,
+                                     virtual_drive_id=virtual_drive_id)
+
+    def test_virtual_drive_details_hot_spare(self):
+        health = json.loads(STORCLI_C0_EALL_SALL_SHOW)
+        drives = health['Controllers'][0]['Response Data']
+        drives['Drive /c0/e62/s20'][0].update({'State': 'DHS', 'DG': '1'})
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_C0_V0_SHOW_ALL,
+            json.dumps(health),
+        ])
+        actual = self.storcli.virtual_drive_details(0, 0)
+        # listed along with the member drives like the enumeration does
+        self.assertEqual(drives_ids(actual['physical_drives']),
+                         set([(62, 0), (62, 1), (62, 20)]))
+        spare = [pd for pd in actual['physical_drives'] if pd['slot'] == 20]
+        self.assertEqual(spare[0]['state'], 'dedicated_hot_spare')
+
+    def test_virtual_drive_details_fallback(self):
+        controller_id = 0
+        virtual_drive_id = 0
+        self.mock_check_output.side_effect = MultiReturnValues([
+            self._make_reply(controller_id, error_code=46),
             extract_controller_raw_data(STORCLI_SHOW_ALL, controller_id),
             STORCLI_C0_EALL_SALL_SHOW
         ])
@@ -286,12 +438,28 @@ class StorcliTest(unittest.TestCase):
                     if vd['controller_id'] == controller_id and
                     vd['virtual_drive'] == virtual_drive_id][0]
         expected_commands = (
+            '{storcli_cmd} /c{controller_id}/v{virtual_drive_id} show all J',
             '{storcli_cmd} /c{controller_id} show J',
             '{storcli_cmd} /c{controller_id}/eall/sall show all J',
         )
         self.assertEqual(actual, expected)
         self.verify_storcli_commands(expected_commands,
-                                     controller_id=controller_id)
+                                     controller_id=controller_id,
+                                     virtual_drive_id=virtual_drive_id)
+
+    def test_nytrocache_details(self):
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_SHOW,
+            STORCLI_C0_EALL_SALL_SHOW,
+            STORCLI_C1_SALL_SHOW
+        ])
+        actual = self.storcli.virtual_drive_details(0, 1,
+                                                    raid_type='nytrocache')
+        self.assertEqual(vd_raid_type(actual), 'nytrocache')
+        # enumerated, /c0/v1 show all doesn't tell nytrocache VDs apart
+        self.assertEqual(self.mock_check_output.call_args_list[0],
+                         mock.call(self.storcli.storcli_cmd +
+                                   '/c0 show J'.split()))
 
     def test_virtual_drive_details_nonexistent(self):
         self.mock_check_output.return_value = STORCLI_SHOW
@@ -301,12 +469,14 @@ class StorcliTest(unittest.TestCase):
             self.storcli.virtual_drive_details(controller_id,
                                                virtual_drive_id)
         expected_commands = (
+            '{storcli_cmd} /c{controller_id}/v{virtual_drive_id} show all J',
             '{storcli_cmd} /c{controller_id} show J',
             '{storcli_cmd} /c0/eall/sall show all J',
             '{storcli_cmd} /c1/sall show all J',
         )
         self.verify_storcli_commands(expected_commands,
-                                     controller_id=controller_id)
+                                     controller_id=controller_id,
+                                     virtual_drive_id=virtual_drive_id)
 
     def verify_storcli_commands(self, expected_commands, **kwargs):
         kwargs['storcli_cmd'] = ' '.join(self.storcli.storcli_cmd)
@@ -409,24 +579,41 @@ class StorcliTest(unittest.TestCase):
         ssd_caching = raid_type is None
         io_policy = 'direct'
 
-        self.mock_check_output.side_effect = MultiReturnValues([
-            self._make_success_reply(controller_id),
-            extract_controller_raw_data(STORCLI_SHOW, controller_id),
-            STORCLI_C0_EALL_SALL_SHOW
-        ])
+        create_cmd = ('{storcli_cmd} /c{controller_id} add vd {raid_type} '
+                      'r{raid_level} drives={drives_str} '
+                      '{pd_per_array} {io_policy} {ssd_caching} J')
+        if raid_type is None:
+            # the new VD is looked up among the VDs of the controller
+            self.mock_check_output.side_effect = MultiReturnValues([
+                self._make_success_reply(controller_id),
+                STORCLI_C0_V0_SHOW_ALL,
+                STORCLI_C0_EALL_SALL_SHOW,
+            ])
+            expected_commands = (
+                create_cmd,
+                '{storcli_cmd} /c{controller_id}/vall show all J',
+                '{storcli_cmd} /c{controller_id}/eall/sall show all J',
+            )
+        else:
+            self.mock_check_output.side_effect = MultiReturnValues([
+                self._make_success_reply(controller_id),
+                extract_controller_raw_data(STORCLI_SHOW, controller_id),
+                STORCLI_C0_EALL_SALL_SHOW
+            ])
+            expected_commands = (
+                create_cmd,
+                '{storcli_cmd} /c{controller_id} show J',
+                '{storcli_cmd} /c{controller_id}/eall/sall show all J',
+            )
 
-        self.storcli.create_virtual_drive(physical_drives,
-                                          raid_level=raid_level,
-                                          raid_type=raid_type,
-                                          io_policy=io_policy,
-                                          ssd_caching=ssd_caching)
-        expected_commands = (
-            '{storcli_cmd} /c{controller_id} add vd {raid_type} '
-            'r{raid_level} drives={drives_str} '
-            '{pd_per_array} {io_policy} {ssd_caching} J',
-            '{storcli_cmd} /c{controller_id} show J',
-            '{storcli_cmd} /c{controller_id}/eall/sall show all J',
-        )
+        actual = self.storcli.create_virtual_drive(physical_drives,
+                                                   raid_level=raid_level,
+                                                   raid_type=raid_type,
+                                                   io_policy=io_policy,
+                                                   ssd_caching=ssd_caching)
+        self.assertEqual(set((pd['enclosure'], pd['slot'])
+                             for pd in actual['physical_drives']),
+                         set((int(enclosure), int(slot)) for slot in slots))
         drives_str = '{enclosure}:{slots}'.format(enclosure=enclosure,
                                                   slots=strlst(slots))
         params = {
@@ -449,6 +636,56 @@ class StorcliTest(unittest.TestCase):
     def test_create_raid10(self):
         self._create_raid(raid_level=10)
 
+    def test_create_raid_with_spare(self):
+        physical_drives = [{'controller_id': 0, 'enclosure': 62, 'slot': slot}
+                           for slot in (0, 1)]
+        spare_drives = [{'controller_id': 0, 'enclosure': 62, 'slot': 20}]
+        reply = self._make_success_reply(0, serialize=False)
+        reply['Controllers'][0]['Response Data'] = {'/c0/v0': []}
+        health = json.loads(STORCLI_C0_EALL_SALL_SHOW)
+        drives = health['Controllers'][0]['Response Data']
+        drives['Drive /c0/e62/s20'][0].update({'State': 'DHS', 'DG': 1})
+        self.mock_check_output.side_effect = MultiReturnValues([
+            json.dumps(reply),
+            STORCLI_C0_V0_SHOW_ALL,
+            json.dumps(health),
+        ])
+        actual = self.storcli.create_virtual_drive(physical_drives,
+                                                   spare_drives=spare_drives,
+                                                   raid_level=1)
+        self.assertEqual(drives_ids(actual['physical_drives']),
+                         set([(62, 0), (62, 1), (62, 20)]))
+        expected_commands = (
+            '{storcli_cmd} /c0 add vd r1 drives=62:0,1 Spares=62:20 J',
+            '{storcli_cmd} /c0/v0 show all J',
+            '{storcli_cmd} /c0/eall/sall show all J',
+        )
+        self.verify_storcli_commands(expected_commands)
+
+    def test_create_vd_lookup_fallback(self):
+        controller_id = 0
+        physical_drives = [{'controller_id': controller_id,
+                            'enclosure': 62,
+                            'slot': 0}]
+        # nytrocli reports the id of the new VD, but the VD has gone
+        reply = self._make_success_reply(controller_id, serialize=False)
+        reply['Controllers'][0]['Response Data'] = {'/c0/v5': []}
+        self.mock_check_output.side_effect = MultiReturnValues([
+            json.dumps(reply),
+            STORCLI_C0_V0_SHOW_ALL,
+            extract_controller_raw_data(STORCLI_SHOW, controller_id),
+            STORCLI_C0_EALL_SALL_SHOW
+        ])
+        with self.assertRaises(storrest.storcli.StorcliError):
+            self.storcli.create_virtual_drive(physical_drives, raid_level=0)
+        expected_commands = (
+            '{storcli_cmd} /c0 add vd r0 drives=62:0 J',
+            '{storcli_cmd} /c0/v5 show all J',
+            '{storcli_cmd} /c0 show J',
+            '{storcli_cmd} /c0/eall/sall show all J',
+        )
+        self.verify_storcli_commands(expected_commands)
+
     def _create_raid_negative(self, valid_reply=True):
         raid_level = 1
         controller_id = 0
@@ -577,13 +814,11 @@ class StorcliTest(unittest.TestCase):
         self.mock_check_output.side_effect = MultiReturnValues([
             extract_controller_raw_data(STORCLI_SHOW,
                                         controller_id=params['controller_id']),
-            STORCLI_C0_EALL_SALL_SHOW,
             self._make_success_reply(params['controller_id'])
         ])
         self.storcli.add_hotspare_drive(vdrives, **params)
         expected_commands = (
             '{storcli_cmd} /c{controller_id} show J',
-            '{storcli_cmd} /c{controller_id}/eall/sall show all J',
             '{storcli_cmd} /c{controller_id}/e{enclosure}/s{slot} add '
             'hotsparedrive dgs={drive_group} J',
         )
@@ -629,6 +864,340 @@ class StorcliTest(unittest.TestCase):
         params['read_ahead'] = 'RA' if params['read_ahead'] else 'NoRA'
         self.verify_storcli_commands(expected_commands, **params)
 
+    def _cached_storcli(self, ttl):
+        self.now = 1000.0
+        cache = storrest.storcache.ResultCache(ttl=ttl,
+                                               clock=lambda: self.now)
+        return storrest.storcli.Storcli(cache=cache)
+
+    def test_cached_controllers(self):
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_SHOW_ALL,
+            STORCLI_ENCLOSURES_SHOW,
+            read_expected('c0_show_health.json'),
+            read_expected('c1_show_health.json'),
+            read_expected('c0_show_health.json'),
+            STORCLI_SHOW_ALL,
+            STORCLI_ENCLOSURES_SHOW,
+            read_expected('c0_show_health.json'),
+        ])
+        self.storcli = self._cached_storcli({'default': 5,
+                                             '/c show health': 60})
+        self.assertEqual(self.storcli.controllers, self.controllers)
+        self.assertEqual(self.storcli.controllers, self.controllers)
+        self.now += 10
+        self.assertEqual(self.storcli.controllers, self.controllers)
+        expected_commands = (
+            '{storcli_cmd} /call show all J',
+            '{storcli_cmd} /c0/eall show J',
+            '{storcli_cmd} /c0 show health J',
+            '{storcli_cmd} /c1 show health J',
+            # failures are not cached
+            '{storcli_cmd} /c0 show health J',
+            # controller 1 health info is still fresh
+            '{storcli_cmd} /call show all J',
+            '{storcli_cmd} /c0/eall show J',
+            '{storcli_cmd} /c0 show health J',
+        )
+        self.verify_storcli_commands(expected_commands)
+
+    def test_controller_profiles(self):
+        profiles = storrest.storcache.ControllerProfiles()
+        self.storcli = storrest.storcli.Storcli(profiles=profiles)
+        moved = json.loads(STORCLI_SHOW_ALL)
+        moved['Controllers'][0]['Response Data']['Basics']['PCI Address'] = \
+            '00:07:00:00'
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_SHOW_ALL,
+            STORCLI_ENCLOSURES_SHOW,
+            read_expected('c0_show_health.json'),
+            read_expected('c1_show_health.json'),
+            STORCLI_SHOW_ALL,
+            read_expected('c0_show_health.json'),
+            read_expected('c1_show_health.json'),
+            self._make_success_reply(1),
+            json.dumps(moved),
+            STORCLI_ENCLOSURES_SHOW,
+            read_expected('c0_show_health.json'),
+            read_expected('c1_show_health.json'),
+        ])
+        self.assertEqual(self.storcli.controllers, self.controllers)
+        self.assertEqual(self.storcli.controllers, self.controllers)
+        self.storcli.delete_virtual_drive(1, 'all')
+        self.storcli.controllers
+        expected_commands = (
+            '{storcli_cmd} /call show all J',
+            '{storcli_cmd} /c0/eall show J',
+            '{storcli_cmd} /c0 show health J',
+            '{storcli_cmd} /c1 show health J',
+            # the enclosures are known already
+            '{storcli_cmd} /call show all J',
+            '{storcli_cmd} /c0 show health J',
+            '{storcli_cmd} /c1 show health J',
+            # so is the WarpDrive model
+            '{storcli_cmd} /c1/v0 del J',
+            # the controller has been moved to another slot
+            '{storcli_cmd} /call show all J',
+            '{storcli_cmd} /c0/eall show J',
+            '{storcli_cmd} /c0 show health J',
+            '{storcli_cmd} /c1 show health J',
+        )
+        self.verify_storcli_commands(expected_commands)
+
+    def test_circuit_breaker(self):
+        self.now = 1000.0
+        breaker = storrest.storbreaker.CircuitBreaker(threshold=2, backoff=10,
+                                                      clock=lambda: self.now)
+        self.storcli = storrest.storcli.Storcli(breaker=breaker)
+        # ErrCd 1, "None"
+        failure = read_expected('c0_show_health.json')
+        self.mock_check_output.side_effect = MultiReturnValues([
+            failure,
+            failure,
+            # the probe after the back-off
+            failure,
+            failure,
+        ])
+        for _ in range(3):
+            self.assertIsNone(self.storcli._controller_health(0))
+        self.assertEqual(breaker.stats(),
+                         {('0', '/c show health'): {'open': 1,
+                                                    'rejected': 1}})
+        self.now += 10
+        self.assertIsNone(self.storcli._controller_health(0))
+        # the back-off doubles
+        self.now += 10
+        self.assertIsNone(self.storcli._controller_health(0))
+        self.now += 10
+        self.assertIsNone(self.storcli._controller_health(0))
+        expected_commands = ('{storcli_cmd} /c0 show health J', ) * 4
+        self.verify_storcli_commands(expected_commands)
+
+        # a timeout opens the breakers of all the commands of the controller
+        timeout = storrest.storcli.StorcliError(
+            'timed out', error_code=storrest.storcli.NYTROCLI_TIMEOUT)
+        breaker.failure(1, '/c show all', timeout, timeout=True)
+        self.assertIs(breaker.check(1, '/c/e show'), timeout)
+        self.assertIsNone(breaker.check(0, '/c/e show'))
+        self.now += 10
+        self.assertIsNone(breaker.check(1, '/c/e show'))
+        breaker.success(1, '/c/e show')
+        self.assertIsNone(breaker.check(1, '/c show all'))
+
+        # the failures are forgotten after a while
+        self.now += 2 * breaker.max_backoff
+        breaker.failure(0, '/c/e show', timeout)
+        self.assertEqual(breaker.stats(),
+                         {('0', '/c/e show'): {'open': 0, 'rejected': 0},
+                          ('0', '/c show health'): {'open': 0,
+                                                    'rejected': 2},
+                          ('1', '*'): {'open': 0, 'rejected': 1}})
+
+    def test_circuit_breaker_ignores_missing_objects(self):
+        breaker = storrest.storbreaker.CircuitBreaker(threshold=2)
+        self.storcli = storrest.storcli.Storcli(breaker=breaker)
+        self.mock_check_output.side_effect = MultiReturnValues(
+            [self._make_reply(0, error_code=255)] * 5)
+        for vd in range(5):
+            with self.assertRaises(storrest.storcli.StorcliError):
+                self.storcli._run(['/c0/v%d' % (100 + vd), 'show', 'all'])
+        # nytrocli has been run every time, nothing is remembered
+        self.assertEqual(self.mock_check_output.call_count, 5)
+        self.assertEqual(breaker.stats(), {})
+
+    def test_cache_invalidated_by_mutation(self):
+        controller_id = 0
+        self.mock_check_output.side_effect = MultiReturnValues([
+            extract_controller_raw_data(STORCLI_SHOW, controller_id),
+            STORCLI_C0_EALL_SALL_SHOW,
+            self._make_success_reply(controller_id),
+            extract_controller_raw_data(STORCLI_SHOW, controller_id),
+            STORCLI_C0_EALL_SALL_SHOW,
+        ])
+        self.storcli = self._cached_storcli(60)
+        self.storcli.virtual_drives(controller_id)
+        self.storcli.virtual_drives(controller_id)
+        self.storcli.delete_virtual_drive(controller_id, 1)
+        self.storcli.virtual_drives(controller_id)
+        expected_commands = (
+            '{storcli_cmd} /c{controller_id} show J',
+            '{storcli_cmd} /c{controller_id}/eall/sall show all J',
+            '{storcli_cmd} /c{controller_id}/v1 del J',
+            '{storcli_cmd} /c{controller_id} show J',
+            '{storcli_cmd} /c{controller_id}/eall/sall show all J',
+        )
+        self.verify_storcli_commands(expected_commands,
+                                     controller_id=controller_id)
+
+    def test_cache_skips_output_read_before_mutation(self):
+        controller_id = 0
+        self.storcli = self._cached_storcli(60)
+        replies = MultiReturnValues([STORCLI_ENCLOSURES_SHOW] * 2)
+
+        def check_output(cmd):
+            # the controller gets modified while nytrocli is running
+            if replies.calls < 0:
+                self.storcli._cache.invalidate(controller_id)
+            return replies(cmd)
+
+        self.mock_check_output.side_effect = check_output
+        self.assertEqual(self.storcli._enclosures(controller_id), [62, 252])
+        self.assertEqual(self.storcli._enclosures(controller_id), [62, 252])
+        expected_commands = ('{storcli_cmd} /c0/eall show J', ) * 2
+        self.verify_storcli_commands(expected_commands)
+
+    def test_topology_index(self):
+        controller_id = 0
+        index = storrest.storcache.TopologyIndex()
+        self.storcli = storrest.storcli.Storcli(topology=index)
+        self.mock_check_output.side_effect = MultiReturnValues([
+            extract_controller_raw_data(STORCLI_SHOW, controller_id),
+            STORCLI_C0_EALL_SALL_SHOW,
+            self._make_success_reply(controller_id),
+            extract_controller_raw_data(STORCLI_SHOW, controller_id),
+            self._make_success_reply(controller_id),
+        ])
+        # the VD listing fills the index
+        self.storcli.virtual_drives(controller_id)
+        topology = index.get(controller_id)
+        self.assertEqual(topology['vd_groups'], {0: [1], 1: [0]})
+        self.assertEqual(drives_ids(topology['group_drives'][1]),
+                         set([(62, 0), (62, 1)]))
+        self.assertEqual(topology['drives'][(62, 0)]['drive_group'], 1)
+        # the assignment modifies the controller, the next one reads
+        # the topology again
+        self.storcli.add_hotspare_drive([0], controller_id=controller_id,
+                                        enclosure=62, slot=19)
+        self.storcli.add_hotspare_drive([0], controller_id=controller_id,
+                                        enclosure=62, slot=20)
+        expected_commands = (
+            '{storcli_cmd} /c0 show J',
+            '{storcli_cmd} /c0/eall/sall show all J',
+            '{storcli_cmd} /c0/e62/s19 add hotsparedrive dgs=1 J',
+            '{storcli_cmd} /c0 show J',
+            '{storcli_cmd} /c0/e62/s20 add hotsparedrive dgs=1 J',
+        )
+        self.verify_storcli_commands(expected_commands)
+        # a topology read before the modification is not stored
+        index.put(controller_id, topology, index.generation - 1)
+        self.assertIsNone(index.get(controller_id))
+
+    def test_memoized_parsing(self):
+        memo = storrest.storcache.ResponseMemo()
+        self.storcli = storrest.storcli.Storcli(memo=memo)
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_SHOW,
+            STORCLI_C0_EALL_SALL_SHOW,
+            STORCLI_C1_SALL_SHOW
+        ] * 2)
+        vdrives = self.storcli.all_virtual_drives
+        self.assertEqual(sorted(vdrives), self.expected_virtual_drives)
+        # the same output gives back the very same objects
+        self.assertIs(self.storcli.all_virtual_drives, vdrives)
+        self.assertEqual(memo.hits['decode'], 3)
+        self.assertEqual(memo.hits['vds'], 1)
+        self.assertEqual(memo.encode(vdrives, len), len(vdrives))
+        self.assertIsNone(memo.encode([], len))
+
+    def test_memo_output_changed(self):
+        memo = storrest.storcache.ResponseMemo(max_entries=2)
+        decode = mock.Mock(side_effect=lambda raw: {'raw': raw})
+        first = memo.decode('cmd', 'a', decode, 'a')
+        self.assertIs(memo.decode('cmd', 'a', decode, 'a'), first)
+        self.assertIsNot(memo.decode('cmd', 'b', decode, 'b'), first)
+        self.assertEqual(decode.call_count, 2)
+        derived = memo.derive('x', [first], dict, first)
+        self.assertIs(memo.derive('x', [first], dict, first), derived)
+        self.assertIsNot(memo.derive('x', [dict(first)], dict, first),
+                         derived)
+        memo.derive('y', [first], dict, first)
+        memo.derive('z', [first], dict, first)
+        # evicted
+        self.assertIsNot(memo.derive('x', [first], dict, first), derived)
+
+    def test_memo_bounded(self, memo=None):
+        memo = memo or storrest.storcache.ResponseMemo(max_entries=2)
+        decode = mock.Mock(side_effect=json.loads)
+        failure = self._make_reply(0, error_code=42)
+        for _ in range(2):
+            memo.decode('failure', failure, decode, failure)
+        self.assertEqual(decode.call_count, 2)
+        for cmd in ('a', 'b', 'a', 'c', 'a', 'b'):
+            memo.decode(cmd, '{}', decode, '{}')
+        # 'b' has been evicted by 'c'
+        self.assertEqual(decode.call_count, 6)
+        self.assertEqual(memo.stats()['entries'], 2)
+
+    def test_memo_bounded_python26(self):
+        with mock.patch.object(storrest.storcache, 'OrderedDict',
+                               storrest.storcompat.OrderedDict):
+            memo = storrest.storcache.ResponseMemo(max_entries=2)
+        self.test_memo_bounded(memo)
+
+    def test_concurrent_commands_coalesced(self):
+        inflight = storrest.storcache.SingleFlight()
+        self.storcli = storrest.storcli.Storcli(inflight=inflight)
+        callers = 5
+        release = threading.Event()
+
+        def slow_storcli(cmd):
+            release.wait()
+            return STORCLI_SHOW
+
+        self.mock_check_output.side_effect = slow_storcli
+        results = []
+
+        def worker():
+            results.append(self.storcli._run(['/call', 'show']))
+
+        threads = [threading.Thread(target=worker) for _ in range(callers)]
+        for thread in threads:
+            thread.start()
+        while inflight.coalesced < callers - 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.verify_storcli_commands(('{storcli_cmd} /call show J',))
+        self.assertEqual(len(results), callers)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(self.storcli.coalescing_stats,
+                         {'calls': callers,
+                          'coalesced': callers - 1,
+                          'in_flight': 0})
+
+    def test_commands_after_mutation_not_coalesced(self):
+        inflight = storrest.storcache.SingleFlight()
+        self.storcli = storrest.storcli.Storcli(inflight=inflight)
+        release = threading.Event()
+
+        def slow_storcli(cmd):
+            if 'del' in cmd:
+                return self._make_success_reply(1)
+            release.wait()
+            return extract_controller_raw_data(STORCLI_SHOW, 0)
+
+        self.mock_check_output.side_effect = slow_storcli
+        threads = [threading.Thread(target=self.storcli._run,
+                                    args=(['/c0', 'show'], ))
+                   for _ in range(2)]
+        threads[0].start()
+        while inflight.in_flight < 1:
+            time.sleep(0.001)
+        self.storcli.delete_virtual_drive(1, 0)
+        threads[1].start()
+        while inflight.in_flight < 2:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.verify_storcli_commands(('{storcli_cmd} /c0 show J',
+                                      '{storcli_cmd} /c1/v0 del J',
+                                      '{storcli_cmd} /c0 show J'))
+        self.assertEqual(inflight.coalesced, 0)
+
     def test_nonexisting_command(self):
         self.mock_check_output.side_effect = \
             OSError(2, 'no such file or directory', '/foo')
@@ -652,8 +1221,136 @@ class StorcliTest(unittest.TestCase):
         the_exception = ee.exception
         self.assertEqual(the_exception.error_code, error_code)
 
+    def test_health_output_pruned(self):
+        parser = storrest.storcli_health.HealthInfoParser()
+        cmd = self.storcli.storcli_cmd + '/c0/eall/sall show all J'.split()
+        full = json.loads(STORCLI_C0_EALL_SALL_SHOW)
+        pruned = self.storcli._decode(cmd, STORCLI_C0_EALL_SALL_SHOW)
+        self.assertNotIn('Device attributes', json.dumps(pruned))
+        full, pruned = [dat['Controllers'][0]['Response Data']
+                        for dat in (full, pruned)]
+        self.assertEqual(parser.drives_health(0, pruned),
+                         parser.drives_health(0, full))
+
+    @mock.patch('storrest.storcli.json.JSONDecoder', side_effect=TypeError)
+    def test_health_output_without_pairs_hook(self, mock_decoder):
+        # python 2.6
+        cmd = self.storcli.storcli_cmd + '/c0/eall/sall show all J'.split()
+        self.assertEqual(self.storcli._decode(cmd, STORCLI_C0_EALL_SALL_SHOW),
+                         json.loads(STORCLI_C0_EALL_SALL_SHOW))
+        cmd = self.storcli.storcli_cmd + '/c0 show health J'.split()
+        self.assertEqual(self.storcli._decode(cmd, 'debug {}',
+                                              permissive=True), {})
+        self.assertEqual(mock_decoder.call_count, 1)
+
+    def test_health_direct_lookup(self):
+        parser = storrest.storcli_health.HealthInfoParser()
+        dat = json.loads(STORCLI_C0_EALL_SALL_SHOW)
+        raw_health_info = {0: dat['Controllers'][0]['Response Data']}
+        expected = parser.drives_health(0, raw_health_info[0])
+        pdrives = [{'controller_id': 0, 'enclosure': enclosure,
+                    'slot': slot} for _, enclosure, slot in sorted(expected)]
+        pdrives.append({'controller_id': 0, 'enclosure': 99, 'slot': 1})
+        parser.add_health_info(0, raw_health_info, pdrives)
+        self.assertEqual(dict((parser._drive_addr_tuple(pd), pd['health'])
+                              for pd in pdrives[:-1]), expected)
+        self.assertIsNone(pdrives[-1]['health'])
+        # the same response gives the same (cached) health objects
+        health = [pd['health'] for pd in pdrives]
+        parser.add_health_info(0, raw_health_info, pdrives)
+        self.assertTrue(all(pd['health'] is old
+                            for pd, old in zip(pdrives[:-1], health)))
+        # the keys nytrocli spelled differently are found by the regexps
+        odd = {0: {'Drive /c0/e5/s1  - Detailed Information': {
+            'Drive /c0/e5/s1 State': {'Drive Temperature': '30C'}}}}
+        pdrive = {'controller_id': 0, 'enclosure': 5, 'slot': 1}
+        parser.add_health_info(0, odd, [pdrive])
+        self.assertEqual(pdrive['health'], {'temperature': '30C',
+                                            'ssd_life_left': None})
+
+    def test_metrics(self):
+        metrics = storrest.stormetrics.Registry()
+        cli = storrest.storcli.Storcli(metrics=metrics)
+        cli._run('/call show all'.split())
+        self.mock_check_output.return_value = self._make_reply(0,
+                                                               error_code=4)
+        with self.assertRaises(storrest.storcli.StorcliError):
+            cli.delete_virtual_drive(0, 1, force=True)
+        count, _ = metrics.get('nytrocli_command_seconds',
+                               command='/c show all')
+        self.assertEqual(count, 1)
+        count, size = metrics.get('nytrocli_output_bytes',
+                                  command='/c show all')
+        self.assertEqual(size, len(STORCLI_SHOW_ALL))
+        self.assertEqual(metrics.get('nytrocli_errors_total',
+                                     command='/c/v del', error_code=4), 1)
+
+    def test_timings(self):
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_SHOW,
+            STORCLI_C0_EALL_SALL_SHOW,
+            STORCLI_C1_SALL_SHOW
+        ])
+        with storrest.stortiming.collect() as timings:
+            self.storcli.all_virtual_drives
+        stages = timings.to_dict()
+        for stage in ('spawn', 'decode', 'extract', 'parse_pd', 'parse_vd',
+                      'parse_health'):
+            self.assertIn(stage, stages)
+        self.assertEqual(stages['spawn']['count'], 3)
+        self.assertIn('spawn;dur=', timings.server_timing())
+        self.assertIsNone(storrest.stortiming.current())
+
+    def test_profiler(self):
+        self.mock_check_output.side_effect = MultiReturnValues([
+            STORCLI_SHOW,
+            STORCLI_C0_EALL_SALL_SHOW,
+            STORCLI_C1_SALL_SHOW
+        ] * 2)
+        profiler = storrest.storprofile.Profiler()
+        cli = storrest.storcli.Storcli(profiler=profiler)
+        self.assertIsNone(profiler.dump())
+        profiler.arm(1)
+        cli.all_virtual_drives
+        cli.all_virtual_drives
+        self.assertEqual(profiler.status(), {'remaining': 0,
+                                             'profiled_calls': 1})
+        self.assertIn('_parse_virtual_drives', profiler.report())
+        self.assertTrue(marshal.loads(profiler.dump()))
+
+    def test_command_timeout(self):
+        pool = storrest.storexec.ProcessPool(timeout=0.2)
+        cli = storrest.storcli.Storcli(storcli_cmd=['sh', '-c', 'sleep 5',
+                                                    'sh'],
+                                       pool=pool)
+        start = time.time()
+        with self.assertRaises(storrest.storcli.StorcliError) as ee:
+            cli.controllers
+        self.assertLess(time.time() - start, 5)
+        self.assertEqual(ee.exception.error_code,
+                         storrest.storcli.NYTROCLI_TIMEOUT)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+    def test_pool_busy(self):
+        pool = storrest.storexec.ProcessPool(max_processes=1, max_queue=0,
+                                             retry_after=7)
+        cli = storrest.storcli.Storcli(pool=pool)
+        with pool.slot():
+            with self.assertRaises(storrest.storcli.StorcliBusyError) as ee:
+                cli.controllers
+        self.assertEqual(ee.exception.error_code,
+                         storrest.storcli.STORCLI_BUSY)
+        self.assertEqual(ee.exception.retry_after, 7)
+        self.assertEqual(pool.stats()['rejected'], 1)
+        self.assertEqual(self.mock_check_output.call_count, 0)
+
 
 class StorutilsTest(unittest.TestCase):
+    _pd_fields = {'controller_id': 0, 'drive_group': None, 'size': 100,
+                  'sector_size': 512, 'state': 'unconfigured_good',
+                  'medium': 'SSD', 'interface': 'SAS', 'model': 'Foo',
+                  'health': {'temperature': '30C', 'ssd_life_left': '99%'}}
+
     def test_parse_phys_drive_state_unusual(self):
         from storrest.storutils import parse_phys_drive_state
         raw_weird_state = 'FooBar'
@@ -695,6 +1392,96 @@ class StorutilsTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             parse_sector_size('foo bar')
 
+    def test_command_class(self):
+        from storrest.storutils import command_class, command_controller
+        cmd = '/c0/eall/sall show all'.split()
+        self.assertEqual(command_class(cmd), '/c/e/s show all')
+        self.assertEqual(command_controller(cmd), '0')
+        cmd = '/call show'.split()
+        self.assertEqual(command_class(cmd), '/c show')
+        self.assertEqual(command_controller(cmd), 'all')
+
+    def test_command_verb(self):
+        verbs = (('/c0/e4/s1 show all', '/c/e/s show all'),
+                 ('/c0 add vd nytrocache r1 name=foo drives=4:1,2',
+                  '/c add vd'),
+                 ('/c0/v1 del cc force', '/c/v del'),
+                 ('/c0/v1 set name=foo', '/c/v set'))
+        for cmd, verb in verbs:
+            self.assertEqual(storrest.storutils.command_verb(cmd.split()),
+                             verb)
+
+    def test_metrics_render(self):
+        metrics = storrest.stormetrics.Registry()
+        hist = metrics.histogram('foo_seconds', 'Foo', buckets=(1, 2))
+        hist.labels(cmd='a"b').observe(1.5)
+        metrics.counter('bar_total', 'Bar').labels().inc(3)
+        metrics.add_collector(lambda: [('baz', 'Baz', 'gauge',
+                                        [({'x': 1}, 7)])])
+        self.assertEqual(metrics.render().splitlines(), [
+            '# HELP bar_total Bar',
+            '# TYPE bar_total counter',
+            'bar_total 3',
+            '# HELP foo_seconds Foo',
+            '# TYPE foo_seconds histogram',
+            'foo_seconds_bucket{cmd="a\\"b",le="1.0"} 0',
+            'foo_seconds_bucket{cmd="a\\"b",le="2.0"} 1',
+            'foo_seconds_bucket{cmd="a\\"b",le="+Inf"} 1',
+            'foo_seconds_sum{cmd="a\\"b"} 1.5',
+            'foo_seconds_count{cmd="a\\"b"} 1',
+            '# HELP baz Baz',
+            '# TYPE baz gauge',
+            'baz{x="1"} 7'])
+
+    def test_index_drive_groups(self):
+        from storrest.storutils import index_drive_groups
+        drives = [{'controller_id': 0, 'slot': 2, 'drive_group': 1},
+                  {'controller_id': 0, 'slot': 1, 'drive_group': 1},
+                  {'controller_id': 0, 'slot': 3, 'drive_group': [1, 2, 2]},
+                  {'controller_id': 1, 'slot': 1, 'drive_group': 1},
+                  {'controller_id': 0, 'slot': 4, 'drive_group': None},
+                  {'controller_id': 0, 'slot': 5, 'drive_group': 'F'}]
+        index = index_drive_groups(drives)
+        self.assertEqual(sorted(index.keys()), [(0, 1), (0, 2), (1, 1)])
+        self.assertEqual([d['slot'] for d in index[(0, 1)]], [1, 2, 3])
+        self.assertEqual(index[(0, 2)], [drives[2]])
+
+    def test_records(self):
+        from storrest.storrecords import PhysicalDrive, to_json
+        drives = [dict(self._pd_fields, enclosure=enclosure, slot=slot,
+                       allocated=allocated)
+                  for enclosure, slot, allocated in ((None, 3, True),
+                                                     (62, 1, False),
+                                                     (8, 2, True),
+                                                     (8, 1, True))]
+        records = [PhysicalDrive(**drive) for drive in drives]
+        self.assertEqual(records, drives)
+        self.assertEqual(sorted(records, key=PhysicalDrive.sort_key),
+                         sorted(drives))
+        self.assertEqual(json.loads(json.dumps(records, default=to_json)),
+                         drives)
+        record = records[0]
+        self.assertEqual(record['slot'], 3)
+        self.assertEqual(record.get('foo', 42), 42)
+        record['health'] = None
+        self.assertIn('health', record)
+        self.assertRaises(KeyError, record.__setitem__, 'foo', 1)
+        self.assertEqual(pickle.loads(pickle.dumps(record)), record)
+
+    def test_parallel_map(self):
+        from storrest.storutils import parallel_map
+
+        def slow_square(x):
+            time.sleep(0.01 * (5 - x))
+            if x == 3:
+                raise ValueError(x)
+            return x * x
+
+        self.assertEqual(parallel_map(slow_square, [0, 1, 2], max_workers=3),
+                         [0, 1, 4])
+        with self.assertRaises(ValueError):
+            parallel_map(slow_square, range(5), max_workers=2)
+
     def test_parse_cache_flags_negative(self):
         from storrest.storutils import parse_cache_flags
 
@@ -705,5 +1492,161 @@ class StorutilsTest(unittest.TestCase):
             parse_cache_flags('NRWTF')
 
 
+class ControllerSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        super(ControllerSchedulerTest, self).setUp()
+        from storrest.storsched import ControllerScheduler
+        self.scheduler = ControllerScheduler(max_readers=2)
+
+    def _start(self, controller, write=False):
+        acquired = threading.Event()
+
+        def worker():
+            self.scheduler.acquire(controller, write=write)
+            acquired.set()
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        return acquired
+
+    def _wait_queued(self, controller, depth=1):
+        def queue_depth():
+            stats = self.scheduler.stats().get(controller, {})
+            return stats.get('queue_depth', 0)
+
+        while queue_depth() < depth:
+            time.sleep(0.001)
+
+    def test_readers_limit(self):
+        self.scheduler.acquire(0)
+        self.scheduler.acquire(0)
+        reader = self._start(0)
+        self._wait_queued('0')
+        self.assertFalse(reader.is_set())
+        self.assertTrue(self._start(1).wait(1))
+        self.scheduler.release(0)
+        self.assertTrue(reader.wait(1))
+
+    def test_writer_exclusive(self):
+        self.scheduler.acquire(0)
+        writer = self._start(0, write=True)
+        self._wait_queued('0')
+        # waiting writer blocks new readers, but not the other controllers
+        reader = self._start(0)
+        self._wait_queued('0', depth=2)
+        self.assertTrue(self._start(1, write=True).wait(1))
+        self.assertFalse(writer.is_set())
+        self.scheduler.release(0)
+        self.assertTrue(writer.wait(1))
+        self.assertFalse(reader.is_set())
+        self.scheduler.release(0, write=True)
+        self.assertTrue(reader.wait(1))
+
+    def test_call_overlaps_all_controllers(self):
+        self.scheduler.acquire(1, write=True)
+        reader = self._start('all')
+        self._wait_queued('all')
+        self.assertFalse(reader.is_set())
+        self.scheduler.release(1, write=True)
+        self.assertTrue(reader.wait(1))
+        stats = self.scheduler.stats()
+        self.assertEqual(stats['all']['readers'], 1)
+        self.assertEqual(stats['all']['commands'], 1)
+        self.assertTrue(stats['all']['wait_time_max'] > 0)
+
+    def test_lock_dir(self):
+        from storrest.storsched import ControllerScheduler
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        # the schedulers of two worker processes
+        first, second = [ControllerScheduler(lock_dir=lock_dir)
+                         for _ in range(2)]
+
+        def start(controller, write=False):
+            acquired, release = threading.Event(), threading.Event()
+            self.addCleanup(release.set)
+
+            def worker():
+                with second.command(controller, write=write):
+                    acquired.set()
+                    release.wait()
+
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            return acquired
+
+        with first.command(0, write=True):
+            reader = start(0)
+            call_reader = start('all')
+            self.assertTrue(start(1).wait(1))
+            self.assertFalse(reader.wait(0.05))
+            self.assertFalse(call_reader.is_set())
+        self.assertTrue(reader.wait(1))
+        self.assertTrue(call_reader.wait(1))
+        writer = start(1, write=True)
+        self.assertFalse(writer.wait(0.05))
+        with first.command(0):
+            pass
+
+    def test_forget_controllers_never_answered(self):
+        from storrest.storsched import ControllerScheduler
+        now = [0.0]
+        scheduler = ControllerScheduler(clock=lambda: now[0])
+        for controller in (0, 7, 8):
+            with scheduler.command(controller):
+                pass
+        scheduler.answered(0)
+        self.assertEqual(sorted(scheduler.stats()), ['0', '7', '8'])
+        now[0] += scheduler.forget_after + 1
+        self.assertEqual(sorted(scheduler.stats()), ['0'])
+        self.assertEqual(scheduler.stats()['0']['commands'], 1)
+
+
+class NytrocliSimTest(unittest.TestCase):
+    """Storcli against tools/nytrocli_sim.py"""
+    def setUp(self):
+        super(NytrocliSimTest, self).setUp()
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        sim = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           '..', 'tools', 'nytrocli_sim.py')
+        self.sim_cmd = [sys.executable, sim, '--controllers', '2',
+                        '--enclosures', '2', '--slots', '4', '--vds', '1']
+        state_file = os.path.join(self.tmpdir, 'state.json')
+        self.storcli = storrest.storcli.Storcli(
+            storcli_cmd=self.sim_cmd + ['--state-file', state_file],
+            batch_commands=True)
+
+    def test_controller_details(self):
+        details = self.storcli.controller_details('all')
+        self.assertEqual([c['enclosures'] for c in details], [[62, 63]] * 2)
+        self.assertEqual([len(c['physical_drives']) for c in details], [8] * 2)
+        vdrives = details[0]['virtual_drives']
+        self.assertEqual(len(vdrives), 1)
+        self.assertEqual([(pd['enclosure'], pd['slot'])
+                          for pd in vdrives[0]['physical_drives']],
+                         [(62, 0), (62, 1)])
+        pdrive = details[0]['physical_drives'][0]
+        self.assertTrue(pdrive['health']['temperature'])
+        # the same options give the same topology
+        other = storrest.storcli.Storcli(storcli_cmd=self.sim_cmd)
+        self.assertEqual(other.controller_details('all'), details)
+
+    def test_create_delete(self):
+        pdrives = [{'controller_id': 1, 'enclosure': 63, 'slot': slot}
+                   for slot in range(3)]
+        vdrive = self.storcli.create_virtual_drive(pdrives, raid_level=5,
+                                                   name='foo')
+        self.assertEqual(vdrive['raid_level'], '5')
+        self.assertEqual(vdrive['name'], 'foo')
+        self.assertEqual(len(self.storcli.virtual_drives(1)), 2)
+        with self.assertRaises(storrest.storcli.StorcliError):
+            self.storcli.create_virtual_drive(pdrives[:1], raid_level=1)
+        self.storcli.delete_virtual_drive(1, vdrive['virtual_drive'])
+        self.assertEqual(len(self.storcli.virtual_drives(1)), 1)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -15,6 +15,11 @@
 
 import json
 import mock
+import os
+import shutil
+import tempfile
+import threading
+import time
 import unittest
 
 from tests_helpers import add_top_srcdir_to_path
@@ -22,8 +27,13 @@ from tests_helpers import add_top_srcdir_to_path
 add_top_srcdir_to_path()
 
 import storrest
+import storrest.storcache
 import storrest.storcli
+import storrest.storcompat
+import storrest.storjobs
+import storrest.storprofile
 import storrest.storrest
+from storrest.storinventory import InventoryPoller
 
 
 class StorrestTest(unittest.TestCase):
@@ -59,6 +69,116 @@ class StorrestTest(unittest.TestCase):
         self.verify_reply(request)
         mock_obj.assert_called_once()
 
+    @mock.patch.object(storrest.storcli.Storcli, 'controller_details')
+    def test_inventory_snapshot(self, mock_obj):
+        pdrive = {'controller_id': 0, 'enclosure': 4, 'slot': 1}
+        vdrive = {'controller_id': 0, 'virtual_drive': 0,
+                  'raid_level': '1', 'physical_drives': [pdrive]}
+        controller = {'controller_id': 0, 'model': 'FooBar'}
+        details = dict(controller, physical_drives=[pdrive],
+                       virtual_drives=[vdrive])
+        mock_obj.return_value = [details]
+        inventory = InventoryPoller(storrest.storrest.get_storcli)
+        url = '/{0}/controllers'.format(self.api_version)
+        expected_replies = (
+            (url, [controller]),
+            (url + '/0', details),
+            (url + '/0/physicaldevices', [pdrive]),
+            (url + '/0/virtualdevices', [vdrive]),
+        )
+        with mock.patch.dict(storrest.storrest.CFG, {'inventory': inventory}):
+            for url, expected in expected_replies:
+                reply = json.loads(self.app.request(url).data)
+                self.assertEqual(reply['data'], expected)
+                self.assertTrue(reply['snapshot_age'] >= 0)
+            mock_obj.assert_called_once_with('all')
+            self.app.request(url + '?fresh=1')
+            self.assertEqual(mock_obj.call_count, 2)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'delete_virtual_drive')
+    @mock.patch.object(storrest.storcli.Storcli, 'controller_details')
+    def test_inventory_invalidated(self, mock_details, mock_delete):
+        self.prepare(mock_delete)
+        mock_details.return_value = []
+        inventory = InventoryPoller(storrest.storrest.get_storcli)
+        url = '/{0}/controllers'.format(self.api_version)
+        with mock.patch.dict(storrest.storrest.CFG, {'inventory': inventory}):
+            self.app.request(url)
+            self.app.request(url + '/0/virtualdevices/1', method='DELETE')
+            self.app.request(url)
+        self.assertEqual(mock_details.call_count, 2)
+
+    def test_storcli_service(self):
+        service = storrest.storrest.StorcliService()
+        storcli = service.storcli
+        self.assertIs(service.storcli, storcli)
+        service.reset()
+        self.assertIsNot(service.storcli, storcli)
+        self.assertIs(storrest.storrest.get_storcli(),
+                      storrest.storrest.SERVICE.storcli)
+        # stop() lets the queued modifications complete
+        jobs = storrest.storjobs.JobManager(workers=1)
+        job = jobs.submit(time.sleep, 0.1)
+        with mock.patch.dict(storrest.storrest.CFG, {'jobs': jobs}):
+            service.stop(timeout=5)
+        self.assertTrue(job.done)
+        # nor waits for a hung inventory refresh beyond the timeout
+        release = threading.Event()
+        self.addCleanup(release.set)
+        storcli = mock.Mock()
+        storcli.controller_details.side_effect = lambda _: release.wait()
+        inventory = InventoryPoller(lambda: storcli, interval=30)
+        cfg = {'inventory': inventory,
+               'jobs': storrest.storjobs.JobManager(workers=1)}
+        with mock.patch.dict(storrest.storrest.CFG, cfg):
+            service.start()
+            while not storcli.controller_details.called:
+                time.sleep(0.001)
+            start = time.time()
+            service.stop(timeout=0.1)
+            self.assertTrue(time.time() - start < 1)
+
+    def test_shared_inventory_snapshot(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snapshot_file = os.path.join(tmpdir, 'inventory')
+        storcli = mock.Mock()
+        storcli.controller_details.return_value = [{'controller_id': 0}]
+        # the pollers of two workers
+        first, second = [InventoryPoller(lambda: storcli, interval=30,
+                                         snapshot_file=snapshot_file)
+                         for _ in range(2)]
+        snapshot = first.snapshot()
+        self.assertEqual(second.snapshot().controllers, snapshot.controllers)
+        # a recent enough snapshot is not taken again
+        second.refresh(max_age=30)
+        self.assertEqual(storcli.controller_details.call_count, 1)
+        second.invalidate()
+        first.snapshot()
+        self.assertEqual(storcli.controller_details.call_count, 2)
+        # the refresh in progress can't publish the data it has read
+        # before the modification
+        started, release = threading.Event(), threading.Event()
+        self.addCleanup(release.set)
+
+        def controller_details(_):
+            started.set()
+            release.wait()
+            return [{'controller_id': 0}]
+
+        storcli.controller_details.side_effect = controller_details
+        refresh = threading.Thread(target=first.refresh)
+        refresh.start()
+        started.wait(5)
+        invalidate = threading.Thread(target=second.invalidate)
+        invalidate.start()
+        invalidate.join(0.05)
+        self.assertTrue(invalidate.is_alive())
+        release.set()
+        refresh.join(5)
+        invalidate.join(5)
+        self.assertFalse(os.path.exists(snapshot_file))
+
     @mock.patch.object(storrest.storcli.Storcli, 'controller_details')
     def test_controller_details(self, mock_obj):
         mock_obj.return_value = self.dummy_data
@@ -387,5 +507,186 @@ class StorrestTest(unittest.TestCase):
     def test_warpdrive_create(self, mock_obj):
         self._warpdrive_create(mock_obj)
 
+    def _async_job(self, mock_obj, positive=True):
+        self.prepare(mock_obj, positive=positive)
+        url = '/{0}/controllers/0/virtualdevices/warpdrive?async=1'
+        request = self.app.request(url.format(self.api_version),
+                                   method='POST')
+        self.assertEqual(request.status, '202 Accepted')
+        job = json.loads(request.data)['data']
+        self.assertEqual(request.headers['Location'],
+                         '/v0.5/jobs/%s' % job['job_id'])
+        self.assertTrue(storrest.storrest.CFG['jobs'].get(job['job_id'])
+                        .wait(5))
+        url = '/{0}/jobs/{1}'.format(self.api_version, job['job_id'])
+        job = json.loads(self.app.request(url).data)['data']
+        mock_obj.assert_called_once_with('0', overprovision=None)
+        return job
+
+    @mock.patch.object(storrest.storcli.Storcli, 'create_warp_drive_vd')
+    def test_async_job(self, mock_obj):
+        job = self._async_job(mock_obj)
+        self.assertEqual(job['status'], 'finished')
+        self.assertEqual(job['result'], self.dummy_data)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'create_warp_drive_vd')
+    def test_async_job_fail(self, mock_obj):
+        job = self._async_job(mock_obj, positive=False)
+        self.assertEqual(job['status'], 'failed')
+        self.assertEqual(job['error_code'], self.dummy_error_code)
+        self.assertEqual(job['error_message'], self.dummy_error_msg)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'create_warp_drive_vd')
+    def test_async_job_queue_full(self, mock_obj):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        mock_obj.side_effect = lambda *args, **kwargs: release.wait()
+        jobs = storrest.storjobs.JobManager(workers=1, max_queued=1,
+                                            retry_after=2)
+        url = '/{0}/controllers/0/virtualdevices/warpdrive?async=1'
+        url = url.format(self.api_version)
+        with mock.patch.dict(storrest.storrest.CFG, {'jobs': jobs}):
+            running = self.app.request(url, method='POST')
+            while not mock_obj.called:
+                time.sleep(0.001)
+            queued = self.app.request(url, method='POST')
+            request = self.app.request(url, method='POST')
+        self.assertEqual(running.status, '202 Accepted')
+        self.assertEqual(queued.status, '202 Accepted')
+        self.assertEqual(request.status, '503 Service Unavailable')
+        self.assertEqual(request.headers['Retry-After'], '2')
+        self.assertEqual(len(jobs.jobs()), 2)
+        release.set()
+        jobs.shutdown(timeout=5)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'create_warp_drive_vd')
+    def test_async_job_several_workers(self, mock_obj):
+        url = '/{0}/controllers/0/virtualdevices/warpdrive?async=1'
+        with mock.patch.dict(storrest.storrest.CFG, {'jobs': None}):
+            reply = json.loads(self.app.request(url.format(self.api_version),
+                                                method='POST').data)
+            jobs = json.loads(self.app.request(
+                '/{0}/jobs'.format(self.api_version)).data)
+        self.assertEqual(reply['error_code'], 400)
+        self.assertEqual(jobs['data'], [])
+        self.assertFalse(mock_obj.called)
+
+    def test_nonexistent_job(self):
+        url = '/{0}/jobs/{1}'.format(self.api_version, 'deadbeef')
+        reply = json.loads(self.app.request(url).data)
+        self.assertEqual(reply['error_code'], 404)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'controller_details')
+    def test_busy(self, mock_obj):
+        mock_obj.side_effect = storrest.storcli.StorcliBusyError(
+            msg=self.dummy_error_msg, retry_after=3)
+        url = '/{0}/controllers/0'.format(self.api_version)
+        request = self.app.request(url)
+        self.assertEqual(request.status, '503 Service Unavailable')
+        self.assertEqual(request.headers['Retry-After'], '3')
+        reply = json.loads(request.data)
+        self.assertEqual(reply['error_code'], storrest.storcli.STORCLI_BUSY)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'controller_details')
+    def test_metrics(self, mock_obj):
+        self.prepare(mock_obj)
+        url = '/{0}/controllers/0'.format(self.api_version)
+        self.app.request(url)
+        request = self.app.request('/metrics')
+        self.assertEqual(request.status, '200 OK')
+        self.assertIn('storrest_http_request_seconds_count{handler='
+                      '"ControllerDetails",method="GET",status="200"}',
+                      request.data)
+        self.assertIn('storrest_pool_spawned', request.data)
+        mock_obj.assert_called_once_with('0')
+
+    @mock.patch.object(storrest.storcli.Storcli, 'controller_details')
+    def test_timing(self, mock_obj):
+        self.prepare(mock_obj)
+        url = '/{0}/controllers/0'.format(self.api_version)
+        request = self.app.request(url)
+        self.assertIn('total;dur=', request.headers['Server-Timing'])
+        self.assertNotIn('timing', json.loads(request.data))
+        request = self.app.request(url + '?timing=1')
+        reply = json.loads(request.data)
+        self.assertEqual(reply['data'], self.dummy_data)
+        self.assertIn('timing', reply)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'controller_details')
+    def test_admin_profile(self, mock_obj):
+        self.prepare(mock_obj)
+        url = '/{0}/controllers/0'.format(self.api_version)
+        profiler = storrest.storprofile.Profiler()
+        token = {'X-Storrest-Admin-Token': 'secret'}
+        cfg = {'profiler': profiler, 'admin_token': None}
+        with mock.patch.dict(storrest.storrest.CFG, cfg):
+            request = self.app.request('/admin/profile', headers=token)
+            self.assertEqual(request.status, '404 Not Found')
+            storrest.storrest.CFG['admin_token'] = 'secret'
+            request = self.app.request('/admin/profile', method='POST',
+                                       data=json.dumps({'requests': 2}))
+            self.assertEqual(request.status, '403 Forbidden')
+            request = self.app.request('/admin/profile', method='POST',
+                                       data=json.dumps({'requests': 2}),
+                                       headers=token)
+            self.assertEqual(json.loads(request.data)['data'],
+                             {'remaining': 2, 'profiled_calls': 0})
+            self.app.request(url)
+            request = self.app.request('/admin/profile', headers=token)
+            self.assertEqual(json.loads(request.data)['data'],
+                             {'remaining': 1, 'profiled_calls': 1})
+            request = self.app.request('/admin/profile/stats?format=text',
+                                       headers=token)
+            self.assertEqual(request.status, '200 OK')
+            self.assertIn('function calls', request.data)
+            request = self.app.request('/admin/profile/stats',
+                                       headers=token)
+            self.assertEqual(request.headers['Content-Type'],
+                             'application/octet-stream')
+            self.app.request('/admin/profile', method='DELETE',
+                             headers=token)
+            request = self.app.request('/admin/profile/stats',
+                                       headers=token)
+            self.assertEqual(request.status, '404 Not Found')
+
+    def test_compare_digest_fallback(self):
+        compare_digest = storrest.storcompat.compare_digest
+        self.assertTrue(compare_digest('secret', 'secret'))
+        self.assertFalse(compare_digest('secret', 'secreT'))
+        self.assertFalse(compare_digest('secret', 'secret1'))
+        self.assertFalse(compare_digest('', 'secret'))
+        self.assertTrue(compare_digest('', ''))
+
+    def test_ordered_dict_fallback(self):
+        ordered = storrest.storcompat.OrderedDict()
+        for key in 'cab':
+            ordered[key] = key.upper()
+        ordered['c'] = 'C'
+        self.assertEqual(ordered.keys(), ['c', 'a', 'b'])
+        self.assertEqual(ordered.pop('a'), 'A')
+        self.assertEqual(ordered.pop('a', None), None)
+        ordered['a'] = 'A'
+        self.assertEqual(list(ordered.iteritems()),
+                         [('c', 'C'), ('b', 'B'), ('a', 'A')])
+        self.assertEqual(ordered.popitem(last=False), ('c', 'C'))
+        self.assertEqual(ordered.popitem(), ('a', 'A'))
+        self.assertEqual(ordered.values(), ['B'])
+        del ordered['b']
+        self.assertEqual(len(ordered), 0)
+        self.assertRaises(KeyError, ordered.popitem)
+
+    @mock.patch.object(storrest.storcli.Storcli, 'physical_drives')
+    def test_memoized_encoding(self, mock_obj):
+        memo = storrest.storcache.ResponseMemo()
+        drives = memo.derive('pds', [], dict, self.dummy_data)
+        mock_obj.return_value = drives
+        url = '/{0}/controllers/0/physicaldevices'.format(self.api_version)
+        with mock.patch.dict(storrest.storrest.CFG, {'memo': memo}):
+            replies = [self.app.request(url).data for _ in range(2)]
+        self.assertEqual(replies[0], replies[1])
+        self.verify_reply(self.app.request(url))
+        self.assertEqual(json.loads(replies[0])['data'], self.dummy_data)
+        self.assertEqual(memo.hits['encode'], 1)
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark of the drive health extraction
+
+Gets '/c0/eall/sall show all' of a synthetic controller from
+tools/nytrocli_sim.py and compares HealthInfoParser.add_health_info
+(direct lookup of the keys built from the drive addresses) with the
+regexp scan of all the keys (HealthInfoParser.drives_health) it used
+to do, both for a fresh parser and for the repeated parsing of the same
+(cached) response.
+"""
+
+import os
+import subprocess
+import sys
+import time
+from optparse import OptionParser
+
+TOP_SRCDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, TOP_SRCDIR)
+
+from storrest.storcli import Storcli
+from storrest.storcli_health import HealthInfoParser
+
+SIMULATOR = os.path.join(TOP_SRCDIR, 'tools', 'nytrocli_sim.py')
+HEALTH_CMD = '/c0/eall/sall show all J'.split()
+
+
+def regex_health_info(parser, controller_id, raw_health_info, pdrives):
+    """The health extraction by matching all the keys with regexps"""
+    health_info = parser.drives_health(controller_id,
+                                       raw_health_info[controller_id])
+    for pd in pdrives:
+        if controller_id != pd['controller_id']:
+            continue
+        pd['health'] = health_info.get(parser._drive_addr_tuple(pd))
+
+
+def best_of(repeat, fcn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fcn(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('--enclosures', type='int', default=10,
+                      help='enclosures of the controller (default: %default)')
+    parser.add_option('--slots', type='int', default=24,
+                      help='drives per enclosure (default: %default)')
+    parser.add_option('-r', '--repeat', type='int', default=20,
+                      help='report the best of this number of runs '
+                      '(default: %default)')
+    options, _ = parser.parse_args()
+
+    storcli_cmd = [sys.executable, SIMULATOR,
+                   '--enclosures', str(options.enclosures),
+                   '--slots', str(options.slots)]
+    storcli = Storcli(storcli_cmd=storcli_cmd)
+    cmd = storcli_cmd + HEALTH_CMD
+    raw_out = subprocess.check_output(cmd)
+    data = storcli._extract_storcli_data(storcli._decode(cmd, raw_out))
+    pdrives = [storcli._parse_physical_drive(0, drive_dat)
+               for key, val in data[0].iteritems()
+               if key.startswith('Drive ') and isinstance(val, list)
+               for drive_dat in val]
+
+    regex = best_of(options.repeat,
+                    lambda: regex_health_info(HealthInfoParser(), 0, data,
+                                              pdrives))
+    expected = [pd['health'] for pd in pdrives]
+    direct = best_of(options.repeat,
+                     lambda: HealthInfoParser().add_health_info(0, data,
+                                                                pdrives))
+    if [pd['health'] for pd in pdrives] != expected:
+        sys.stderr.write('direct lookup and regexps disagree\n')
+        sys.exit(1)
+    warm_parser = HealthInfoParser()
+    warm = best_of(options.repeat, warm_parser.add_health_info, 0, data,
+                   pdrives)
+    print('%d drives, %d keys in the response' % (len(pdrives),
+                                                  len(data[0])))
+    print('%-22s %10s %8s' % ('', 'ms', 'speedup'))
+    for name, elapsed in (('regexp scan', regex),
+                          ('direct lookup', direct),
+                          ('direct lookup, cached', warm)):
+        print('%-22s %10.3f %7.1fx' % (name, elapsed * 1000,
+                                       regex / elapsed if elapsed else 0))
+
+if __name__ == '__main__':
+    main()
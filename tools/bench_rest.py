@@ -0,0 +1,422 @@
+#!/usr/bin/env python
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""End to end benchmark of the storrest REST API
+
+Serves storrest.storrest.app over HTTP with tools/nytrocli_sim.py as
+nytrocli and measures every endpoint for each topology:
+
+- the GET endpoints are hammered by --concurrency client threads,
+- the modifying endpoints are run one at a time in rounds (create,
+  update, hot spare, delete, ...) since they change the configuration.
+
+The results (latency percentiles, requests per second, nytrocli spawns
+per request) are written as JSON. With --baseline the results are
+compared to a previous run and the regressions are reported.
+"""
+
+import httplib
+import json
+import os
+import platform
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+TOP_SRCDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, TOP_SRCDIR)
+
+import web
+from storrest import storrest
+from storrest.storcache import ControllerProfiles, ResultCache, \
+    TopologyIndex, parse_ttl_spec
+from storrest.storinventory import InventoryPoller
+
+SIMULATOR = os.path.join(TOP_SRCDIR, 'tools', 'nytrocli_sim.py')
+API = '/v0.5'
+# controllers x enclosures x slots, from 4 to 240 drives
+TOPOLOGIES = ('1x1x4', '2x1x12', '4x2x12', '8x2x15')
+GET_ENDPOINTS = (
+    '/controllers',
+    '/controllers/all',
+    '/controllers/0',
+    '/controllers/0/physicaldevices',
+    '/controllers/0/virtualdevices',
+    '/controllers/0/virtualdevices/0',
+    '/controllers/0/virtualdevices/nytrocache',
+    '/controllers/0/virtualdevices/cachecade',
+    '/jobs',
+)
+HOTSPARE = '/controllers/0/physicaldevices/E/S/hotspare'
+
+
+def percentile(values, pct):
+    """Nearest rank percentile of the sorted values"""
+    if not values:
+        return None
+    rank = int(round(pct / 100.0 * len(values) + 0.5)) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+def summarize(latencies, elapsed, spawns, errors):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {'requests': count,
+            'errors': errors,
+            'latency': {'p50': percentile(latencies, 50),
+                        'p95': percentile(latencies, 95),
+                        'p99': percentile(latencies, 99),
+                        'mean': sum(latencies) / count if count else None,
+                        'max': latencies[-1] if count else None},
+            'requests_per_second': count / elapsed if elapsed else None,
+            'spawns_per_request': float(spawns) / count if count else None}
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class Server(object):
+    """storrest.storrest.app in a background thread"""
+    def __init__(self, threads):
+        self.port = free_port()
+        self._server = web.httpserver.WSGIServer(('127.0.0.1', self.port),
+                                                 storrest.app.wsgifunc())
+        self._server.numthreads = threads
+        self._thread = threading.Thread(target=self._server.start)
+        self._thread.daemon = True
+
+    def start(self):
+        self._thread.start()
+        while not self._server.ready:
+            time.sleep(0.01)
+
+    def stop(self):
+        self._server.stop()
+        self._thread.join()
+
+
+class Client(object):
+    def __init__(self, port):
+        self._conn = httplib.HTTPConnection('127.0.0.1', port)
+
+    def request(self, method, url, data=None):
+        """Send the request, return (status, reply, latency)"""
+        body = json.dumps(data) if data is not None else None
+        start = time.time()
+        try:
+            self._conn.request(method, API + url, body)
+            response = self._conn.getresponse()
+            raw = response.read()
+        except (httplib.HTTPException, socket.error):
+            self._conn.close()
+            raise
+        latency = time.time() - start
+        if response.getheader('connection', '').lower() == 'close':
+            self._conn.close()
+        try:
+            reply = json.loads(raw)
+        except ValueError:
+            reply = None
+        return response.status, reply, latency
+
+    def close(self):
+        self._conn.close()
+
+
+def spawned():
+    return storrest.CFG['pool'].stats()['spawned']
+
+
+def run_concurrent(port, url, concurrency, requests):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    remaining = [requests]
+
+    def worker():
+        client = Client(port)
+        try:
+            while True:
+                with lock:
+                    if not remaining[0]:
+                        return
+                    remaining[0] -= 1
+                try:
+                    status, _, latency = client.request('GET', url)
+                except (httplib.HTTPException, socket.error):
+                    with lock:
+                        errors[0] += 1
+                    continue
+                with lock:
+                    latencies.append(latency)
+                    if status >= 400:
+                        errors[0] += 1
+        finally:
+            client.close()
+
+    spawned_before = spawned()
+    start = time.time()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    return summarize(latencies, elapsed, spawned() - spawned_before,
+                     errors[0])
+
+
+class MutationRound(object):
+    """The modifying endpoints, in the order which keeps the config sane
+
+    Uses the last two drives of the first enclosure of controller 0, the
+    RAID1 of the first two drives (created by the simulator with --vds 1)
+    is deleted by 'delete all' and created again at the end.
+    """
+    def __init__(self, client, enclosure, slots):
+        self.client = client
+        self.enclosure = enclosure
+        self.slots = slots
+        self.samples = {}
+
+    def _drive(self, slot):
+        return {'controller_id': 0, 'enclosure': self.enclosure,
+                'slot': slot}
+
+    def _call(self, method, name, url, data=None):
+        spawned_before = spawned()
+        status, reply, latency = self.client.request(method, url, data)
+        samples = self.samples.setdefault('%s %s' % (method, name),
+                                          ([], [0], [0]))
+        samples[0].append(latency)
+        samples[1][0] += spawned() - spawned_before
+        if status >= 400:
+            samples[2][0] += 1
+            return None
+        return reply['data']
+
+    def run(self):
+        vd_url = '/controllers/0/virtualdevices'
+        cc_url = vd_url + '/nytrocache'
+        hs_url = '/controllers/0/physicaldevices/%s/%s/hotspare' % (
+            self.enclosure, self.slots - 1)
+        data = {'drives': [self._drive(self.slots - 2)], 'raid_level': 0,
+                'name': 'bench'}
+        vd = self._call('POST', vd_url, vd_url, data)
+        if vd is not None:
+            vd_id = vd['virtual_drive']
+            self._call('POST', vd_url + '/N', '%s/%s' % (vd_url, vd_id),
+                       {'name': 'bench2'})
+            self._call('POST', HOTSPARE, hs_url, {'virtual_drives': [vd_id]})
+            self._call('DELETE', HOTSPARE, hs_url)
+            self._call('DELETE', vd_url + '/N', '%s/%s' % (vd_url, vd_id))
+        cc = self._call('POST', cc_url, cc_url,
+                        {'drives': [self._drive(self.slots - 2)]})
+        if cc is not None:
+            cc_id = cc['virtual_drive']
+            self._call('GET', cc_url + '/N', '%s/%s' % (cc_url, cc_id))
+            self._call('DELETE', cc_url + '/N', '%s/%s' % (cc_url, cc_id))
+        self._call('POST', vd_url + '/warpdrive', vd_url + '/warpdrive')
+        job = self._call('POST', vd_url + '/warpdrive?async=1',
+                         vd_url + '/warpdrive?async=1')
+        if job is not None:
+            storrest.CFG['jobs'].get(job['job_id']).wait(60)
+            self._call('GET', '/jobs/N', '/jobs/%s' % job['job_id'])
+        self._call('DELETE', vd_url, vd_url)
+        self._call('POST', vd_url, vd_url,
+                   {'drives': [self._drive(0), self._drive(1)],
+                    'raid_level': 1, 'name': 'vd0'})
+
+
+def configure(options, topology, state_file):
+    controllers, enclosures, slots = topology.split('x')
+    sim_cmd = [sys.executable, SIMULATOR,
+               '--controllers', controllers,
+               '--enclosures', enclosures,
+               '--slots', slots,
+               '--vds', '1',
+               '--state-file', state_file]
+    storrest.CFG['storcli_command'] = sim_cmd + options.sim_opts.split()
+    storrest.CFG['cache'] = None
+    if options.cache_ttl:
+        storrest.CFG['cache'] = ResultCache(
+            ttl=parse_ttl_spec(options.cache_ttl))
+    # the simulated controllers are not the same any more
+    storrest.CFG['controller_profiles'] = ControllerProfiles()
+    storrest.CFG['topology'] = TopologyIndex()
+    storrest.SERVICE.reset()
+    if storrest.CFG['inventory'] is not None:
+        storrest.CFG['inventory'].stop()
+        storrest.CFG['inventory'] = None
+    if options.poll_interval:
+        storrest.CFG['inventory'] = InventoryPoller(
+            storrest.get_storcli, interval=options.poll_interval)
+        storrest.CFG['inventory'].start()
+    return int(controllers), int(enclosures), int(slots)
+
+
+def bench_topology(options, topology, port, tmpdir):
+    state_file = os.path.join(tmpdir, '%s.json' % topology)
+    controllers, enclosures, slots = configure(options, topology, state_file)
+    info = {'topology': topology,
+            'controllers': controllers,
+            'drives': controllers * enclosures * slots}
+    results = []
+    # warm up (and create the simulator state)
+    Client(port).request('GET', '/controllers/all')
+    for url in GET_ENDPOINTS:
+        for concurrency in options.concurrency:
+            result = run_concurrent(port, url, concurrency, options.requests)
+            result.update(info, endpoint='GET %s' % url,
+                          concurrency=concurrency)
+            results.append(result)
+            sys.stderr.write('%(topology)s %(endpoint)s c=%(concurrency)s: '
+                             'p50 %(p50).4fs, %(rps).1f req/s, '
+                             '%(spawns).2f spawns/req\n' %
+                             dict(result, rps=result['requests_per_second'],
+                                  spawns=result['spawns_per_request'],
+                                  **result['latency']))
+    if slots < 4:
+        return results
+    client = Client(port)
+    mutations = MutationRound(client, 62, slots)
+    start = time.time()
+    for _ in range(options.mutation_rounds):
+        mutations.run()
+    elapsed = time.time() - start
+    client.close()
+    for endpoint, (latencies, spawns, errors) in \
+            sorted(mutations.samples.items()):
+        result = summarize(latencies, elapsed, spawns[0], errors[0])
+        # the rounds run sequentially, the rate of a single endpoint
+        # doesn't mean much
+        result['requests_per_second'] = None
+        result.update(info, endpoint=endpoint, concurrency=1)
+        results.append(result)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """The results whose p95 latency or spawns grew beyond the tolerance"""
+    def key(result):
+        return (result['topology'], result['endpoint'],
+                result['concurrency'])
+
+    old_results = dict((key(r), r) for r in baseline['results'])
+    regressions = []
+    for result in results:
+        old = old_results.get(key(result))
+        if old is None:
+            continue
+        for metric, new_val, old_val in (
+                ('p95', result['latency']['p95'], old['latency']['p95']),
+                ('spawns_per_request', result['spawns_per_request'],
+                 old['spawns_per_request'])):
+            if new_val is None or old_val is None:
+                continue
+            if new_val > old_val * (1 + tolerance) and new_val - old_val > \
+                    (0.001 if metric == 'p95' else 0.01):
+                regressions.append({'topology': result['topology'],
+                                    'endpoint': result['endpoint'],
+                                    'concurrency': result['concurrency'],
+                                    'metric': metric,
+                                    'baseline': old_val,
+                                    'current': new_val})
+    return regressions
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option('--topologies', default=','.join(TOPOLOGIES),
+                      help='comma separated CONTROLLERSxENCLOSURESxSLOTS '
+                      '(default: %default)')
+    parser.add_option('--concurrency', default='1,4,16',
+                      help='comma separated numbers of client threads '
+                      '(default: %default)')
+    parser.add_option('--requests', type='int', default=50,
+                      help='GET requests per endpoint and concurrency level '
+                      '(default: %default)')
+    parser.add_option('--mutation-rounds', type='int', default=3,
+                      help='runs of the modifying endpoints '
+                      '(default: %default)')
+    parser.add_option('--server-threads', type='int', default=16)
+    parser.add_option('--sim-opts', default='',
+                      help='extra nytrocli_sim.py options, '
+                      'i.e. "--latency 0.05"')
+    parser.add_option('--cache-ttl', help='as storrest --cache-ttl')
+    parser.add_option('--poll-interval', type='float',
+                      help='as storrest --poll-interval')
+    parser.add_option('-o', '--output', default='storrest-bench.json',
+                      help='JSON results file (default: %default)')
+    parser.add_option('--baseline',
+                      help='report the regressions against this results file')
+    parser.add_option('--tolerance', type='float', default=0.2,
+                      help='allowed relative growth of p95 latency and '
+                      'spawns per request (default: %default)')
+    options, _ = parser.parse_args()
+    options.concurrency = [int(c) for c in options.concurrency.split(',')]
+
+    tmpdir = tempfile.mkdtemp(prefix='storrest-bench-')
+    server = Server(options.server_threads)
+    server.start()
+    results = []
+    try:
+        for topology in options.topologies.split(','):
+            results.extend(bench_topology(options, topology, server.port,
+                                          tmpdir))
+    finally:
+        server.stop()
+        if storrest.CFG['inventory'] is not None:
+            storrest.CFG['inventory'].stop()
+        shutil.rmtree(tmpdir)
+
+    report = {'storrest_version': storrest.storrest_git_version,
+              'python': platform.python_version(),
+              'timestamp': time.time(),
+              'config': {'concurrency': options.concurrency,
+                         'requests': options.requests,
+                         'mutation_rounds': options.mutation_rounds,
+                         'server_threads': options.server_threads,
+                         'sim_opts': options.sim_opts,
+                         'cache_ttl': options.cache_ttl,
+                         'poll_interval': options.poll_interval,
+                         'max_workers': storrest.CFG['max_workers'],
+                         'batch_commands': storrest.CFG['batch_commands']},
+              'results': results}
+    ret = 0
+    if options.baseline:
+        with open(options.baseline) as f:
+            report['regressions'] = compare(results, json.load(f),
+                                            options.tolerance)
+        ret = 1 if report['regressions'] else 0
+    with open(options.output, 'w') as f:
+        json.dump(report, f, indent=1, sort_keys=True)
+    for regression in report.get('regressions', []):
+        sys.stderr.write('REGRESSION %(topology)s %(endpoint)s '
+                         'c=%(concurrency)s %(metric)s: %(baseline)s -> '
+                         '%(current)s\n' % regression)
+    return ret
+
+if __name__ == '__main__':
+    sys.exit(main())
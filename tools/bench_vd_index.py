@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Microbenchmark of the VD to PD association in _parse_virtual_drives
+
+Compares the drive group index (storutils.index_drive_groups) with the
+former scan of all physical drives for every virtual drive, for growing
+numbers of drives. Every 8th VD has a dedicated hot spare which belongs
+to its drive group and to the next one.
+"""
+
+import os
+import sys
+import time
+from optparse import OptionParser
+
+TOP_SRCDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, TOP_SRCDIR)
+
+from storrest.storcli import Storcli
+from storrest.storutils import index_drive_groups
+
+# physical drives x virtual drives (of a single controller)
+SIZES = ((24, 4), (60, 16), (120, 32), (240, 64), (480, 128))
+
+
+def make_drives(controller_id, pd_count, vd_count):
+    phys_drives = []
+    for slot in range(pd_count):
+        drive_group = slot * vd_count // pd_count
+        if slot % (pd_count // vd_count) == 0 and drive_group % 8 == 7:
+            # dedicated hot spare of two drive groups
+            drive_group = [drive_group, (drive_group + 1) % vd_count]
+        phys_drives.append({'controller_id': controller_id,
+                            'enclosure': 62 + slot // 24,
+                            'slot': slot % 24,
+                            'drive_group': drive_group,
+                            'allocated': True,
+                            'model': 'SIM SSD'})
+    vd_list = [{'DG/VD': '%d/%d' % (vd, vd),
+                'TYPE': 'RAID1',
+                'State': 'Optl',
+                'Access': 'RW',
+                'Consist': 'No',
+                'Cache': 'NRWTD',
+                'Cac': '-',
+                'Size': '100.0 GB',
+                'Name': 'vd%d' % vd} for vd in range(vd_count)]
+    return phys_drives, {controller_id: {'VD LIST': vd_list}}
+
+
+def scan_physical_drives(phys_drives, vdrives):
+    """The association by scanning all drives for every VD"""
+    def drive_belongs_to(phys, virt):
+        if phys['drive_group'] is None:
+            return False
+        if phys['controller_id'] != virt['controller_id']:
+            return False
+        if phys['drive_group'] == virt['drive_group']:
+            return True
+        try:
+            return virt['drive_group'] in phys['drive_group']
+        except TypeError:
+            return False
+
+    for vdrive in vdrives:
+        pdrives = [d for d in phys_drives if drive_belongs_to(d, vdrive)]
+        pdrives.sort()
+        vdrive['physical_drives'] = pdrives
+
+
+def index_physical_drives(phys_drives, vdrives):
+    dg_index = index_drive_groups(phys_drives)
+    for vdrive in vdrives:
+        key = (vdrive['controller_id'], vdrive['drive_group'])
+        vdrive['physical_drives'] = list(dg_index.get(key, ()))
+
+
+def best_of(repeat, fcn, *args):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        fcn(*args)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = OptionParser(usage='%prog [options]')
+    parser.add_option('-r', '--repeat', type='int', default=20,
+                      help='report the best of this number of runs '
+                      '(default: %default)')
+    options, _ = parser.parse_args()
+
+    storcli = Storcli(storcli_cmd=['true'])
+    print('%5s %5s %12s %12s %8s %12s' % ('PDs', 'VDs', 'scan, ms',
+                                           'index, ms', 'speedup',
+                                           'parse VDs, ms'))
+    for pd_count, vd_count in SIZES:
+        phys_drives, data = make_drives(0, pd_count, vd_count)
+        vdrives = [storcli._parse_virtual_drive(0, dat)
+                   for dat in data[0]['VD LIST']]
+        scan = best_of(options.repeat, scan_physical_drives, phys_drives,
+                       vdrives)
+        expected = [vd['physical_drives'] for vd in vdrives]
+        index = best_of(options.repeat, index_physical_drives, phys_drives,
+                        vdrives)
+        if [vd['physical_drives'] for vd in vdrives] != expected:
+            sys.stderr.write('index and scan disagree for %d PDs, %d VDs\n' %
+                             (pd_count, vd_count))
+            sys.exit(1)
+        parse = best_of(options.repeat, storcli._parse_virtual_drives, data,
+                        phys_drives)
+        print('%5d %5d %12.3f %12.3f %7.1fx %12.3f' % (
+            pd_count, vd_count, scan * 1000, index * 1000,
+            scan / index if index else float('inf'), parse * 1000))
+
+if __name__ == '__main__':
+    main()
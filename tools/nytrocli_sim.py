@@ -0,0 +1,588 @@
+#!/usr/bin/env python
+# Copyright 2014 Avago Technologies Ltd.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this software except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Fake nytrocli64 for testing storrest without the hardware
+
+The simulator options go before the nytrocli command, i.e.
+
+storrest --storcli-command \
+    'tools/nytrocli_sim.py --controllers 2 --enclosures 2 --slots 24'
+
+The topology (controllers x enclosures x slots) and the drives attributes
+are derived from --seed, so the same options give the same output. The
+virtual drives and hot spares created by the modifying commands are kept
+in --state-file, without it every run starts with the --vds RAID1 drives.
+"""
+
+import fcntl
+import json
+import os
+import random
+import re
+import sys
+import time
+from optparse import OptionParser
+
+FIRST_ENCLOSURE = 62
+CONTROLLER_MODEL = 'Nytro MegaRAID8100-4i'
+HDD_SIZE = 837.258
+SSD_SIZE = 185.750
+GENERIC_ERROR = 255
+OBJECT_RX = re.compile(r'^/c(\d+|all)(?:/e(\d+|all))?(?:/s(\d+|all))?'
+                       r'(?:/v(\d+|all))?$')
+CACHE_FLAGS = {'ra': ('read_ahead', 'R'), 'nora': ('read_ahead', 'NR'),
+               'wb': ('write_cache', 'WB'), 'wt': ('write_cache', 'WT'),
+               'direct': ('io_policy', 'D'), 'cached': ('io_policy', 'C')}
+CACHECADE_FLAGS = set(['cc', 'cachecade', 'nytrocache'])
+RAID_TYPES = {0: 'RAID0', 1: 'RAID1', 5: 'RAID5', 6: 'RAID6',
+              10: 'RAID10', 50: 'RAID50', 60: 'RAID60'}
+# the minimal number of drives and the number of drives used for parity
+RAID_GEOMETRY = {0: (1, 0), 1: (2, 1), 5: (3, 1), 6: (4, 2),
+                 10: (4, 2), 50: (6, 2), 60: (8, 4)}
+
+
+class NytrocliError(Exception):
+    def __init__(self, msg, error_code=GENERIC_ERROR):
+        super(NytrocliError, self).__init__(msg)
+        self.error_code = error_code
+
+
+def parse_options(argv):
+    parser = OptionParser(usage='%prog [options] NYTROCLI_COMMAND... J')
+    parser.disable_interspersed_args()
+    parser.add_option('--controllers', type='int', default=1)
+    parser.add_option('--enclosures', type='int', default=1,
+                      help='enclosures per controller')
+    parser.add_option('--slots', type='int', default=8,
+                      help='drives per enclosure')
+    parser.add_option('--vds', type='int', default=0,
+                      help='initial number of RAID1 virtual drives '
+                      'per controller')
+    parser.add_option('--latency', type='float', default=0.0,
+                      help='seconds every command takes')
+    parser.add_option('--latency-jitter', type='float', default=0.0,
+                      help='random extra latency, up to the given seconds')
+    parser.add_option('--latency-per-drive', type='float', default=0.0,
+                      help='extra seconds per drive in the output')
+    parser.add_option('--failure-rate', type='float', default=0.0,
+                      help='fraction of commands which fail')
+    parser.add_option('--seed', type='int', default=0)
+    parser.add_option('--state-file',
+                      help='keep the configuration changes between runs')
+    parser.add_option('--spawn-log',
+                      help='append a line per run to the given file')
+    return parser.parse_args(argv)
+
+
+def fmt_size(size_gb):
+    if size_gb >= 1024:
+        return '%.3f TB' % (size_gb / 1024)
+    return '%.3f GB' % size_gb
+
+
+class Topology(object):
+    """The drives (static) and the configuration (kept in the state)"""
+    def __init__(self, options, state):
+        self.options = options
+        self.state = state
+        if 'controllers' not in state:
+            state['controllers'] = dict((str(cid), self._initial_config(cid))
+                                        for cid in self.controller_ids())
+
+    def controller_ids(self):
+        return range(self.options.controllers)
+
+    def enclosure_ids(self):
+        return [FIRST_ENCLOSURE + e for e in range(self.options.enclosures)]
+
+    def drive_ids(self, controller_id):
+        return [(eid, slot) for eid in self.enclosure_ids()
+                for slot in range(self.options.slots)]
+
+    def config(self, controller_id):
+        return self.state['controllers'][str(controller_id)]
+
+    def _initial_config(self, controller_id):
+        cfg = {'vds': [], 'spares': {}}
+        drives = self.drive_ids(controller_id)
+        for vd in range(min(self.options.vds, len(drives) // 2)):
+            cfg['vds'].append(self._make_vd(cfg, 1, drives[2 * vd:2 * vd + 2],
+                                            name='vd%d' % vd))
+        return cfg
+
+    def drive(self, controller_id, eid, slot):
+        rng = random.Random('%s/%s/%s/%s' % (self.options.seed, controller_id,
+                                             eid, slot))
+        ssd = slot % 4 == 3
+        return {'did': (eid - FIRST_ENCLOSURE) * self.options.slots + slot,
+                'medium': 'SSD' if ssd else 'HDD',
+                'size': SSD_SIZE if ssd else HDD_SIZE,
+                'model': 'MZ6ER200HAGM' if ssd else 'ST900MM0006',
+                'serial': 'S0N%05d' % rng.randint(0, 99999),
+                'temperature': rng.randint(28, 45),
+                'life_left': rng.choice((100, 100, 98, 87)) if ssd else None}
+
+    def _make_vd(self, cfg, raid_level, drives, name='', cachecade=False):
+        used = [vd['dg'] for vd in cfg['vds']], [vd['vd'] for vd in cfg['vds']]
+        dg, vd = [min(set(range(len(ids) + 1)) - set(ids)) for ids in used]
+        return {'dg': dg, 'vd': vd, 'raid_level': raid_level,
+                'cachecade': cachecade, 'name': name,
+                'drives': [list(d) for d in drives],
+                'read_ahead': 'R', 'write_cache': 'WT', 'io_policy': 'D',
+                'ssd_caching': '-'}
+
+    def vd_of_drive(self, controller_id, eid, slot):
+        for vd in self.config(controller_id)['vds']:
+            if [eid, slot] in vd['drives']:
+                return vd
+
+    def drive_state(self, controller_id, eid, slot):
+        """nytrocli state and drive group of the drive"""
+        vd = self.vd_of_drive(controller_id, eid, slot)
+        if vd is not None:
+            return 'Onln', vd['dg']
+        dgs = self.config(controller_id)['spares'].get('%s:%s' % (eid, slot))
+        if dgs is None:
+            return 'UGood', '-'
+        if not dgs:
+            return 'GHS', '-'
+        return 'DHS', dgs[0] if len(dgs) == 1 else ','.join(map(str, dgs))
+
+    def pd_entry(self, controller_id, eid, slot):
+        drive = self.drive(controller_id, eid, slot)
+        state, dg = self.drive_state(controller_id, eid, slot)
+        return {'EID:Slt': '%s:%s' % (eid, slot),
+                'DID': drive['did'],
+                'State': state,
+                'DG': dg,
+                'Size': fmt_size(drive['size']),
+                'Intf': 'SAS',
+                'Med': drive['medium'],
+                'SED': 'N',
+                'PI': 'N',
+                'SeSz': '512B',
+                'Model': '%-16s' % drive['model'],
+                'Sp': 'U'}
+
+    def vd_type(self, vd):
+        if vd['cachecade']:
+            return 'NytroCache%d' % vd['raid_level']
+        return RAID_TYPES[vd['raid_level']]
+
+    def vd_size(self, controller_id, vd):
+        sizes = [self.drive(controller_id, *d)['size'] for d in vd['drives']]
+        if vd['cachecade']:
+            return sum(sizes)
+        _, parity = RAID_GEOMETRY[vd['raid_level']]
+        if vd['raid_level'] in (1, 10):
+            parity = len(sizes) // 2
+        return min(sizes) * (len(sizes) - parity)
+
+    def vd_entry(self, controller_id, vd):
+        return {'DG/VD': '%d/%d' % (vd['dg'], vd['vd']),
+                'TYPE': self.vd_type(vd),
+                'State': 'Optl',
+                'Access': 'RW',
+                'Consist': 'No',
+                'Cache': ''.join([vd['read_ahead'], vd['write_cache'],
+                                  vd['io_policy']]),
+                'Cac': vd['ssd_caching'],
+                'sCC': 'OFF',
+                'Size': fmt_size(self.vd_size(controller_id, vd)),
+                'Name': vd['name']}
+
+
+class Simulator(object):
+    def __init__(self, options, state, rng):
+        self.options = options
+        self.topology = Topology(options, state)
+        self.rng = rng
+        self.drives_shown = 0
+
+    def _controllers(self, cid):
+        if cid == 'all':
+            return self.topology.controller_ids()
+        if int(cid) not in self.topology.controller_ids():
+            raise NytrocliError('Controller %s not found' % cid)
+        return [int(cid)]
+
+    def _drives(self, controller_id, eid, slot):
+        drives = [(e, s) for e, s in self.topology.drive_ids(controller_id)
+                  if eid in (None, 'all', str(e)) and
+                  slot in (None, 'all', str(s))]
+        if not drives:
+            raise NytrocliError('Drive not found')
+        self.drives_shown += len(drives)
+        return drives
+
+    def _vds(self, controller_id, vid):
+        vds = [vd for vd in self.topology.config(controller_id)['vds']
+               if vid == 'all' or str(vd['vd']) == vid]
+        if not vds and vid != 'all':
+            raise NytrocliError('VD %s does not exist' % vid)
+        return vds
+
+    def _basics(self, cid):
+        return {'Controller': cid,
+                'Model': CONTROLLER_MODEL,
+                'Serial Number': 'SIM%06d' % cid,
+                'SAS Address': '50000000123456%02x' % cid,
+                'PCI Address': '00:%02x:00:00' % (6 + cid)}
+
+    def _topology(self, cid):
+        ret = []
+        for vd in self.topology.config(cid)['vds']:
+            vd_type = self.topology.vd_type(vd)
+            size = fmt_size(self.topology.vd_size(cid, vd))
+            ret.append({'DG': vd['dg'], 'Arr': '-', 'Row': '-',
+                        'EID:Slot': '-', 'DID': '-', 'Type': vd_type,
+                        'State': 'Optl', 'BT': 'N', 'Size': size,
+                        'PDC': 'dflt', 'PI': 'N', 'SED': 'N', 'DS3': 'none',
+                        'FSpace': 'N'})
+            for row, (eid, slot) in enumerate(vd['drives']):
+                pd = self.topology.pd_entry(cid, eid, slot)
+                ret.append({'DG': vd['dg'], 'Arr': 0, 'Row': row,
+                            'EID:Slot': pd['EID:Slt'], 'DID': pd['DID'],
+                            'Type': 'DRIVE', 'State': 'Onln', 'BT': 'N',
+                            'Size': pd['Size'], 'PDC': 'dflt', 'PI': 'N',
+                            'SED': 'N', 'DS3': 'none', 'FSpace': '-'})
+        return ret
+
+    def _drive_lists(self, cid):
+        vds = [self.topology.vd_entry(cid, vd)
+               for vd in self.topology.config(cid)['vds']]
+        pds = [self.topology.pd_entry(cid, *d)
+               for d in self._drives(cid, None, None)]
+        return {'Drive Groups': len(vds),
+                'TOPOLOGY': self._topology(cid),
+                'Virtual Drives': len(vds),
+                'VD LIST': vds,
+                'Physical Drives': len(pds),
+                'PD LIST': pds}
+
+    def show_controller(self, cid, show_all):
+        basics = self._basics(cid)
+        if show_all:
+            ret = {'Basics': basics,
+                   'Version': {'Firmware Package Build': '23.31.0-0023',
+                               'Firmware Version': '3.430.05-0023',
+                               'Driver Name': 'megaraid_sas'},
+                   'Bus': {'Vendor Id': 4096, 'Device Id': 91,
+                           'Host Interface': 'PCIE',
+                           'Device Interface': 'SAS-6G'},
+                   'Status': {'Controller Status': 'OK'},
+                   'Capabilities': {'Supported Drives': 'SAS, SATA',
+                                    'Max Configurable CacheCade Size': 512}}
+        else:
+            ret = {'Product Name': basics['Model'],
+                   'Serial Number': basics['Serial Number'],
+                   'SAS Address': ' ' + basics['SAS Address'],
+                   'PCI Address': basics['PCI Address'],
+                   'Host Interface': 'PCIE',
+                   'Device Interface': 'SAS-6G'}
+        ret.update(self._drive_lists(cid))
+        return ret
+
+    def show_health(self, cid):
+        return {'Controller Health Info': {'TemperatureROC': 60 + cid,
+                                           'Warranty Remaining': 100,
+                                           'Overall Health': 'GOOD',
+                                           'Reason Code': 0}}
+
+    def show_enclosures(self, cid, eid):
+        slots = self.options.slots
+        return {'Properties': [
+            {'EID': e, 'State': 'OK', 'Slots': slots, 'PD': slots, 'PS': 2,
+             'Fans': 4, 'TSs': 4, 'Alms': 1, 'SIM': 2, 'Port#': 'Port 0 - 3',
+             'ProdID': 'MD1220', 'VendorSpecific': 'SIM'}
+            for e in self.topology.enclosure_ids()
+            if eid == 'all' or str(e) == eid]}
+
+    def _drive_details(self, cid, eid, slot):
+        drive = self.topology.drive(cid, eid, slot)
+        addr = 'Drive /c%s/e%s/s%s' % (cid, eid, slot)
+        state = {'Shield Counter': 0,
+                 'Media Error Count': 0,
+                 'Other Error Count': 0,
+                 'Drive Temperature': ' %dC (%.2f F)' % (
+                     drive['temperature'], drive['temperature'] * 1.8 + 32),
+                 'Predictive Failure Count': 0,
+                 'S.M.A.R.T alert flagged by drive': 'No'}
+        if drive['life_left'] is not None:
+            state['SSD Life Left'] = ' %.2f' % drive['life_left']
+        inquiry = ''.join('%02x ' % ((drive['did'] * 7 + i) % 256)
+                          for i in range(128))
+        return {addr + ' State': state,
+                addr + ' Device attributes': {
+                    'SN': drive['serial'],
+                    'Manufacturer Id': 'SEAGATE ',
+                    'Model Number': '%-16s' % drive['model'],
+                    'WWN': '5000C500%08X' % (cid << 16 | eid << 8 | slot),
+                    'Firmware Revision': '0001',
+                    'Raw size': fmt_size(drive['size'] + 0.5),
+                    'Logical Sector Size': '512B',
+                    'Physical Sector Size': '512B'},
+                addr + ' Policies/Settings': {
+                    'Enclosure position': 0,
+                    'Connected Port Number': '0(path0) ',
+                    'Commissioned Spare': 'No',
+                    'Emergency Spare': 'No',
+                    'Port Information': [
+                        {'Port': port, 'Status': 'Active',
+                         'Linkspeed': '6.0Gb/s',
+                         'SAS address': '0x5000c500%08x' % (drive['did'] * 2 +
+                                                            port)}
+                        for port in (0, 1)]},
+                'Inquiry Data': inquiry}
+
+    def show_drives(self, cid, eid, slot, show_all):
+        ret = {}
+        drives = self._drives(cid, eid, slot)
+        if not show_all:
+            return {'Drive Information': [self.topology.pd_entry(cid, *d)
+                                          for d in drives]}
+        for e, s in drives:
+            addr = 'Drive /c%s/e%s/s%s' % (cid, e, s)
+            ret[addr] = [self.topology.pd_entry(cid, e, s)]
+            ret[addr + ' - Detailed Information'] = \
+                self._drive_details(cid, e, s)
+        return ret
+
+    def show_vds(self, cid, vid, show_all):
+        ret = {}
+        vds = self._vds(cid, vid)
+        if not show_all:
+            return {'Virtual Drives': [self.topology.vd_entry(cid, vd)
+                                       for vd in vds]}
+        for vd in vds:
+            ret['/c%s/v%s' % (cid, vd['vd'])] = [
+                self.topology.vd_entry(cid, vd)]
+            ret['PDs for VD %s' % vd['vd']] = [
+                self.topology.pd_entry(cid, *d) for d in vd['drives']]
+            ret['VD%s Properties' % vd['vd']] = {
+                'Strip Size': '256 KB',
+                'Number of Drives Per Span': len(vd['drives']),
+                'Span Depth': 1,
+                'OS Drive Name': '/dev/sd%s' % chr(ord('a') + vd['vd'] % 26)}
+        return ret
+
+    def _parse_drives(self, spec):
+        eid, slots = spec.split(':')
+        return [[int(eid), int(slot)] for slot in slots.split(',')]
+
+    def _check_unconfigured(self, cid, drives):
+        known = [list(d) for d in self.topology.drive_ids(cid)]
+        for eid, slot in drives:
+            if [eid, slot] not in known:
+                raise NytrocliError('Drive %s:%s not found' % (eid, slot))
+            state, _ = self.topology.drive_state(cid, eid, slot)
+            if state != 'UGood':
+                raise NytrocliError('Drive %s:%s is not unconfigured good' %
+                                    (eid, slot))
+
+    def add_vd(self, cid, args):
+        params = dict(arg.split('=', 1) for arg in args if '=' in arg)
+        params = dict((k.lower(), v) for k, v in params.iteritems())
+        flags = [arg.lower() for arg in args if '=' not in arg]
+        cachecade = bool(set(flags) & CACHECADE_FLAGS)
+        levels = [f for f in flags if re.match(r'^r(aid)?\d+$', f)]
+        if not levels or 'drives' not in params:
+            raise NytrocliError('Invalid add vd command')
+        raid_level = int(re.sub(r'\D', '', levels[0]))
+        if raid_level not in RAID_TYPES or \
+                cachecade and raid_level not in (0, 1):
+            raise NytrocliError('Unsupported RAID level %s' % raid_level)
+        drives = self._parse_drives(params['drives'])
+        spares = []
+        if 'spares' in params:
+            spares = self._parse_drives(params['spares'])
+        self._check_unconfigured(cid, drives + spares)
+        min_drives, _ = RAID_GEOMETRY[raid_level]
+        if len(drives) < min_drives or \
+                raid_level in (1, 10) and len(drives) % 2:
+            raise NytrocliError('Invalid number of drives for RAID%s' %
+                                raid_level)
+        cfg = self.topology.config(cid)
+        vd = self.topology._make_vd(cfg, raid_level, drives,
+                                    name=params.get('name', ''),
+                                    cachecade=cachecade)
+        for flag in flags:
+            if flag in CACHE_FLAGS:
+                key, val = CACHE_FLAGS[flag]
+                vd[key] = val
+        if 'cachevd' in flags:
+            vd['ssd_caching'] = 'R'
+        cfg['vds'].append(vd)
+        for eid, slot in spares:
+            cfg['spares']['%s:%s' % (eid, slot)] = [vd['dg']]
+        return 'Add VD Succeeded'
+
+    def delete_vds(self, cid, vid, args):
+        cfg = self.topology.config(cid)
+        deleted = self._vds(cid, vid)
+        cachecade = bool(set(args) & CACHECADE_FLAGS)
+        if vid != 'all' and deleted[0]['cachecade'] != cachecade:
+            raise NytrocliError('VD %s is %sa CacheCade VD' %
+                                (vid, '' if deleted[0]['cachecade']
+                                 else 'not '))
+        dgs = [vd['dg'] for vd in deleted]
+        cfg['vds'] = [vd for vd in cfg['vds'] if vd not in deleted]
+        for drive, spare_dgs in cfg['spares'].items():
+            if spare_dgs and not set(spare_dgs) - set(dgs):
+                del cfg['spares'][drive]
+        return 'Delete VD succeeded'
+
+    def set_vd(self, cid, vid, args):
+        for vd in self._vds(cid, vid):
+            for arg in args:
+                key, _, val = arg.partition('=')
+                key = key.lower()
+                if key == 'name':
+                    vd['name'] = val
+                elif key == 'ssdcaching':
+                    vd['ssd_caching'] = 'R' if val.lower() == 'on' else '-'
+                elif key in ('wrcache', 'rdcache', 'iopolicy') and \
+                        val.lower() in CACHE_FLAGS:
+                    vd_key, vd_val = CACHE_FLAGS[val.lower()]
+                    vd[vd_key] = vd_val
+                else:
+                    raise NytrocliError('Invalid set option %s' % arg)
+        return 'Set VD Properties succeeded'
+
+    def add_hotspare(self, cid, eid, slot, args):
+        drive = [int(eid), int(slot)]
+        self._check_unconfigured(cid, [drive])
+        params = dict(arg.split('=', 1) for arg in args if '=' in arg)
+        dgs = [int(dg) for dg in params.get('dgs', '').split(',') if dg]
+        known = [vd['dg'] for vd in self.topology.config(cid)['vds']]
+        if set(dgs) - set(known):
+            raise NytrocliError('Drive group %s not found' %
+                                ','.join(map(str, set(dgs) - set(known))))
+        self.topology.config(cid)['spares']['%s:%s' % tuple(drive)] = dgs
+        return 'Add Hot Spare Succeeded'
+
+    def delete_hotspare(self, cid, eid, slot):
+        spares = self.topology.config(cid)['spares']
+        if spares.pop('%s:%s' % (eid, slot), None) is None:
+            raise NytrocliError('Drive %s:%s is not a hot spare' %
+                                (eid, slot))
+        return 'Delete Hot Spare Succeeded'
+
+    def run_on_controller(self, cid, path, verb, args):
+        eid, slot, vid = path
+        show_all = args[:1] == ['all']
+        if verb == 'show':
+            if vid is not None:
+                return self.show_vds(cid, vid, show_all), None
+            if slot is not None:
+                return self.show_drives(cid, eid, slot, show_all), None
+            if eid is not None:
+                return self.show_enclosures(cid, eid), None
+            if args[:1] == ['health']:
+                return self.show_health(cid), None
+            return self.show_controller(cid, show_all), None
+        if verb == 'add' and args[:1] == ['vd'] and eid is None:
+            return None, self.add_vd(cid, args[1:])
+        if verb == 'del' and vid is not None:
+            return None, self.delete_vds(cid, vid, args)
+        if verb == 'set' and vid is not None:
+            return None, self.set_vd(cid, vid, args)
+        if slot not in (None, 'all') and args[:1] == ['hotsparedrive']:
+            if verb == 'add':
+                return None, self.add_hotspare(cid, eid, slot, args[1:])
+            if verb == 'delete':
+                return None, self.delete_hotspare(cid, eid, slot)
+        if verb == 'start' and args[:1] == ['format']:
+            return None, 'Start Format Succeeded'
+        raise NytrocliError('Un-supported command')
+
+    def run(self, args):
+        if args[-1:] != ['J'] or len(args) < 3:
+            raise NytrocliError('Only the JSON output (J) is supported')
+        matched = OBJECT_RX.match(args[0])
+        if not matched:
+            raise NytrocliError('Invalid object %s' % args[0])
+        cid, eid, slot, vid = matched.groups()
+        verb, rest = args[1].lower(), [a for a in args[2:-1]]
+        if verb != 'show':
+            rest = [a if '=' in a else a.lower() for a in rest]
+        ret = []
+        for controller_id in self._controllers(cid):
+            status = {'Controller': controller_id, 'Status': 'Success',
+                      'Description': 'None'}
+            out = {'Command Status': status}
+            try:
+                if self.rng.random() < self.options.failure_rate:
+                    raise NytrocliError('Simulated failure')
+                data, description = self.run_on_controller(
+                    controller_id, (eid, slot, vid), verb, rest)
+            except NytrocliError, e:
+                status.update({'Status': 'Failure', 'ErrCd': e.error_code,
+                               'Description': str(e)})
+            else:
+                if description is not None:
+                    status['Description'] = description
+                if data is not None:
+                    out['Response Data'] = data
+            ret.append(out)
+        return {'Controllers': ret}
+
+
+def error_reply(msg):
+    return {'Controllers': [{'Command Status': {
+        'Controller': 'None', 'Status': 'Failure', 'ErrCd': GENERIC_ERROR,
+        'Description': msg}}]}
+
+
+def main(argv):
+    options, args = parse_options(argv)
+    start = time.time()
+    state_fd = None
+    state = {}
+    if options.state_file:
+        state_fd = os.open(options.state_file, os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(state_fd, fcntl.LOCK_EX)
+        raw_state = os.read(state_fd, os.fstat(state_fd).st_size)
+        if raw_state:
+            state = json.loads(raw_state)
+    invocation = state.get('invocations', 0)
+    state['invocations'] = invocation + 1
+    rng = random.Random('%s:%s:%s' % (options.seed, invocation,
+                                      ' '.join(args)))
+    simulator = Simulator(options, state, rng)
+    try:
+        reply = simulator.run(args)
+    except NytrocliError, e:
+        reply = error_reply(str(e))
+    if state_fd is not None:
+        os.lseek(state_fd, 0, os.SEEK_SET)
+        os.ftruncate(state_fd, 0)
+        os.write(state_fd, json.dumps(state))
+        os.close(state_fd)
+    latency = options.latency + rng.random() * options.latency_jitter + \
+        options.latency_per_drive * simulator.drives_shown
+    time.sleep(max(latency - (time.time() - start), 0))
+    if options.spawn_log:
+        with open(options.spawn_log, 'a') as f:
+            f.write('%.6f %d %s\n' % (start, os.getpid(), ' '.join(args)))
+    sys.stdout.write(json.dumps(reply, indent=1, sort_keys=True,
+                                separators=(',', ' : ')))
+    sys.stdout.write('\n')
+    failed = any(c['Command Status']['Status'] != 'Success'
+                 for c in reply['Controllers'])
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))